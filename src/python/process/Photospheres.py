@@ -11,24 +11,96 @@ from OpenGL import GL
 from OpenGL.GL.shaders import compileShader, compileProgram
 from PyQt5.QtWidgets import QApplication, QMainWindow, QGridLayout
 from PyQt5.uic import loadUi
-from PyQt5.QtGui import QImage
+from PyQt5.QtCore import Qt, QBuffer, QIODevice, QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
 from PyQt5.QtNetwork import QNetworkRequest, QNetworkAccessManager
 from PyQt5.QtOpenGL import QGLWidget, QGLFormat
 
 
+def textureImage(image):
+    """
+    QImage in the layout ImageWidget uploads: RGBA8888, top row first, as QImage stores it.
+    Shares the image, without copying, when it is already in that format.
+    """
+    return image.convertToFormat(QImage.Format_RGBA8888)
+
+
+class ImageLoadSignals(QObject):
+    preview = pyqtSignal(int, QImage)
+    loaded = pyqtSignal(int, QImage)
+    failed = pyqtSignal(int, str)
+
+
+class ImageLoadTask(QRunnable):
+    """
+    Decodes one image on a QThreadPool worker thread, from a local file or from
+    downloaded bytes, and converts it with textureImage(), so the GUI thread only
+    uploads it. Larger images first emit a preview, reduced while decoding
+    (in the DCT domain, for JPEG) to fit within preview_size pixels.
+    Results carry the serial number of the load, so stale loads can be ignored.
+    """
+    def __init__(self, serial, path=None, data=None, preview_size=2048):
+        super(ImageLoadTask, self).__init__()
+        self.serial = serial
+        self.path = path
+        self.data = data
+        self.preview_size = preview_size
+        self.signals = ImageLoadSignals()
+
+    def _reader(self):
+        "(QImageReader, device it reads from); a reader decodes only once"
+        if self.path is not None:
+            # reads the file directly, not through QNetworkAccessManager
+            return QImageReader(self.path), None
+        device = QBuffer()
+        device.setData(self.data)
+        device.open(QIODevice.ReadOnly)
+        return QImageReader(device), device
+
+    def run(self):
+        try:
+            reader, device = self._reader()
+            size = reader.size()
+            if size.isValid() and max(size.width(), size.height()) > self.preview_size:
+                reader.setScaledSize(size.scaled(self.preview_size, self.preview_size, Qt.KeepAspectRatio))
+                preview = reader.read()
+                if not preview.isNull():
+                    self.signals.preview.emit(self.serial, textureImage(preview))
+                reader, device = self._reader()
+            image = reader.read()
+            if image.isNull():
+                self.signals.failed.emit(self.serial, reader.errorString())
+                return
+            self.signals.loaded.emit(self.serial, textureImage(image))
+        except Exception as exc:
+            self.signals.failed.emit(self.serial, str(exc))
+
+
 class ImageWidget(QGLWidget):
+    """
+    Shows one image, uploaded straight from the QImage memory through a pixel
+    buffer object, upload_band_bytes at a time, so the only CPU copy of the
+    image is the QImage itself. The shader flips the rows, which QImage stores top first.
+    """
+    upload_band_bytes = 16 << 20
+
     def __init__(self, *args, **kwargs):
         super(ImageWidget, self).__init__(*args, **kwargs)
         self.setStyleSheet('QWidget { background: blue; }');
         self.image = None
         self.image_needs_upload = False
+        self.pixel_buffer = None
 
     def setImage(self, image):
         if self.image is image:
             return # no change
-        self.image = image.convertToFormat(QImage.Format_RGBA8888).mirrored()
+        self.setTextureImage(textureImage(image))
+
+    def setTextureImage(self, image):
+        "Show an image already converted with textureImage(), for example on a worker thread"
+        self.image = image
         self.image_needs_upload = True
-        self.repaint()
+        self.update()
 
     def initializeGL(self):
         # print('initializeGL')
@@ -42,9 +114,10 @@ class ImageWidget(QGLWidget):
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
         GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        self.pixel_buffer = GL.glGenBuffers(1)
         vertex_shader = compileShader(
             """#version 450 core
-            #line 49
+            #line 122
             // projected screen quad
             const vec4 SCREEN_QUAD[4] = vec4[4](
                 vec4(-1, -1, 0.5, 1),
@@ -61,12 +134,13 @@ class ImageWidget(QGLWidget):
                 int vertexIndex = TRIANGLE_STRIP_INDICES[gl_VertexID];
                 gl_Position = SCREEN_QUAD[vertexIndex];
                 texCoord = 0.5 * (SCREEN_QUAD[vertexIndex].xy + vec2(1));
+                texCoord.y = 1.0 - texCoord.y; // image rows start at the top
             }
             """,
             GL.GL_VERTEX_SHADER)
         fragment_shader = compileShader(
             """#version 450 core
-            #line 71
+            #line 145
 
             layout(binding = 0) uniform sampler2D image;
 
@@ -83,29 +157,35 @@ class ImageWidget(QGLWidget):
         self.shader = compileProgram(vertex_shader, fragment_shader)
     
     def _uploadImageGL(self):
-        # print('uploading')
-        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
-        # print('getting bytes')
-        bits = self.image.bits()
-        bits.setsize(self.image.byteCount())
-        # print(bits)
-        # print(len(bits))
         w = self.image.width()
         h = self.image.height()
-        # print(w, h)
-        arr = numpy.array(bits).reshape(h, w, 4)
-        # print (arr.shape)
+        row_bytes = self.image.bytesPerLine()
+        bits = self.image.constBits()
+        bits.setsize(row_bytes * h)
+        pixels = numpy.frombuffer(bits, dtype=numpy.uint8).reshape(h, row_bytes) # no copy
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+        GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, row_bytes // 4)
         GL.glTexImage2D(
                 GL.GL_TEXTURE_2D,
                 0, 
-                GL.GL_RGBA,
-                self.image.width(),
-                self.image.height(),
+                GL.GL_RGBA8,
+                w,
+                h,
                 0,
                 GL.GL_RGBA,
                 GL.GL_UNSIGNED_BYTE, 
-                arr)
-        # print('glTexImage2D')
+                None)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.pixel_buffer)
+        band_rows = max(1, self.upload_band_bytes // row_bytes)
+        for y in range(0, h, band_rows):
+            band = pixels[y:y + band_rows]
+            # orphan the previous band, so this copy need not wait for its transfer
+            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, band.nbytes, None, GL.GL_STREAM_DRAW)
+            GL.glBufferSubData(GL.GL_PIXEL_UNPACK_BUFFER, 0, band.nbytes, band)
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, y, w, len(band),
+                               GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, None) # from the pixel buffer
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+        GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, 0)
         GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
         self.image_needs_upload = False
     
@@ -134,6 +214,9 @@ class MainWindow(QMainWindow):
         self.setAcceptDrops(True)
         self.webCtrl = QNetworkAccessManager()
         self.webCtrl.finished.connect(self._fileLoaded)
+        self.threadPool = QThreadPool.globalInstance()
+        self.loadSerial = 0 # only the latest load is shown
+        self.loadTasks = {}
         glFormat = QGLFormat()
         glFormat.setVersion(4, 5)
         glFormat.setProfile(QGLFormat.CoreProfile)
@@ -150,19 +233,47 @@ class MainWindow(QMainWindow):
 
     def dropEvent(self, event):
         for url in event.mimeData().urls():
-            request = QNetworkRequest(url)
-            self.webCtrl.get(request)        
+            self.loadUrl(url)
+
+    def loadUrl(self, url):
+        self.loadSerial += 1
+        if url.isLocalFile():
+            self._decode(ImageLoadTask(self.loadSerial, path=url.toLocalFile()))
+            return
+        request = QNetworkRequest(url)
+        request.setAttribute(QNetworkRequest.User, self.loadSerial)
+        self.webCtrl.get(request)
 
     def _fileLoaded(self, networkReply):
-        data = networkReply.readAll()
-        # print(len(data))
+        serial = networkReply.request().attribute(QNetworkRequest.User)
+        networkReply.deleteLater()
+        if serial != self.loadSerial:
+            return # superseded by a later drop
+        if networkReply.error():
+            self.statusBar().showMessage(networkReply.errorString())
+            return
         # todo: use libtiff or png libraries for 16-bit and 32-bit images
-        image = QImage()
-        image.loadFromData(data)
-        # print(image.width(), image.height())
-        # print(image.bitPlaneCount(), image.depth())
-        # print(image.format(), image.pixelFormat())
-        self.glWidget.setImage(image)
+        self._decode(ImageLoadTask(serial, data=networkReply.readAll()))
+
+    def _decode(self, task):
+        task.signals.preview.connect(self._imageDecoded)
+        task.signals.loaded.connect(self._imageDecoded)
+        task.signals.loaded.connect(self._loadFinished)
+        task.signals.failed.connect(self._loadFailed)
+        self.loadTasks[task.serial] = task # keeps the signals alive
+        self.threadPool.start(task)
+
+    def _imageDecoded(self, serial, image):
+        if serial == self.loadSerial:
+            self.glWidget.setTextureImage(image)
+
+    def _loadFinished(self, serial, image):
+        self.loadTasks.pop(serial, None)
+
+    def _loadFailed(self, serial, message):
+        self.loadTasks.pop(serial, None)
+        if serial == self.loadSerial:
+            self.statusBar().showMessage(message)
 
 
 class PhotospheresApp(QApplication):
@@ -0,0 +1,106 @@
+"""
+Accounting of OpenGL memory used by textures and vertex buffers,
+with an optional budget enforced by downscaling least-recently-displayed textures.
+"""
+
+from collections import OrderedDict
+
+
+def texture_bytes(width, height, bytes_per_texel, levels=1, faces=1):
+    """
+    Approximate GPU memory used by a texture with the given mipmap level count
+    """
+    total = 0
+    for _ in range(levels):
+        total += width * height * bytes_per_texel
+        width = max(1, width // 2)
+        height = max(1, height // 2)
+    return total * faces
+
+
+def mipmap_level_count(width, height):
+    return max(width, height).bit_length()
+
+
+def release_vbo_cpu_copy(vbo):
+    """
+    Drop the numpy array held by an OpenGL.arrays.vbo.VBO, once its contents are on the GPU
+    """
+    if vbo.copied:
+        vbo.data = None
+
+
+class GpuMemoryManager(object):
+    """
+    Registry of OpenGL resources.
+    Registered resources must implement gpu_bytes(), returning their current
+    GPU memory use. Resources that can shrink also implement reduce_gpu_memory(),
+    which releases some GPU memory (for example, by dropping the finest mipmap level)
+    and returns the number of bytes freed, or zero when no further reduction is possible.
+    All methods that may call reduce_gpu_memory() must be called with the OpenGL context current.
+    With release_cpu_copies=True, actors drop the CPU copies of static data once it is uploaded.
+    """
+    def __init__(self, budget_bytes=None, release_cpu_copies=False):
+        self.budget_bytes = budget_bytes  # None means unlimited
+        self.release_cpu_copies = release_cpu_copies
+        # Ordered least-recently-displayed first
+        self._resources = OrderedDict()
+
+    def register(self, resource):
+        "Add or update a resource, after its data has been uploaded"
+        key = id(resource)
+        self._resources[key] = [resource, resource.gpu_bytes()]
+        self._resources.move_to_end(key)
+        self.enforce_budget()
+
+    def unregister(self, resource):
+        self._resources.pop(id(resource), None)
+
+    def touch(self, resource):
+        "Mark a resource as displayed in the current frame"
+        key = id(resource)
+        if key in self._resources:
+            self._resources.move_to_end(key)
+
+    def set_budget(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.enforce_budget()
+
+    def used_bytes(self):
+        return sum(record[1] for record in self._resources.values())
+
+    def usage(self):
+        "List of (resource, gpu_bytes) pairs, least recently displayed first"
+        return [tuple(record) for record in self._resources.values()]
+
+    def footprints(self):
+        """
+        List of (resource, gpu_bytes, cpu_bytes) triples, least recently displayed first.
+        cpu_bytes is None for resources without a cpu_bytes() method.
+        """
+        result = []
+        for resource, gpu_bytes in self.usage():
+            cpu_bytes = resource.cpu_bytes() if hasattr(resource, 'cpu_bytes') else None
+            result.append((resource, gpu_bytes, cpu_bytes))
+        return result
+
+    def enforce_budget(self):
+        if self.budget_bytes is None:
+            return
+        used = self.used_bytes()
+        for record in list(self._resources.values()):
+            resource = record[0]
+            if not hasattr(resource, 'reduce_gpu_memory'):
+                continue
+            while used > self.budget_bytes:
+                freed = resource.reduce_gpu_memory()
+                if freed <= 0:
+                    break
+                used -= freed
+                record[1] = resource.gpu_bytes()
+            if used <= self.budget_bytes:
+                break
+
+
+# Shared manager used by all vrprim actors
+gpu_memory_manager = GpuMemoryManager()
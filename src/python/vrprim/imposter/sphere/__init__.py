@@ -4,6 +4,7 @@ Created on Feb 7, 2017
 @author: Christopher M. Bruns
 """
 
+import ctypes
 import textwrap
 
 from OpenGL import GL
@@ -12,12 +13,31 @@ from OpenGL.arrays.vbo import VBO
 import numpy
 
 from openvr.glframework.glmatrix import pack, translate
+from vrprim.gpu_memory import gpu_memory_manager, release_vbo_cpu_copy
+from vrprim.imposter.sphere.encoding import CompactSpheres, COMPACT_SPHERE_DTYPE
+from vrprim.imposter.sphere.lod import SphereLevelsOfDetail
+from vrprim.imposter.sphere.picking import SpherePicker
+from vrprim.imposter.sphere.spatial import SphereGrid, cell_ranges, frame_view_projections
+from vrprim.imposter.sphere.streaming import PersistentRingBuffer
 
 
 class SphereProgram(object):
     """
+    Implemented options, each generating a specialized program (see variant()):
+        encoding:
+            * "float": SPHERE_DTYPE vertex attributes, 20 bytes per sphere
+            * "compact": COMPACT_SPHERE_DTYPE vertex attributes, 8 bytes per sphere,
+              decoded with per-block frames and a color palette (see encoding.CompactSpheres)
+        depth:
+            * "correct": write the ray-cast sphere depth, with solid core near clipping
+            * "conservative": imposter geometry is flattened to the sphere's nearest depth, and the
+              ray-cast depth is declared depth_greater, so hidden spheres can be rejected
+              before shading. Spheres cut by the near plane are not solid core clipped.
+        lighting:
+            * "point_light": directional light, with the direction set per draw
+            * "normal": color by world-frame surface normal
+            * "flat": unlit per-sphere color
     Possible future adjustable options include:
-        correct_depth_buffer?
         radius:
             * constant global radius
             * uniform global radius
@@ -44,48 +64,168 @@ class SphereProgram(object):
         solid core clipping
             padded clip slab plus final fragment clipping
        """
+    # GLSL expression for the index of the current sphere in the vertex buffer
+    sphere_index_expression = 'gl_VertexID'
+    sphere_index_extension = ''
+    # direction toward the light, in world coordinates
+    light_direction = numpy.array([-2.0, 10.0, -1.0, 0.0])
+    # shared program instances, by class and options
+    _variants = {}
+
+    @classmethod
+    def variant(cls, **options):
+        """
+        Shared program for one combination of options. Actors using the same options
+        compile and link the program only once; it is deleted when the last one calls dispose_gl().
+        """
+        key = (cls, ) + tuple(sorted(options.items()))
+        if key not in SphereProgram._variants:
+            SphereProgram._variants[key] = cls(**options)
+        return SphereProgram._variants[key]
 
-    def __init__(self, default_radius=0.2):
+    def __init__(self, default_radius=0.2, encoding='float', block_size=4096,
+                 depth='correct', lighting='point_light'):
         self.default_radius = default_radius
+        self.encoding = encoding
+        self.block_size = block_size
+        self.depth = depth
+        self.lighting = lighting
         self.sphere_center_location = 1
+        self.sphere_radius_location = 4
+        self.sphere_color_location = 5
         self.model_view_location = 2
         self.projection_location = 3
+        self.radius_range_location = 6
+        self.block_frame_unit = 1
+        self.palette_unit = 2
+        self.projection_inverse_location = 7
+        self.light_direction_location = 8
         self.program_handle = None
+        self.user_count = 0
+
+    @property
+    def uses_projection_inverse(self):
+        return self.depth == 'correct'
 
     def init_gl(self):
-        vertex_shader = compileShader(self.get_vertex_shader(),
-                                      GL.GL_VERTEX_SHADER)
-        geometry_shader = compileShader(self.get_geometry_shader(),
-                                        GL.GL_GEOMETRY_SHADER)
-        fragment_shader = compileShader(self.get_fragment_shader(),
-                                        GL.GL_FRAGMENT_SHADER)
-        self.program_handle = compileProgram(vertex_shader, geometry_shader,
-                                             fragment_shader)
+        self.user_count += 1
+        if self.program_handle is not None:
+            return
+        shaders = [compileShader(self.get_vertex_shader(),
+                                 GL.GL_VERTEX_SHADER), ]
+        geometry_shader = self.get_geometry_shader()
+        if geometry_shader is not None:
+            shaders.append(compileShader(geometry_shader,
+                                         GL.GL_GEOMETRY_SHADER))
+        shaders.append(compileShader(self.get_fragment_shader(),
+                                     GL.GL_FRAGMENT_SHADER))
+        self.program_handle = compileProgram(*shaders)
 
     def load(self):
         GL.glUseProgram(self.program_handle)
 
+    def load_uniforms(self, model_view, projection):
+        "Per-draw uniforms, including matrix inverses that would otherwise be computed per vertex or fragment"
+        GL.glUniformMatrix4fv(self.model_view_location, 1, False,
+                              pack(model_view))
+        GL.glUniformMatrix4fv(self.projection_location, 1, False,
+                              pack(projection))
+        if self.uses_projection_inverse:
+            GL.glUniformMatrix4fv(self.projection_inverse_location, 1, False,
+                                  pack(numpy.linalg.inv(numpy.asarray(projection, dtype=numpy.float64))))
+        if self.lighting == 'point_light':
+            light = numpy.dot(self.light_direction, numpy.asarray(model_view, dtype=numpy.float64))[0:3]
+            GL.glUniform3f(self.light_direction_location, *(light / numpy.linalg.norm(light)))
+
     def dispose_gl(self):
-        if self.program_handle is not None:
+        self.user_count = max(self.user_count - 1, 0)
+        if self.program_handle is not None and self.user_count == 0:
             GL.glDeleteProgram(self.program_handle)
             self.program_handle = None
 
+    def get_attribute_decl(self):
+        "GLSL vertex attribute declarations, and a read_sphere() function that decodes them"
+        if self.encoding == 'float':
+            return textwrap.dedent(
+                """\
+                layout(location = %d) in vec3 sphere_center;
+                layout(location = %d) in float sphere_radius;
+                layout(location = %d) in vec4 sphere_color;
+
+                void read_sphere(out vec3 center, out float radius, out vec4 color)
+                {
+                    center = sphere_center;
+                    radius = sphere_radius;
+                    color = sphere_color;
+                }
+                """ % (self.sphere_center_location, self.sphere_radius_location,
+                       self.sphere_color_location))
+        elif self.encoding == 'compact':
+            return textwrap.dedent(
+                """\
+                layout(location = %d) in vec3 sphere_offset; // int16, in units of the block scale
+                layout(location = %d) in uvec2 sphere_codes; // palette index, quantized radius
+                layout(location = %d) uniform vec2 radius_range; // smallest radius, radius step
+                layout(binding = %d) uniform samplerBuffer block_frames; // origin, then scale, of each block
+                layout(binding = %d) uniform samplerBuffer palette;
+                const int BLOCK_SIZE = %d;
+
+                void read_sphere(out vec3 center, out float radius, out vec4 color)
+                {
+                    int block = (%s) / BLOCK_SIZE;
+                    vec3 origin = texelFetch(block_frames, 2 * block).xyz;
+                    vec3 scale = texelFetch(block_frames, 2 * block + 1).xyz;
+                    center = origin + scale * sphere_offset;
+                    radius = radius_range.x + radius_range.y * float(sphere_codes.y);
+                    color = texelFetch(palette, int(sphere_codes.x));
+                }
+                """ % (self.sphere_center_location, self.sphere_color_location,
+                       self.radius_range_location, self.block_frame_unit,
+                       self.palette_unit, self.block_size, self.sphere_index_expression))
+        raise ValueError("Unknown sphere encoding %r" % self.encoding)
+
+    def get_front_depth_decl(self):
+        "GLSL FLAT_DEPTH flag, true for depth='conservative', and the imposter depth function it uses"
+        if self.depth != 'conservative':
+            return 'const bool FLAT_DEPTH = false;\n'
+        return textwrap.dedent(
+            """\
+            const bool FLAT_DEPTH = true;
+
+            // NDC depth of the sphere point nearest the viewer, kept in front of the near plane.
+            // Imposter vertices at this depth never lie behind the ray-cast surface.
+            float front_ndc_depth(in vec3 center, in float radius)
+            {
+                vec4 clip = projectionMatrix * vec4(0, 0, center.z + radius, 1);
+                if (clip.w <= 0)
+                    return -0.99999;
+                return max(clip.z / clip.w, -0.99999);
+            }
+            """)
+
     def get_vertex_shader(self):
         vertex_shader = textwrap.dedent(
             """\
             #version 450 core
-            #line 78
+            #line 139
             // Vertex shader for sphere imposters
             
             layout(location = %d) uniform mat4 modelviewMatrix = mat4(1);
-            layout(location = %d) in vec3 sphere_center;
-            
+            %s
+            out SphereAttributes
+            {
+                float radius;
+                vec4 color;
+            } sa;
+
             void main() 
             {
+                vec3 sphere_center;
+                read_sphere(sphere_center, sa.radius, sa.color);
                 // NOTE: projection is deferred to the geometry shader
                 gl_Position = modelviewMatrix * vec4(sphere_center, 1);
             }
-            """ % (self.model_view_location, self.sphere_center_location))
+            """) % (self.model_view_location, self.get_attribute_decl())
         return vertex_shader
 
     def get_geometry_shader(self):
@@ -98,8 +238,13 @@ class SphereProgram(object):
             layout(triangle_strip, max_vertices=20) out; // 2 * viewer-facing half-cube imposter geometry
 
             layout(location = %d) uniform mat4 projectionMatrix;
-            
-            const float radius = %s;
+            %s
+            in SphereAttributes
+            {
+                float radius;
+                vec4 color;
+            } sa[];
+
             // Spatially linear parameters can be computed per-vertex, and correctly interpolated per-fragment,
             // to help efficiently solve the quadratic ray-casting formula for this sphere.
             out LinearParameters
@@ -109,13 +254,18 @@ class SphereProgram(object):
                 float c2; // cee squared   (constant)
                 float pc; // pos dot center   (linear)
                 float radius;
+                vec4 color; // (constant)
             } lp;
+
+            float imposter_ndc_depth; // with FLAT_DEPTH, the depth of all imposter vertices
             
             void emit_one_vertex(in vec3 offset, in float trim) 
             {
                 vec3 center = lp.c;
-                lp.p = lp.c + trim * radius * offset;
+                lp.p = lp.c + trim * lp.radius * offset;
                 gl_Position = projectionMatrix * vec4(lp.p, 1);
+                if (FLAT_DEPTH)
+                    gl_Position.z = imposter_ndc_depth * gl_Position.w;
                 lp.pc = dot(lp.p, lp.c);
                 EmitVertex();
             }
@@ -169,9 +319,13 @@ class SphereProgram(object):
             void main() 
             {
                 vec4 posIn = gl_in[0].gl_Position;
+                float radius = sa[0].radius;
                 lp.c = posIn.xyz/posIn.w; // sphere center is constant for all vertices
                 lp.c2 = dot(lp.c, lp.c) - radius*radius; // 2*c coefficient is constant for all vertices
                 lp.radius = radius;
+                lp.color = sa[0].color;
+                if (FLAT_DEPTH)
+                    imposter_ndc_depth = front_ndc_depth(lp.c, radius);
                 
                 // Use different optimizations depending on how close the sphere is to the viewer
                 // todo: make this optional
@@ -232,20 +386,69 @@ class SphereProgram(object):
                     EndPrimitive();
                 }
              }\
-            """ % (
-                self.projection_location,
-                self.default_radius))
+            """) % (self.projection_location, self.get_front_depth_decl())
         return geometry_shader
 
     def get_fragment_shader(self):
+        if self.depth == 'correct':
+            depth_code = textwrap.dedent(
+                """\
+                // Set depth correctly
+                const float far = 1.0; // or gl_DepthRange.far
+                const float near = 0.0; // or gl_DepthRange.near
+                vec4 clip = projectionMatrix * vec4(s, 1);
+                float ndc_depth = clip.z / clip.w;
+                float depth = 0.5 * ((far - near) * ndc_depth + near + far);
+                // NOTE: I'm not sure why "depth >= 1" is needed here, but it is needed
+                // to make the solid core effect work all the way through the sphere
+                if (depth <= 0 || depth >= 1) {  // sphere surface is behind near clip plane
+                    // is the rear of the sphere visible?
+                    vec3 back = alpha2 * lp.p;
+                    clip = projectionMatrix * vec4(back, 1);
+                    ndc_depth = clip.z / clip.w;
+                    depth = 0.5 * ((far - near) * ndc_depth + near + far);
+                    if (depth <= 0 || depth >= 1)
+                        discard;
+                    // Solid core clipped sphere
+                    normal = vec3(0, 0, 1);
+                    depth = 1e-9;
+                    // adjust s to intersect near clip plane
+                    vec4 zNear_vec = projectionInverse * vec4(0, 0, 0, 1);
+                    float zNear = zNear_vec.z / zNear_vec.w;
+                    float zd = (s.z - zNear) / (s.z - back.z);
+                    s = mix(s, back, zd);
+                }
+                gl_FragDepth = depth;
+                """)
+        elif self.depth == 'conservative':
+            # The imposter sits at the sphere's nearest depth (see get_front_depth_decl()),
+            # so the ray-cast depth is never nearer, as depth_greater promises
+            depth_code = textwrap.dedent(
+                """\
+                vec4 clip = projectionMatrix * vec4(s, 1);
+                float depth = 0.5 * (clip.z / clip.w + 1.0);
+                gl_FragDepth = clamp(depth, gl_FragCoord.z, 1.0);
+                """)
+        else:
+            raise ValueError("Unknown sphere depth mode %r" % self.depth)
+        shading = {
+            'point_light': 'point_light(s, normal, sphere_color)',
+            'normal': 'normal_material(s, normal, sphere_color)',
+            'flat': 'sphere_color',
+        }
+        if self.lighting not in shading:
+            raise ValueError("Unknown sphere lighting mode %r" % self.lighting)
         fragment_shader = textwrap.dedent(
             """\
             #version 450 core
             #line 245
             // Fragment shader for sphere imposters
+            %(depth_decl)s
             
-            layout(location = %d) uniform mat4 modelviewMatrix = mat4(1);
-            layout(location = %d) uniform mat4 projectionMatrix = mat4(1);
+            layout(location = %(model_view)d) uniform mat4 modelviewMatrix = mat4(1);
+            layout(location = %(projection)d) uniform mat4 projectionMatrix = mat4(1);
+            layout(location = %(projection_inverse)d) uniform mat4 projectionInverse = mat4(1);
+            layout(location = %(light_direction)d) uniform vec3 lightDirection = vec3(0, 0, 1); // in camera coordinates
 
             in LinearParameters
             {
@@ -254,6 +457,7 @@ class SphereProgram(object):
                 float c2; // cee squared   (constant)
                 float pc; // pos dot center   (linear)
                 float radius;
+                vec4 color; // (constant)
             } lp;
             
             out vec4 frag_color;
@@ -269,8 +473,7 @@ class SphereProgram(object):
                 const vec3 ambient_light = vec3(0.2, 0.2, 0.25);
                 const vec3 diffuse_light = vec3(0.6, 0.8, 0.6);
                 const vec3 specular_light = 0.5 * vec3(0.8, 0.8, 0.6);
-                const vec4 light_pos = modelviewMatrix * vec4(-2, 10, -1, 0);  // w==0 means light at inifinity
-                const vec3 surfaceToLight = normalize(light_pos.xyz);
+                vec3 surfaceToLight = lightDirection;
                 float diffuseCoefficient = max(0.0, dot(normal, surfaceToLight));
                 vec3 diffuse = diffuseCoefficient * surface_color * diffuse_light;
                 vec3 ambient = ambient_light * surface_color;
@@ -307,83 +510,501 @@ class SphereProgram(object):
                 vec3 s = alpha1 * lp.p;  // sphere surface in camera coordinates
                 
                 vec3 normal = 1.0 / lp.radius * (s - lp.c); // in camera coordinates
-                const vec3 sphere_color = vec3(0.4, 0.4, 0.6);
+                vec3 sphere_color = lp.color.rgb;
 
-                // Set depth correctly
-                // todo: make this optional
-                const float far = 1.0; // or gl_DepthRange.far
-                const float near = 0.0; // or gl_DepthRange.near
-                vec4 clip = projectionMatrix * vec4(s, 1);
-                float ndc_depth = clip.z / clip.w;
-                float depth = 0.5 * ((far - near) * ndc_depth + near + far);
-                // NOTE: I'm not sure why "depth >= 1" is needed here, but it is needed
-                // to make the solid core effect work all the way through the sphere
-                if (depth <= 0 || depth >= 1) {  // sphere surface is behind near clip plane
-                    // is the rear of the sphere visible?
-                    vec3 back = alpha2 * lp.p;
-                    clip = projectionMatrix * vec4(back, 1);
-                    ndc_depth = clip.z / clip.w;
-                    depth = 0.5 * ((far - near) * ndc_depth + near + far);
-                    if (depth <= 0 || depth >= 1)
-                        discard;
-                    // Solid core clipped sphere
-                    normal = vec3(0, 0, 1);
-                    depth = 1e-9;
-                    // adjust s to intersect near clip plane
-                    vec4 zNear_vec = inverse(projectionMatrix) * vec4(0, 0, 0, 1);
-                    float zNear = zNear_vec.z / zNear_vec.w;
-                    float zd = (s.z - zNear) / (s.z - back.z);
-                    s = mix(s, back, zd);
-                }
-                gl_FragDepth = depth;
-                
-                frag_color = vec4(
-                        point_light(s, normal, sphere_color),
-                        // normal_material(s, normal, sphere_color),
-                        opacity);
-                
+            %(depth_code)s
+                frag_color = vec4(%(shading)s, opacity);
+            }
+            """) % {
+                'model_view': self.model_view_location,
+                'projection': self.projection_location,
+                'projection_inverse': self.projection_inverse_location,
+                'light_direction': self.light_direction_location,
+                'depth_decl': 'layout(depth_greater) out float gl_FragDepth;' if self.depth == 'conservative' else '',
+                'depth_code': textwrap.indent(depth_code, '    '),
+                'shading': shading[self.lighting],
             }
-            """ % (self.model_view_location, self.projection_location))
         return fragment_shader
 
 
+class SphereQuadProgram(SphereProgram):
+    """
+    Sphere imposters without a geometry shader.
+    Each sphere is drawn as one instance of a four-vertex triangle strip,
+    a viewer-facing quad that bounds the sphere's silhouette,
+    with the per-sphere attributes advancing once per instance.
+    The fragment shader is the same ray-casting shader used by SphereProgram.
+    """
+    # gl_InstanceID does not include the base instance of each sphere range
+    sphere_index_expression = 'gl_InstanceID + gl_BaseInstanceARB'
+    sphere_index_extension = '#extension GL_ARB_shader_draw_parameters : require'
+
+    @property
+    def uses_projection_inverse(self):
+        return True  # for viewers inside a sphere
+
+    def get_vertex_shader(self):
+        vertex_shader = textwrap.dedent(
+            """\
+            #version 450 core
+            %s
+            #line 443
+            // Vertex shader for instanced quad sphere imposters
+            
+            layout(location = %d) uniform mat4 modelviewMatrix = mat4(1);
+            layout(location = %d) uniform mat4 projectionMatrix = mat4(1);
+            layout(location = %d) uniform mat4 projectionInverse = mat4(1);
+            %s
+            %s
+            out LinearParameters
+            {
+                vec3 c; // sphere center   (constant)
+                vec3 p; // imposter position   (linear)
+                float c2; // cee squared   (constant)
+                float pc; // pos dot center   (linear)
+                float radius;
+                vec4 color; // (constant)
+            } lp;
+
+            const vec2 STRIP_CORNERS[4] = vec2[4](
+                vec2(-1, -1),
+                vec2( 1, -1),
+                vec2(-1,  1),
+                vec2( 1,  1));
+
+            void main() 
+            {
+                vec2 corner = STRIP_CORNERS[gl_VertexID];
+                vec3 sphere_center;
+                float sphere_radius;
+                read_sphere(sphere_center, sphere_radius, lp.color);
+                vec4 c4 = modelviewMatrix * vec4(sphere_center, 1);
+                lp.c = c4.xyz / c4.w;
+                lp.radius = sphere_radius;
+                float r2 = sphere_radius * sphere_radius;
+                float d2 = dot(lp.c, lp.c);
+                lp.c2 = d2 - r2;
+                if (d2 > 1.0001 * r2) {
+                    // Quad through the sphere center, perpendicular to the view ray,
+                    // sized to cover the cone of rays tangent to the sphere
+                    vec3 zhat = normalize(-lp.c);
+                    vec3 up = abs(zhat.y) > 0.99 ? vec3(1, 0, 0) : vec3(0, 1, 0);
+                    vec3 xhat = normalize(cross(up, zhat));
+                    vec3 yhat = cross(zhat, xhat);
+                    float half_size = sphere_radius * sqrt(d2 / lp.c2);
+                    lp.p = lp.c + half_size * (corner.x * xhat + corner.y * yhat);
+                    gl_Position = projectionMatrix * vec4(lp.p, 1);
+                }
+                else {
+                    // Viewer is inside the sphere; cover the whole viewport
+                    gl_Position = vec4(corner, 0, 1);
+                    vec4 p4 = projectionInverse * gl_Position;
+                    lp.p = p4.xyz / p4.w;
+                }
+                if (FLAT_DEPTH)
+                    gl_Position.z = front_ndc_depth(lp.c, sphere_radius) * gl_Position.w;
+                lp.pc = dot(lp.p, lp.c);
+            }
+            """) % (self.sphere_index_extension if self.encoding == 'compact' else '',
+                    self.model_view_location, self.projection_location,
+                    self.projection_inverse_location, self.get_attribute_decl(),
+                    self.get_front_depth_decl())
+        return vertex_shader
+
+    def get_geometry_shader(self):
+        return None
+
+
+# Interleaved per-sphere vertex attributes, 20 bytes per sphere
+SPHERE_DTYPE = numpy.dtype([
+    ('center', numpy.float32, 3),
+    ('radius', numpy.float32),
+    ('color', numpy.uint8, 4),  # normalized RGBA
+])
+
+
+def sphere_array(centers, radii=None, colors=None, default_radius=0.2,
+                 default_color=(102, 102, 153, 255)):
+    """
+    Pack sphere centers, radii, and colors into one interleaved SPHERE_DTYPE array.
+    radii may be a scalar or one value per sphere. colors may be RGB or RGBA,
+    either floats in the range [0, 1] or uint8, one color for all or one per sphere.
+
+    >>> a = sphere_array([[0, 0, 0], [1, 2, 3]], radii=[0.5, 1.0], colors=(1.0, 0.0, 0.0))
+    >>> a['center'][1].tolist(), a['radius'].tolist(), a['color'][0].tolist()
+    ([1.0, 2.0, 3.0], [0.5, 1.0], [255, 0, 0, 255])
+    """
+    centers = numpy.asarray(centers, dtype=numpy.float32).reshape(-1, 3)
+    result = numpy.empty(len(centers), dtype=SPHERE_DTYPE)
+    result['center'] = centers
+    result['radius'] = default_radius if radii is None else radii
+    if colors is None:
+        colors = default_color
+    result['color'] = color_bytes(colors)
+    return result
+
+
+def color_bytes(colors):
+    "Convert RGB or RGBA colors, as floats in [0, 1] or uint8, into uint8 RGBA"
+    colors = numpy.asarray(colors)
+    if colors.dtype.kind == 'f':
+        colors = numpy.clip(colors * 255.0 + 0.5, 0, 255)
+    result = numpy.full(colors.shape[:-1] + (4,), 255, dtype=numpy.uint8)
+    result[..., 0:colors.shape[-1]] = colors
+    return result
+
+
 class SphereActor(object):
     """
-    High-performance display actor for large numbers of spheres
+    High-performance display actor for large numbers of spheres.
+    All spheres are stored in one interleaved vertex buffer, and drawn with a single draw call.
+    With a spatial index (by default for 10000 spheres or more) the buffer is sorted
+    by grid cell, and only cells inside the view frustum are drawn.
+    Sphere indices in the public methods always refer to the original input order.
+    backend selects how imposter geometry is generated: "geometry_shader" (SphereProgram)
+    or "instanced_quad" (SphereQuadProgram), which avoids geometry shaders.
+    dynamic actors keep triple-buffered, persistently mapped vertex storage, for spheres
+    that change every frame; see update_spheres().
+    encoding="compact" stores static spheres in 8 bytes each instead of 20, with
+    the precision bounds reported by the "compact" attribute (an encoding.CompactSpheres).
+    lod draws distant grid cells as a few aggregate spheres (see lod.SphereLevelsOfDetail),
+    so that imposter work follows screen coverage instead of sphere count.
+    pickable actors answer ray queries with pick(), and keep the picking index
+    current through move_spheres() and update_spheres().
+    depth and lighting select a shader variant; see SphereProgram. depth="conservative"
+    lets the GPU reject hidden spheres before shading them, and differs from "correct"
+    only for spheres cut by the near clipping plane.
     """
+    BACKENDS = {
+        'geometry_shader': SphereProgram,
+        'instanced_quad': SphereQuadProgram,
+    }
 
-    def __init__(self, vbos=None):
-        self.shader = SphereProgram()
+    def __init__(self, centers=None, radii=None, colors=None, spatial_index=None,
+                 backend='geometry_shader', dynamic=False, encoding='float', lod=False,
+                 pickable=False, depth='correct', lighting='point_light'):
+        if dynamic and encoding != 'float':
+            raise ValueError("Dynamic spheres require encoding='float'")
+        if lod and (dynamic or encoding != 'float' or spatial_index is False):
+            raise ValueError("Level of detail requires static, float encoded spheres with a spatial index")
+        self.backend = backend
+        self.shader = self.BACKENDS[backend].variant(encoding=encoding, depth=depth, lighting=lighting)
         self.vao = None
-        if vbos is None:
-            # Create on vertex buffer object
-            self.vbos = [VBO(numpy.array([0, 1.1, 0], dtype='f')), ]
+        self.indirect_buffer = None
+        if centers is None:
+            centers = [[0, 1.1, 0], ]  # one sphere
+        self.spheres = sphere_array(centers, radii, colors,
+                                    default_radius=self.shader.default_radius)
+        self.sphere_count = len(self.spheres)
+        self.picker = None
+        if pickable:
+            self.picker = SpherePicker(self.spheres['center'], self.spheres['radius'])
+        if spatial_index is None:
+            # contiguous updates of dynamic spheres would scatter in sorted order
+            spatial_index = self.sphere_count >= 10000 and not dynamic
+        self.grid = None
+        self.sphere_order = None  # original index of each sphere in the buffer
+        self.sphere_position = None  # buffer position of each original sphere index
+        self.cull_views = None
+        self._cull_call_count = 0  # display_gl() calls since set_cull_views()
+        self._visible_cells = None  # grid cells visible in any view of the current frame
+        self.lod = None
+        self.lod_vbo = None
+        self.lod_vao = None
+        if spatial_index or lod:
+            self._build_spatial_index()
+        if lod:
+            self.lod = SphereLevelsOfDetail(self.spheres, self.grid)
+            self.lod_vbo = VBO(self.lod.spheres.view(numpy.uint8))
+        self.vbo = None
+        self.ring = None
+        self.compact = None
+        if dynamic:
+            self.ring = PersistentRingBuffer(self.spheres)
+        elif encoding == 'compact':
+            # after spatial sorting, so each block covers a small region
+            self.compact = CompactSpheres(self.spheres, self.shader.block_size)
+            self.vbo = VBO(self.compact.data.view(numpy.uint8))
+        else:
+            self.vbo = VBO(self.spheres.view(numpy.uint8))
+
+    def _build_spatial_index(self):
+        self.grid = SphereGrid(self.spheres['center'], self.spheres['radius'])
+        self.spheres = self.spheres[self.grid.order]
+        if self.sphere_order is None:
+            self.sphere_order = self.grid.order
+        else:
+            self.sphere_order = self.sphere_order[self.grid.order]
+        self.sphere_position = numpy.empty_like(self.sphere_order)
+        self.sphere_position[self.sphere_order] = numpy.arange(self.sphere_count)
+        self._visible_cells = None
+        if self.lod is not None:
+            self._update_lod()
+
+    def set_cull_views(self, cull_views):
+        """
+        Cull once per frame against the union of several views, for example both eyes,
+        instead of separately in each display_gl() call: either a spatial.StereoCullViews,
+        which follows the eyes every frame (see spatial.use_stereo_culling()), or a list of
+        fixed model-view-projection matrices. Each frame then makes one display_gl() call
+        per view, in order. Pass None to restore per-call culling.
+        """
+        self.cull_views = cull_views
+        self._cull_call_count = 0
+        self._visible_cells = None
 
     def init_gl(self):
         self.shader.init_gl()
         self.vao = GL.glGenVertexArrays(1)
-        for vbo in self.vbos:
-            pass
+        GL.glBindVertexArray(self.vao)
+        if self.ring is not None:
+            self.ring.init_gl()
+        else:
+            self.vbo.bind()  # upload
+        if self.compact is not None:
+            attribute_locations = self._set_compact_attributes()
+            self.compact.init_gl()
+        else:
+            attribute_locations = self._set_float_attributes()
+        self._set_divisors(attribute_locations)
+        if self.lod is not None:
+            self.lod_vao = GL.glGenVertexArrays(1)
+            GL.glBindVertexArray(self.lod_vao)
+            self.lod_vbo.bind()
+            self._set_divisors(self._set_float_attributes())
+        if self.backend == 'instanced_quad':
+            self.indirect_buffer = GL.glGenBuffers(1)
+        GL.glBindVertexArray(0)
+        gpu_memory_manager.register(self)
+        if gpu_memory_manager.release_cpu_copies and self.vbo is not None:
+            release_vbo_cpu_copy(self.vbo)
+            if self.compact is not None:
+                self.compact.data = None
+            # self.spheres stays: update_spheres(), move_spheres() and spatial index rebuilds need it
+
+    def _set_divisors(self, attribute_locations):
+        if self.backend == 'instanced_quad':
+            # advance sphere attributes once per quad, not once per vertex
+            for loc in attribute_locations:
+                GL.glVertexAttribDivisor(loc, 1)
+
+    def _set_float_attributes(self):
+        stride = SPHERE_DTYPE.itemsize
+        fields = SPHERE_DTYPE.fields
+        loc = self.shader.sphere_center_location
+        GL.glEnableVertexAttribArray(loc)
+        GL.glVertexAttribPointer(loc, 3, GL.GL_FLOAT, False,
+                                 stride, ctypes.c_void_p(fields['center'][1]))
+        loc = self.shader.sphere_radius_location
+        GL.glEnableVertexAttribArray(loc)
+        GL.glVertexAttribPointer(loc, 1, GL.GL_FLOAT, False,
+                                 stride, ctypes.c_void_p(fields['radius'][1]))
+        loc = self.shader.sphere_color_location
+        GL.glEnableVertexAttribArray(loc)
+        GL.glVertexAttribPointer(loc, 4, GL.GL_UNSIGNED_BYTE, True,
+                                 stride, ctypes.c_void_p(fields['color'][1]))
+        return (self.shader.sphere_center_location,
+                self.shader.sphere_radius_location,
+                self.shader.sphere_color_location)
+
+    def _set_compact_attributes(self):
+        stride = COMPACT_SPHERE_DTYPE.itemsize
+        fields = COMPACT_SPHERE_DTYPE.fields
+        loc = self.shader.sphere_center_location
+        GL.glEnableVertexAttribArray(loc)
+        GL.glVertexAttribPointer(loc, 3, GL.GL_SHORT, False,
+                                 stride, ctypes.c_void_p(fields['offset'][1]))
+        # palette index and radius, as one integer uvec2
+        loc = self.shader.sphere_color_location
+        GL.glEnableVertexAttribArray(loc)
+        GL.glVertexAttribIPointer(loc, 2, GL.GL_UNSIGNED_BYTE,
+                                  stride, ctypes.c_void_p(fields['color_index'][1]))
+        return (self.shader.sphere_center_location,
+                self.shader.sphere_color_location)
+
+    def gpu_bytes(self):
+        if self.ring is not None:
+            return self.ring.gpu_bytes()
+        if self.compact is not None:
+            return self.compact.gpu_bytes()
+        if self.lod is not None:
+            return self.vbo.size + self.lod_vbo.size
+        return self.vbo.size
 
     def display_gl(self, model_view, projection):
+        if self.sphere_count < 1:
+            return
         GL.glBindVertexArray(self.vao)
         GL.glUseProgram(self.shader.program_handle)
-        GL.glUniformMatrix4fv(self.shader.model_view_location, 1, False,
-                              pack(model_view))
-        GL.glUniformMatrix4fv(self.shader.projection_location, 1, False,
-                              pack(projection))
-        for vbo in self.vbos:
-            vbo.bind()
-            xyzloc = self.shader.sphere_center_location
-            GL.glEnableVertexAttribArray(xyzloc)
-            GL.glVertexAttribPointer(xyzloc, 3, GL.GL_FLOAT, False, 0, None)
-            GL.glDrawArrays(GL.GL_POINTS, 0, 1)
+        self.shader.load_uniforms(model_view, projection)
+        if self.compact is not None:
+            self.compact.display_gl(self.shader.block_frame_unit, self.shader.palette_unit,
+                                    self.shader.radius_range_location)
+        if self.grid is None:
+            first = numpy.array([0, ], dtype=numpy.int32)
+            count = numpy.array([self.sphere_count, ], dtype=numpy.int32)
+        else:
+            visible = self._frame_visible_cells(model_view, projection)
+            if self.lod is None:
+                first, count = cell_ranges(numpy.flatnonzero(visible), self.grid.cell_start, self.grid.cell_count)
+            else:
+                first, count = self._draw_lod(model_view, projection, visible)
+        if len(first) < 1:
+            return
+        if self.ring is not None:
+            first = first + self.ring.first_element  # draw from the current region
+        self._draw_ranges(first, count)
+
+    def _frame_visible_cells(self, model_view, projection):
+        "Mask of visible grid cells, culled in the first display_gl() call of each frame"
+        view_count = 1 if self.cull_views is None else len(self.cull_views)
+        first_view = self._cull_call_count % view_count == 0
+        self._cull_call_count += 1
+        if first_view or self._visible_cells is None:
+            views = frame_view_projections(self.cull_views, model_view, projection)
+            self._visible_cells = self.grid.visible_cells(views)
+        return self._visible_cells
+
+    def _draw_lod(self, model_view, projection, visible):
+        "Draw the cells that need only aggregate spheres; returns ranges of cells that need every sphere"
+        viewport_height = GL.glGetIntegerv(GL.GL_VIEWPORT)[3]
+        levels = self.lod.select_levels(model_view, projection, viewport_height)
+        (first, count), (lod_first, lod_count) = self.lod.visible_ranges(visible, levels)
+        if len(lod_first) > 0:
+            GL.glBindVertexArray(self.lod_vao)
+            self._draw_ranges(lod_first, lod_count)
+            GL.glBindVertexArray(self.vao)
+        return first, count
+
+    def _draw_ranges(self, first, count):
+        if self.backend == 'instanced_quad':
+            self._draw_quad_ranges(first, count)
+        elif len(first) == 1:
+            GL.glDrawArrays(GL.GL_POINTS, int(first[0]), int(count[0]))
+        else:
+            GL.glMultiDrawArrays(GL.GL_POINTS, first, count, len(first))
+
+    def _draw_quad_ranges(self, first, count):
+        "One indirect draw command per sphere range, each instancing a four-vertex quad"
+        if len(first) == 1:
+            GL.glDrawArraysInstancedBaseInstance(GL.GL_TRIANGLE_STRIP, 0, 4,
+                                                 int(count[0]), int(first[0]))
+            return
+        # DrawArraysIndirectCommand: count, instanceCount, first, baseInstance
+        commands = numpy.zeros((len(first), 4), dtype=numpy.uint32)
+        commands[:, 0] = 4
+        commands[:, 1] = count
+        commands[:, 3] = first
+        GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, self.indirect_buffer)
+        GL.glBufferData(GL.GL_DRAW_INDIRECT_BUFFER, commands.nbytes, commands, GL.GL_STREAM_DRAW)
+        GL.glMultiDrawArraysIndirect(GL.GL_TRIANGLE_STRIP, None, len(first), 0)
+        GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, 0)
+
+    def move_spheres(self, indices, centers):
+        """
+        Change the centers of some spheres, and update the spatial index incrementally.
+        """
+        if self.compact is not None:
+            raise RuntimeError("Compact sphere encoding cannot be modified after construction")
+        indices = numpy.asarray(indices)
+        positions = indices if self.sphere_position is None else self.sphere_position[indices]
+        self.spheres['center'][positions] = centers
+        if self.picker is not None:
+            self.picker.move_spheres(indices, centers)
+        self._publish(positions, centers_changed=True)
+
+    def pick(self, origins, directions, max_distance=numpy.inf):
+        """
+        First sphere hit by each ray, for example one ray per controller, as (indices, distances);
+        see picking.SpherePicker.pick(). Requires pickable=True.
+        """
+        if self.picker is None:
+            raise RuntimeError("SphereActor was not created with pickable=True")
+        return self.picker.pick(origins, directions, max_distance)
+
+    def update_spheres(self, first=0, centers=None, radii=None, colors=None):
+        """
+        Replace the attributes of spheres first, first+1, ... with new values;
+        any of centers, radii, or colors may be omitted, and omitting all of them changes nothing.
+        On dynamic actors, the update is written into the next region of the mapped
+        buffer without waiting for the GPU, and becomes visible in the next display_gl().
+        """
+        if self.compact is not None:
+            raise RuntimeError("Compact sphere encoding cannot be modified after construction")
+        count = max([len(a) for a in (centers, radii, colors) if a is not None] or [0])
+        if count == 0:
+            return
+        indices = numpy.arange(first, first + count)
+        positions = indices if self.sphere_position is None else self.sphere_position[indices]
+        if centers is not None:
+            self.spheres['center'][positions] = centers
+        if radii is not None:
+            self.spheres['radius'][positions] = radii
+        if colors is not None:
+            self.spheres['color'][positions] = color_bytes(colors)
+        if self.picker is not None and (centers is not None or radii is not None):
+            spheres = self.spheres[positions]
+            self.picker.move_spheres(indices, spheres['center'], spheres['radius'])
+        self._publish(positions, centers_changed=centers is not None or radii is not None)
+
+    def update_bandwidth(self):
+        "Bytes per second written by update_spheres() on dynamic actors"
+        if self.ring is None:
+            return 0.0
+        return self.ring.update_bandwidth()
+
+    def _publish(self, positions, centers_changed):
+        "Send modified spheres, at the given buffer positions, to the GPU"
+        begin, end = positions.min(), positions.max() + 1
+        if self.grid is not None and centers_changed:
+            spheres = self.spheres[positions]
+            self.grid.update(positions, spheres['center'], spheres['radius'])
+            if self.grid.needs_rebuild:
+                self._build_spatial_index()
+                begin, end = 0, self.sphere_count
+            elif self.lod is not None:
+                self._update_lod()
+        if self.ring is not None:
+            self.ring.data = self.spheres
+            self.ring.write(int(begin), int(end))
+        else:
+            self._upload_range(begin, end)
+
+    def _update_lod(self):
+        "Recompute aggregate spheres, and upload them if the buffer already exists"
+        self.lod.build(self.spheres, self.grid)
+        self.lod_vbo.set_array(self.lod.spheres.view(numpy.uint8))
+        if self.lod_vao is not None:
+            self.lod_vbo.bind()
+            self.lod_vbo.unbind()
+
+    def _upload_range(self, begin, end):
+        "Copy spheres [begin, end) from the CPU copy into the vertex buffer"
+        stride = SPHERE_DTYPE.itemsize
+        self.vbo.bind()
+        GL.glBufferSubData(GL.GL_ARRAY_BUFFER, int(begin) * stride, int(end - begin) * stride,
+                           self.spheres[begin:end].view(numpy.uint8))
+        self.vbo.unbind()
 
     def dispose_gl(self):
+        gpu_memory_manager.unregister(self)
         self.shader.dispose_gl()
-        for vbo in self.vbos:
-            vbo.delete()
-        self.vbos = []
+        if self.vao is not None:
+            GL.glDeleteVertexArrays(1, [self.vao, ])
+            self.vao = None
+        if self.indirect_buffer is not None:
+            GL.glDeleteBuffers(1, [self.indirect_buffer, ])
+            self.indirect_buffer = None
+        if self.compact is not None:
+            self.compact.dispose_gl()
+        if self.lod_vao is not None:
+            GL.glDeleteVertexArrays(1, [self.lod_vao, ])
+            self.lod_vao = None
+            self.lod_vbo.delete()
+        if self.ring is not None:
+            self.ring.dispose_gl()
+        else:
+            self.vbo.delete()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+"""
+Measure SphereActor frame times for increasing numbers of spheres,
+for each imposter backend, for the compact sphere encoding,
+with level of detail, for the fastest shader variant,
+and for spheres that move every frame.
+
+Usage: python -m vrprim.imposter.sphere.benchmark [sphere_count ...]
+"""
+
+import sys
+import time
+
+import glfw
+import numpy
+from OpenGL import GL
+
+from vrprim.imposter.sphere import SphereActor
+
+
+def perspective(fov_y_degrees, aspect, z_near, z_far):
+    "Projection matrix, in the same (transposed) layout used by the other actors"
+    t = z_near * numpy.tan(numpy.radians(fov_y_degrees) / 2.0)
+    r = aspect * t
+    n, f = z_near, z_far
+    return numpy.array(
+            [[n/r, 0.0, 0.0, 0.0],
+            [0.0, n/t, 0.0, 0.0],
+            [0.0, 0.0, -(f+n)/(f-n), -1.0],
+            [0.0, 0.0, -2.0*f*n/(f-n), 0.0]], 'f')
+
+
+def random_spheres(count, seed=0):
+    "Spheres filling a 2x2x2 cube, sized to keep total sphere volume constant"
+    rng = numpy.random.RandomState(seed)
+    centers = rng.uniform(-1.0, 1.0, size=(count, 3)).astype(numpy.float32)
+    radii = numpy.full(count, 0.3 / count ** (1.0 / 3.0), dtype=numpy.float32)
+    colors = rng.randint(64, 256, size=(count, 3)).astype(numpy.uint8)
+    return centers, radii, colors
+
+
+class SphereBenchmark(object):
+    def __init__(self, width=1024, height=1024, frame_count=50):
+        self.width = width
+        self.height = height
+        self.frame_count = frame_count
+        self.window = None
+
+    def __enter__(self):
+        if not glfw.init():
+            raise Exception("GLFW Initialization error")
+        glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 4)
+        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 5)
+        glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+        glfw.window_hint(glfw.VISIBLE, False)
+        self.window = glfw.create_window(self.width, self.height, "Sphere benchmark", None, None)
+        if self.window is None:
+            glfw.terminate()
+            raise Exception("GLFW window creation error")
+        glfw.make_context_current(self.window)
+        glfw.swap_interval(0)
+        GL.glViewport(0, 0, self.width, self.height)
+        GL.glEnable(GL.GL_DEPTH_TEST)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        glfw.terminate()
+
+    def frame_time(self, actor):
+        "Mean milliseconds per frame, for a view of the whole sphere set"
+        model_view = numpy.identity(4, dtype=numpy.float32)
+        model_view[3, 2] = -3.0  # camera 3 units from the center of the spheres
+        projection = perspective(60.0, self.width / float(self.height), 0.1, 10.0)
+        actor.init_gl()
+        # warm up
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+        actor.display_gl(model_view, projection)
+        GL.glFinish()
+        t0 = time.time()
+        for _ in range(self.frame_count):
+            GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+            actor.display_gl(model_view, projection)
+        GL.glFinish()
+        elapsed = time.time() - t0
+        actor.dispose_gl()
+        return 1000.0 * elapsed / self.frame_count
+
+    def streaming_frame_time(self, actor, centers):
+        "Mean milliseconds per frame, and update megabytes per second, when all centers change each frame"
+        model_view = numpy.identity(4, dtype=numpy.float32)
+        model_view[3, 2] = -3.0
+        projection = perspective(60.0, self.width / float(self.height), 0.1, 10.0)
+        actor.init_gl()
+        offsets = numpy.random.RandomState(1).normal(0.0, 0.001, size=(4,) + centers.shape).astype(numpy.float32)
+        GL.glFinish()
+        t0 = time.time()
+        for frame in range(self.frame_count):
+            actor.update_spheres(centers=centers + offsets[frame % 4])
+            GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+            actor.display_gl(model_view, projection)
+        GL.glFinish()
+        elapsed = time.time() - t0
+        bandwidth = actor.update_bandwidth()
+        actor.dispose_gl()
+        return 1000.0 * elapsed / self.frame_count, bandwidth / 1e6
+
+
+def main(sphere_counts):
+    with SphereBenchmark() as bench:
+        for count in sphere_counts:
+            centers, radii, colors = random_spheres(count)
+            for backend in sorted(SphereActor.BACKENDS):
+                actor = SphereActor(centers=centers, radii=radii, colors=colors,
+                                    backend=backend)
+                ms = bench.frame_time(actor)
+                print("%10d spheres, %-16s: %8.2f ms per frame" % (count, backend, ms))
+            actor = SphereActor(centers=centers, radii=radii, colors=colors, encoding='compact')
+            ms = bench.frame_time(actor)
+            print("%10d spheres, %-16s: %8.2f ms per frame" % (count, 'compact', ms))
+            actor = SphereActor(centers=centers, radii=radii, colors=colors, lod=True)
+            ms = bench.frame_time(actor)
+            print("%10d spheres, %-16s: %8.2f ms per frame" % (count, 'lod', ms))
+            actor = SphereActor(centers=centers, radii=radii, colors=colors, depth='conservative', lighting='flat')
+            ms = bench.frame_time(actor)
+            print("%10d spheres, %-16s: %8.2f ms per frame" % (count, 'conservative, flat', ms))
+            actor = SphereActor(centers=centers, radii=radii, colors=colors, dynamic=True)
+            ms, mb_per_second = bench.streaming_frame_time(actor, centers)
+            print("%10d spheres, %-16s: %8.2f ms per frame, %8.1f MB/s updates" % (
+                    count, 'streaming', ms, mb_per_second))
+
+
+if __name__ == '__main__':
+    counts = [int(a) for a in sys.argv[1:]] or [10000, 1000000, 10000000]
+    main(counts)
@@ -0,0 +1,121 @@
+"""
+Compact encoding of sphere attributes, eight bytes per sphere:
+    * int16 xyz center, relative to the origin and scale of its block of consecutive spheres
+    * uint8 index into a palette of up to 256 RGBA colors
+    * uint8 radius, linearly quantized between the smallest and largest radius
+Decoding happens in the vertex shader; see SphereProgram(encoding='compact').
+Blocks are most precise when spheres are sorted spatially, as SphereGrid does.
+"""
+
+import numpy
+from OpenGL import GL
+
+
+COMPACT_SPHERE_DTYPE = numpy.dtype([
+    ('offset', '<i2', 3),
+    ('color_index', 'u1'),
+    ('radius_index', 'u1'),
+])
+
+
+def color_palette(colors, max_colors=256):
+    """
+    Returns (palette, indices) for an (N, 4) uint8 color array.
+    When there are more than max_colors distinct colors, low bits are dropped
+    from every channel until few enough colors remain.
+    """
+    packed = colors.astype(numpy.uint32).dot(numpy.array([1 << 24, 1 << 16, 1 << 8, 1], dtype=numpy.uint32))
+    for dropped_bits in range(8):
+        channel_mask = (0xff << dropped_bits) & 0xff
+        mask = numpy.uint32(channel_mask * 0x01010101)
+        palette_keys, indices = numpy.unique(packed & mask, return_inverse=True)
+        if len(palette_keys) <= max_colors:
+            break
+    half_step = numpy.uint32(((1 << dropped_bits) >> 1) * 0x01010101)
+    palette_keys = palette_keys | half_step  # center of each reduced color bin
+    shifts = numpy.array([24, 16, 8, 0], dtype=numpy.uint32)
+    palette = ((palette_keys[:, numpy.newaxis] >> shifts) & 0xff).astype(numpy.uint8)
+    return palette, indices.reshape(-1).astype(numpy.uint8)
+
+
+class CompactSpheres(object):
+    """
+    Quantized copy of a SPHERE_DTYPE array, plus the per-block frames and palette needed to decode it.
+    The precision bounds of the encoding are available as
+    max_position_error (per axis), max_radius_error, and max_color_error (per 8-bit channel).
+    Positions are exact to half a block scale, 1/65534 of the block extent per axis,
+    plus float32 rounding during decoding.
+    """
+    def __init__(self, spheres, block_size=4096):
+        self.block_size = block_size
+        count = len(spheres)
+        self.sphere_count = count
+        centers = spheres['center'].astype(numpy.float64)
+        starts = numpy.arange(0, max(count, 1), block_size)
+        if count == 0:
+            centers = numpy.zeros((1, 3))
+        lo = numpy.minimum.reduceat(centers, starts, axis=0)
+        hi = numpy.maximum.reduceat(centers, starts, axis=0)
+        origin = 0.5 * (lo + hi)
+        scale = numpy.maximum(0.5 * (hi - lo) / 32767.0, 1e-12)
+        block = numpy.arange(count) // block_size
+        self.data = numpy.empty(count, dtype=COMPACT_SPHERE_DTYPE)
+        self.data['offset'] = numpy.clip(numpy.rint((centers[:count] - origin[block]) / scale[block]), -32767, 32767)
+        # two RGBA32F texels per block: origin, then scale
+        self.block_frames = numpy.zeros((len(starts), 2, 4), dtype=numpy.float32)
+        self.block_frames[:, 0, 0:3] = origin
+        self.block_frames[:, 1, 0:3] = scale
+        self.max_position_error = 0.5 * scale.max(axis=0)
+        # radius
+        radii = spheres['radius']
+        r_min = float(radii.min()) if count else 0.0
+        r_max = float(radii.max()) if count else 0.0
+        r_step = (r_max - r_min) / 255.0
+        if r_step > 0:
+            self.data['radius_index'] = numpy.rint((radii - r_min) / r_step)
+        else:
+            self.data['radius_index'] = 0
+        self.radius_range = numpy.array([r_min, r_step], dtype=numpy.float32)
+        self.max_radius_error = 0.5 * r_step
+        # color
+        if count:
+            self.palette, self.data['color_index'] = color_palette(spheres['color'])
+            decoded = self.palette[self.data['color_index']].astype(numpy.int16)
+            self.max_color_error = int(numpy.abs(decoded - spheres['color']).max())
+        else:
+            self.palette = numpy.zeros((1, 4), dtype=numpy.uint8)
+            self.max_color_error = 0
+        self._buffers = None
+        self.textures = None
+
+    def gpu_bytes(self):
+        return (self.sphere_count * COMPACT_SPHERE_DTYPE.itemsize
+                + self.block_frames.nbytes + self.palette.nbytes)
+
+    def init_gl(self):
+        "Upload block frames and palette as buffer textures"
+        self._buffers = GL.glGenBuffers(2)
+        self.textures = GL.glGenTextures(2)
+        for buf, tex, arr, fmt in zip(self._buffers, self.textures,
+                                      (self.block_frames, self.palette),
+                                      (GL.GL_RGBA32F, GL.GL_RGBA8)):
+            GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, buf)
+            GL.glBufferData(GL.GL_TEXTURE_BUFFER, arr.nbytes, arr, GL.GL_STATIC_DRAW)
+            GL.glBindTexture(GL.GL_TEXTURE_BUFFER, tex)
+            GL.glTexBuffer(GL.GL_TEXTURE_BUFFER, fmt, buf)
+        GL.glBindTexture(GL.GL_TEXTURE_BUFFER, 0)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, 0)
+
+    def display_gl(self, block_frame_unit, palette_unit, radius_range_location):
+        for unit, tex in zip((block_frame_unit, palette_unit), self.textures):
+            GL.glActiveTexture(GL.GL_TEXTURE0 + unit)
+            GL.glBindTexture(GL.GL_TEXTURE_BUFFER, tex)
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+        GL.glUniform2f(radius_range_location, self.radius_range[0], self.radius_range[1])
+
+    def dispose_gl(self):
+        if self.textures is not None:
+            GL.glDeleteTextures(self.textures)
+            GL.glDeleteBuffers(2, self._buffers)
+            self.textures = None
+            self._buffers = None
@@ -0,0 +1,115 @@
+"""
+Hierarchical level of detail for large sphere sets, built over a SphereGrid.
+
+Each coarser level replaces the spheres of every grid cell with at most
+subdivision**3 aggregate spheres, one per occupied sub-cell. An aggregate keeps the
+total projected area of its members (up to their bounding sphere), and their
+area-weighted mean center and color. At display time each visible cell is drawn
+at the coarsest level whose aggregates still project to at most pixel_radius pixels,
+so distant clusters cost a few sub-pixel sphere imposters instead of thousands.
+"""
+
+import numpy
+
+from vrprim.imposter.sphere.spatial import morton_code, cell_ranges
+
+
+def aggregate_spheres(spheres, starts):
+    """
+    One aggregate sphere for each group of consecutive spheres beginning at the indices in starts
+    """
+    centers = spheres['center'].astype(numpy.float64)
+    radii = spheres['radius'].astype(numpy.float64)
+    area = radii * radii
+    total_area = numpy.maximum(numpy.add.reduceat(area, starts), 1e-30)
+    center = numpy.add.reduceat(centers * area[:, numpy.newaxis], starts, axis=0) / total_area[:, numpy.newaxis]
+    group = numpy.repeat(numpy.arange(len(starts)), numpy.diff(numpy.r_[starts, len(spheres)]))
+    extent = numpy.linalg.norm(centers - center[group], axis=1) + radii
+    bounding_radius = numpy.maximum.reduceat(extent, starts)
+    color = numpy.add.reduceat(spheres['color'] * area[:, numpy.newaxis], starts, axis=0) / total_area[:, numpy.newaxis]
+    result = numpy.empty(len(starts), dtype=spheres.dtype)
+    result['center'] = center
+    result['radius'] = numpy.minimum(numpy.sqrt(total_area), bounding_radius)
+    result['color'] = numpy.clip(numpy.rint(color), 0, 255)
+    return result
+
+
+class SphereLevelsOfDetail(object):
+    """
+    Aggregate sphere levels for spheres sorted in SphereGrid order.
+    "spheres" holds every coarser level, concatenated; level k (1, 2, ...) of cell i
+    is the range cell_start[k][i], with cell_count[k][i] aggregates.
+    Level 0 is the original spheres, with the grid's own cell ranges.
+    """
+    def __init__(self, spheres, grid, subdivisions=(4, 2, 1), pixel_radius=1.0):
+        self.subdivisions = subdivisions
+        self.pixel_radius = pixel_radius
+        self.build(spheres, grid)
+
+    def build(self, spheres, grid):
+        "(Re)compute the aggregate levels, after spheres move or the grid is rebuilt"
+        self.grid = grid
+        cell_total = len(grid.cell_start)
+        # largest radius drawn in each cell, for each level
+        self.cell_radius = [numpy.maximum.reduceat(spheres['radius'], grid.cell_start)
+                            if cell_total else numpy.zeros(0, dtype=numpy.float32), ]
+        self.cell_start = [grid.cell_start, ]
+        self.cell_count = [grid.cell_count, ]
+        levels = []
+        offset = 0
+        if cell_total:
+            scaled = (spheres['center'] - grid.origin) / grid.cell_size
+            fraction = scaled - numpy.floor(scaled)  # position within the grid cell
+        for subdivision in self.subdivisions:
+            if cell_total == 0:
+                break
+            sub_ijk = numpy.clip(numpy.floor(fraction * subdivision), 0, subdivision - 1).astype(numpy.int64)
+            key = grid.sphere_cell.astype(numpy.int64) * subdivision ** 3 + morton_code(sub_ijk)
+            order = numpy.argsort(key, kind='stable')
+            key = key[order]
+            starts = numpy.flatnonzero(numpy.r_[True, key[1:] != key[:-1]])
+            aggregates = aggregate_spheres(spheres[order], starts)
+            agg_cell = key[starts] // subdivision ** 3
+            first = numpy.searchsorted(agg_cell, numpy.arange(cell_total))
+            count = numpy.diff(numpy.r_[first, len(starts)])
+            self.cell_start.append((first + offset).astype(numpy.int32))
+            self.cell_count.append(count.astype(numpy.int32))
+            self.cell_radius.append(numpy.maximum.reduceat(aggregates['radius'], first))
+            levels.append(aggregates)
+            offset += len(aggregates)
+        self.cell_radius = numpy.array(self.cell_radius)
+        if levels:
+            self.spheres = numpy.concatenate(levels)
+        else:
+            self.spheres = numpy.zeros(0, dtype=spheres.dtype)
+
+    @property
+    def level_count(self):
+        return len(self.cell_start)
+
+    def select_levels(self, model_view, projection, viewport_height):
+        "Level of detail index for every grid cell, for one view"
+        eye = numpy.linalg.inv(numpy.asarray(model_view, dtype=numpy.float64))[3, 0:3]
+        # distance from the eye to the nearest point of each cell box
+        gap = numpy.maximum(numpy.maximum(self.grid.box_min - eye, eye - self.grid.box_max), 0)
+        distance = numpy.maximum(numpy.linalg.norm(gap, axis=1), 1e-6)
+        pixels_per_unit = 0.5 * viewport_height * abs(projection[1][1]) / distance
+        small_enough = self.cell_radius * pixels_per_unit <= self.pixel_radius
+        small_enough[0] = True
+        # coarsest acceptable level
+        return self.level_count - 1 - numpy.argmax(small_enough[::-1], axis=0)
+
+    def visible_ranges(self, visible, levels):
+        """
+        Draw ranges for the visible cells, as ((first, count) into the original spheres,
+        (first, count) into the concatenated aggregate spheres)
+        """
+        fine = cell_ranges(numpy.flatnonzero(visible & (levels == 0)),
+                           self.cell_start[0], self.cell_count[0])
+        coarse = [cell_ranges(numpy.flatnonzero(visible & (levels == k)),
+                              self.cell_start[k], self.cell_count[k])
+                  for k in range(1, self.level_count)]
+        if not coarse:
+            return fine, (numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32))
+        return fine, (numpy.concatenate([r[0] for r in coarse]),
+                      numpy.concatenate([r[1] for r in coarse]))
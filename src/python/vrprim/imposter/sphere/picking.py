@@ -0,0 +1,174 @@
+"""
+First-hit ray picking against large sphere sets, for example from VR controllers.
+
+Spheres are bucketed in a fine SphereGrid, and the grid cells, which are stored in
+Morton order, are grouped into a bounding volume hierarchy of consecutive cells.
+Each ray descends the hierarchy to the grid cells it intersects, then tests the
+spheres of those cells, nearest cells first, stopping as soon as no remaining
+cell can hold a closer hit.
+"""
+
+import numpy
+
+from vrprim.imposter.sphere.spatial import SphereGrid
+
+
+def ray_box_intervals(origin, direction, box_min, box_max):
+    "Entry and exit distances of one ray through each axis-aligned box; no overlap when exit < entry"
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        inverse = 1.0 / direction
+        t0 = (box_min - origin) * inverse
+        t1 = (box_max - origin) * inverse
+    # fmin/fmax ignore the NaNs from rays lying in a box face
+    near = numpy.fmin(t0, t1)
+    far = numpy.fmax(t0, t1)
+    t_enter = numpy.fmax(numpy.fmax(near[:, 0], near[:, 1]), near[:, 2])
+    t_exit = numpy.fmin(numpy.fmin(far[:, 0], far[:, 1]), far[:, 2])
+    return t_enter, t_exit
+
+
+def ray_sphere_distances(origin, direction, centers, radii):
+    """
+    Distance along one normalized ray to the first intersection with each sphere.
+    Rays starting inside a sphere hit it at distance zero; misses are infinite.
+    """
+    oc = centers - origin
+    b = oc.dot(direction)
+    discriminant = b * b - numpy.einsum('ij,ij->i', oc, oc) + radii * radii
+    result = numpy.full(len(radii), numpy.inf)
+    hit = discriminant >= 0
+    root = numpy.sqrt(discriminant[hit])
+    near = b[hit] - root
+    far = b[hit] + root
+    result[hit] = numpy.where(near >= 0, near, numpy.where(far >= 0, 0.0, numpy.inf))
+    return result
+
+
+class SpherePicker(object):
+    """
+    Answers batched ray queries, such as one ray per controller per frame, against a set of spheres.
+    Sphere indices refer to the order of the centers given to the constructor.
+    """
+    def __init__(self, centers, radii, spheres_per_cell=64, branching=16):
+        self.spheres_per_cell = spheres_per_cell
+        self.branching = branching
+        self.centers = numpy.array(centers, dtype=numpy.float64).reshape(-1, 3)
+        self.radii = numpy.array(numpy.broadcast_to(radii, (len(self.centers),)), dtype=numpy.float64)
+        self._build()
+
+    def _build(self):
+        self.grid = SphereGrid(self.centers, self.radii, spheres_per_cell=self.spheres_per_cell)
+        self._sorted_centers = self.centers[self.grid.order]
+        self._sorted_radii = self.radii[self.grid.order]
+        self._position = numpy.empty_like(self.grid.order)
+        self._position[self.grid.order] = numpy.arange(len(self.grid.order))
+        # (box_min, box_max) of each hierarchy level above the grid cells, coarsest last
+        self.levels = []
+        box_min, box_max = self.grid.box_min, self.grid.box_max
+        while len(box_min) > self.branching:
+            starts = numpy.arange(0, len(box_min), self.branching)
+            box_min = numpy.minimum.reduceat(box_min, starts, axis=0)
+            box_max = numpy.maximum.reduceat(box_max, starts, axis=0)
+            self.levels.append((box_min, box_max))
+
+    def move_spheres(self, indices, centers, radii=None):
+        "Update some spheres in place; cell bounds grow to match, until the grid needs a rebuild"
+        indices = numpy.asarray(indices)
+        self.centers[indices] = centers
+        if radii is not None:
+            self.radii[indices] = radii
+        if len(self.grid.order) == 0:
+            return
+        positions = self._position[indices]
+        self._sorted_centers[positions] = self.centers[indices]
+        self._sorted_radii[positions] = self.radii[indices]
+        self.grid.update(positions, self.centers[indices], self.radii[indices])
+        if self.grid.needs_rebuild:
+            self._build()
+            return
+        # grow the hierarchy boxes above the updated cells
+        nodes = numpy.unique(self.grid.sphere_cell[positions])
+        child_min, child_max = self.grid.box_min, self.grid.box_max
+        for box_min, box_max in self.levels:
+            parents = nodes // self.branching
+            numpy.minimum.at(box_min, parents, child_min[nodes])
+            numpy.maximum.at(box_max, parents, child_max[nodes])
+            nodes = numpy.unique(parents)
+            child_min, child_max = box_min, box_max
+
+    def pick(self, origins, directions, max_distance=numpy.inf):
+        """
+        First sphere hit by each ray, as (indices, distances) arrays, with index -1
+        and infinite distance for rays that hit nothing within max_distance.
+        origins and directions have shape (3,) for one ray or (ray_count, 3).
+        """
+        origins = numpy.asarray(origins, dtype=numpy.float64).reshape(-1, 3)
+        directions = numpy.asarray(directions, dtype=numpy.float64).reshape(-1, 3)
+        directions = directions / numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+        indices = numpy.full(len(origins), -1, dtype=numpy.int64)
+        distances = numpy.full(len(origins), numpy.inf)
+        if len(self.grid.order) == 0:
+            return indices, distances
+        for r, (origin, direction) in enumerate(zip(origins, directions)):
+            position, distances[r] = self._pick_one(origin, direction, max_distance)
+            if position >= 0:
+                indices[r] = self.grid.order[position]
+        return indices, distances
+
+    def _pick_one(self, origin, direction, max_distance):
+        grid = self.grid
+        # descend the hierarchy to the intersected grid cells
+        cell_count = len(grid.cell_start)
+        node_count = len(self.levels[-1][0]) if self.levels else cell_count
+        nodes = numpy.arange(node_count)
+        for level in range(len(self.levels), -1, -1):
+            if level == 0:
+                box_min, box_max = grid.box_min, grid.box_max
+            else:
+                box_min, box_max = self.levels[level - 1]
+            t_enter, t_exit = ray_box_intervals(origin, direction, box_min[nodes], box_max[nodes])
+            t_enter = numpy.maximum(t_enter, 0)
+            hit = (t_exit >= t_enter) & (t_enter <= max_distance)
+            nodes = nodes[hit]
+            if level > 0:
+                child_count = cell_count if level == 1 else len(self.levels[level - 2][0])
+                nodes = (nodes[:, numpy.newaxis] * self.branching + numpy.arange(self.branching)).ravel()
+                nodes = nodes[nodes < child_count]
+        t_enter = t_enter[hit]
+        by_distance = numpy.argsort(t_enter, kind='stable')
+        cells = nodes[by_distance]
+        t_enter = t_enter[by_distance]
+        best_distance = max_distance
+        best_position = -1
+        begin = 0
+        batch = 4
+        while begin < len(cells):
+            if t_enter[begin] > best_distance:
+                break  # every remaining cell is farther than the current hit
+            batch_cells = cells[begin:begin + batch]
+            counts = grid.cell_count[batch_cells]
+            offsets = numpy.repeat(grid.cell_start[batch_cells] - numpy.cumsum(counts) + counts, counts)
+            positions = offsets + numpy.arange(counts.sum())
+            t = ray_sphere_distances(origin, direction,
+                                     self._sorted_centers[positions], self._sorted_radii[positions])
+            k = numpy.argmin(t)
+            if t[k] < best_distance:
+                best_distance = t[k]
+                best_position = positions[k]
+            begin += batch
+            batch *= 2
+        if best_position < 0:
+            return -1, numpy.inf
+        return best_position, best_distance
+
+
+def controller_rays(device_matrices):
+    """
+    Pointing rays from 3x4 device-to-tracking pose matrices, such as the
+    mDeviceToAbsoluteTracking of controller poses (openvr.HmdMatrix34_t, or arrays);
+    controllers point along their -Z axis.
+    Returns (origins, directions), each of shape (device_count, 3).
+    """
+    m = numpy.array([numpy.asarray(getattr(d, 'm', d), dtype=numpy.float64).reshape(3, 4) for d in device_matrices])
+    m = m.reshape(-1, 3, 4)
+    return m[:, :, 3], -m[:, :, 2]
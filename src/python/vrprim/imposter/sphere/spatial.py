@@ -0,0 +1,205 @@
+"""
+Uniform grid spatial index over sphere centers, for view frustum culling.
+
+Spheres are sorted by grid cell, in Morton (Z-curve) order, so each occupied
+cell is one contiguous range of the sphere vertex buffer, and neighboring
+visible cells usually merge into longer ranges.
+"""
+
+import numpy
+
+
+def _spread_bits(v):
+    "Insert two zero bits between each of the low 10 bits of integer array v"
+    v = v.astype(numpy.uint32) & 0x3ff
+    v = (v | (v << 16)) & 0x030000ff
+    v = (v | (v << 8)) & 0x0300f00f
+    v = (v | (v << 4)) & 0x030c30c3
+    v = (v | (v << 2)) & 0x09249249
+    return v
+
+
+def morton_code(ijk):
+    """
+    Z-order curve index of integer grid coordinates, up to 1024 cells per axis
+
+    >>> morton_code(numpy.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 1]])).tolist()
+    [0, 1, 2, 7]
+    """
+    return _spread_bits(ijk[:, 0]) | (_spread_bits(ijk[:, 1]) << 1) | (_spread_bits(ijk[:, 2]) << 2)
+
+
+def frustum_planes(view_projection):
+    """
+    Six inward-facing clip planes (a, b, c, d), from a combined model-view-projection
+    matrix in this package's row-vector layout (clip = xyzw * matrix)
+    """
+    m = numpy.asarray(view_projection, dtype=numpy.float64)
+    planes = numpy.array([
+        m[:, 3] + m[:, 0],  # left
+        m[:, 3] - m[:, 0],  # right
+        m[:, 3] + m[:, 1],  # bottom
+        m[:, 3] - m[:, 1],  # top
+        m[:, 3] + m[:, 2],  # near
+        m[:, 3] - m[:, 2],  # far
+    ])
+    return planes / numpy.linalg.norm(planes[:, 0:3], axis=1)[:, numpy.newaxis]
+
+
+def boxes_in_frustum(box_min, box_max, planes):
+    "Boolean mask of axis-aligned boxes not entirely outside any plane"
+    center = 0.5 * (box_min + box_max)
+    half = 0.5 * (box_max - box_min)
+    # signed distance of each box's most-inside corner, for each plane
+    dist = center.dot(planes[:, 0:3].T) + planes[:, 3] + half.dot(numpy.abs(planes[:, 0:3]).T)
+    return numpy.all(dist >= 0, axis=1)
+
+
+class StereoCullViews(object):
+    """
+    Model-view-projection matrices of every eye of a frame, derived from the model-view
+    matrix of its first eye, for culling once per frame against all of them.
+    eye_views are the fixed head-to-eye view matrices, and projections the per-eye projections,
+    in this package's row-vector layout; see from_renderer().
+    """
+    def __init__(self, eye_views, projections):
+        self.eye_views = [numpy.asarray(v, dtype=numpy.float64) for v in eye_views]
+        self.projections = [numpy.asarray(p, dtype=numpy.float64) for p in projections]
+        self._first_eye_inverse = numpy.linalg.inv(self.eye_views[0])
+
+    @classmethod
+    def from_renderer(cls, renderer):
+        "Eye matrices of an openvr.gl_renderer.OpenVrGlRenderer, after its init_gl(); it draws the left eye first"
+        return cls([renderer.view_left, renderer.view_right],
+                   [renderer.projection_left, renderer.projection_right])
+
+    def __len__(self):
+        return len(self.eye_views)
+
+    def view_projections(self, first_model_view):
+        "Model-view-projection matrix of each eye, given the model-view matrix of the first eye"
+        head = numpy.dot(numpy.asarray(first_model_view, dtype=numpy.float64), self._first_eye_inverse)
+        return [head.dot(v).dot(p) for v, p in zip(self.eye_views, self.projections)]
+
+
+def frame_view_projections(cull_views, model_view, projection):
+    """
+    Model-view-projection matrices to cull against, in the first display_gl() call of a frame.
+    cull_views is None, for the current view only, a StereoCullViews, or a list of fixed matrices.
+    """
+    if cull_views is None:
+        return [numpy.dot(model_view, projection), ]
+    if isinstance(cull_views, StereoCullViews):
+        return cull_views.view_projections(model_view)
+    return cull_views
+
+
+def use_stereo_culling(renderer):
+    """
+    Make the actors of an openvr.gl_renderer.OpenVrGlRenderer that have a set_cull_views()
+    method cull once per frame against both eyes. Call after renderer.init_gl().
+    """
+    views = StereoCullViews.from_renderer(renderer)
+    for actor in renderer:
+        if hasattr(actor, 'set_cull_views'):
+            actor.set_cull_views(views)
+    return views
+
+
+def cell_ranges(cells, cell_start, cell_count):
+    """
+    (first, count) int32 arrays of contiguous buffer ranges covering the given sorted cell indices,
+    merging runs of adjacent cells
+    """
+    if len(cells) == 0:
+        return numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32)
+    breaks = numpy.flatnonzero(numpy.diff(cells) != 1) + 1
+    run_first = cells[numpy.r_[0, breaks]]
+    run_last = cells[numpy.r_[breaks - 1, len(cells) - 1]]
+    first = cell_start[run_first]
+    count = cell_start[run_last] + cell_count[run_last] - first
+    return first.astype(numpy.int32), count.astype(numpy.int32)
+
+
+class SphereGrid(object):
+    """
+    Loose uniform grid over a set of spheres.
+    After construction, "order" is the permutation that sorts the spheres by cell;
+    the sphere vertex buffer must be stored in that order.
+    Cell bounding boxes grow as spheres move (see update()), so culling
+    stays conservative without reordering the buffer, until needs_rebuild.
+    """
+    def __init__(self, centers, radii, spheres_per_cell=512, rebuild_fraction=0.25):
+        centers = numpy.asarray(centers, dtype=numpy.float32).reshape(-1, 3)
+        radii = numpy.broadcast_to(numpy.asarray(radii, dtype=numpy.float32), (len(centers),))
+        self.sphere_count = len(centers)
+        self.rebuild_fraction = rebuild_fraction
+        # spheres that have left their original cell, in sorted order
+        self.displaced = numpy.zeros(self.sphere_count, dtype=bool)
+        if self.sphere_count == 0:
+            self.order = numpy.zeros(0, dtype=numpy.int64)
+            self.cell_code = numpy.zeros(0, dtype=numpy.uint32)
+            self.cell_start = numpy.zeros(0, dtype=numpy.int32)
+            self.cell_count = numpy.zeros(0, dtype=numpy.int32)
+            self.box_min = numpy.zeros((0, 3), dtype=numpy.float32)
+            self.box_max = numpy.zeros((0, 3), dtype=numpy.float32)
+            self.sphere_cell = numpy.zeros(0, dtype=numpy.int32)
+            return
+        # Choose roughly cubical cells holding spheres_per_cell spheres on average
+        lo = centers.min(axis=0)
+        extent = numpy.maximum(centers.max(axis=0) - lo, 1e-6)
+        cell_count = max(1.0, self.sphere_count / float(spheres_per_cell))
+        cell_size = (numpy.prod(extent) / cell_count) ** (1.0 / 3.0)
+        self.dims = numpy.clip(numpy.ceil(extent / cell_size), 1, 1024).astype(numpy.int64)
+        self.origin = lo
+        self.cell_size = extent / self.dims
+        ijk = self._cell_coordinates(centers)
+        codes = morton_code(ijk)
+        self.order = numpy.argsort(codes, kind='stable')
+        sorted_codes = codes[self.order]
+        # Occupied cells, as contiguous ranges in sorted sphere order
+        starts = numpy.flatnonzero(numpy.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        self.cell_code = sorted_codes[starts]
+        self.cell_start = starts.astype(numpy.int32)
+        self.cell_count = numpy.diff(numpy.r_[starts, self.sphere_count]).astype(numpy.int32)
+        self.sphere_cell = numpy.repeat(numpy.arange(len(starts), dtype=numpy.int32), self.cell_count)
+        # Tight bounds of the spheres in each cell
+        c = centers[self.order]
+        r = radii[self.order][:, numpy.newaxis]
+        self.box_min = numpy.minimum.reduceat(c - r, starts, axis=0)
+        self.box_max = numpy.maximum.reduceat(c + r, starts, axis=0)
+
+    def _cell_coordinates(self, centers):
+        ijk = numpy.floor((centers - self.origin) / self.cell_size).astype(numpy.int64)
+        return numpy.clip(ijk, 0, self.dims - 1)
+
+    @property
+    def needs_rebuild(self):
+        return numpy.count_nonzero(self.displaced) > self.rebuild_fraction * self.sphere_count
+
+    def update(self, positions, centers, radii):
+        """
+        Account for spheres that moved. positions are indices into the sorted sphere order.
+        Cell bounds only grow, so a rebuild is eventually needed; see needs_rebuild.
+        """
+        positions = numpy.asarray(positions)
+        centers = numpy.asarray(centers, dtype=numpy.float32).reshape(-1, 3)
+        r = numpy.broadcast_to(numpy.asarray(radii, dtype=numpy.float32), (len(centers),))[:, numpy.newaxis]
+        cells = self.sphere_cell[positions]
+        numpy.minimum.at(self.box_min, cells, centers - r)
+        numpy.maximum.at(self.box_max, cells, centers + r)
+        self.displaced[positions] = morton_code(self._cell_coordinates(centers)) != self.cell_code[cells]
+
+    def visible_cells(self, view_projections):
+        "Mask of cells visible in any of the given model-view-projection matrices"
+        visible = numpy.zeros(len(self.cell_start), dtype=bool)
+        for vp in view_projections:
+            visible |= boxes_in_frustum(self.box_min, self.box_max, frustum_planes(vp))
+        return visible
+
+    def visible_ranges(self, view_projections):
+        """
+        (first, count) int32 arrays of contiguous visible sphere ranges, suitable for glMultiDrawArrays
+        """
+        cells = numpy.flatnonzero(self.visible_cells(view_projections))
+        return cell_ranges(cells, self.cell_start, self.cell_count)
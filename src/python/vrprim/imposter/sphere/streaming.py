@@ -0,0 +1,112 @@
+"""
+Persistently mapped, multiply buffered vertex storage for per-frame updates.
+"""
+
+import ctypes
+import time
+
+import numpy
+from OpenGL import GL
+
+
+class PersistentRingBuffer(object):
+    """
+    One OpenGL buffer holding region_count copies of a numpy array, mapped once
+    for writing, for the lifetime of the buffer.
+    Each call to write() fills the next region and makes it current, while the GPU may
+    still be reading from the previous regions. Fence objects prevent overwriting
+    a region before the GPU has finished drawing from it.
+    "data" is the CPU master copy; callers modify it, then call write() with the dirty range.
+    """
+    def __init__(self, data, region_count=3):
+        self.data = data
+        self.region_count = region_count
+        self.buffer = None
+        self.mapped = None
+        self.current = 0
+        self._fences = [None, ] * region_count
+        # range of elements each region is missing, as [begin, end) or None
+        self._stale = [None, ] * region_count
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        self.stall_seconds = 0.0
+
+    def init_gl(self):
+        "Create, map, and initialize the buffer. Leaves it bound to GL_ARRAY_BUFFER."
+        total_bytes = self.data.nbytes * self.region_count
+        flags = GL.GL_MAP_WRITE_BIT | GL.GL_MAP_PERSISTENT_BIT | GL.GL_MAP_COHERENT_BIT
+        self.buffer = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffer)
+        GL.glBufferStorage(GL.GL_ARRAY_BUFFER, total_bytes, None, flags)
+        pointer = GL.glMapBufferRange(GL.GL_ARRAY_BUFFER, 0, total_bytes, flags)
+        address = ctypes.cast(pointer, ctypes.c_void_p).value
+        raw = (ctypes.c_ubyte * total_bytes).from_address(address)
+        self.mapped = numpy.frombuffer(raw, dtype=self.data.dtype).reshape(self.region_count, len(self.data))
+        self.mapped[:] = self.data
+
+    @property
+    def first_element(self):
+        "Offset, in elements, of the region the GPU should draw from"
+        return self.current * len(self.data)
+
+    def gpu_bytes(self):
+        return self.data.nbytes * self.region_count
+
+    def write(self, begin, end):
+        """
+        Copy elements [begin, end) of the master copy into the next region, and make that region current.
+        """
+        # Everything drawn so far used the current region
+        self._fences[self.current] = GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        region = (self.current + 1) % self.region_count
+        self._wait_for(region)
+        t0 = time.time()
+        for r in range(self.region_count):
+            if r != region:
+                self._stale[r] = self._union(self._stale[r], (begin, end))
+        b, e = self._union(self._stale[region], (begin, end))
+        self.mapped[region, b:e] = self.data[b:e]
+        self._stale[region] = None
+        self.write_seconds += time.time() - t0
+        self.bytes_written += (e - b) * self.data.dtype.itemsize
+        self.current = region
+
+    def update_bandwidth(self):
+        "Sustained bytes per second copied into the mapped buffer, excluding fence stalls"
+        if self.write_seconds <= 0:
+            return 0.0
+        return self.bytes_written / self.write_seconds
+
+    def dispose_gl(self):
+        for fence in self._fences:
+            if fence is not None:
+                GL.glDeleteSync(fence)
+        self._fences = [None, ] * self.region_count
+        if self.buffer is not None:
+            self.mapped = None
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffer)
+            GL.glUnmapBuffer(GL.GL_ARRAY_BUFFER)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+            GL.glDeleteBuffers(1, [self.buffer, ])
+            self.buffer = None
+
+    def _wait_for(self, region):
+        fence = self._fences[region]
+        if fence is None:
+            return
+        t0 = time.time()
+        while True:
+            result = GL.glClientWaitSync(fence, GL.GL_SYNC_FLUSH_COMMANDS_BIT, 1000000)  # 1 ms
+            if result in (GL.GL_ALREADY_SIGNALED, GL.GL_CONDITION_SATISFIED):
+                break
+            if result == GL.GL_WAIT_FAILED:
+                raise RuntimeError("glClientWaitSync failed")
+        self.stall_seconds += time.time() - t0
+        GL.glDeleteSync(fence)
+        self._fences[region] = None
+
+    @staticmethod
+    def _union(range1, range2):
+        if range1 is None:
+            return range2
+        return min(range1[0], range2[0]), max(range1[1], range2[1])
@@ -0,0 +1,208 @@
+"""
+Playback of large particle trajectories from a compact, memory-mapped binary file.
+
+File layout: a 64-byte header (TRAJECTORY_HEADER), followed by frame_count frames,
+each holding sphere_count xyz positions, either as float32 or as int16 values
+quantized as position = origin + scale * value. Quantized positions are accurate
+to within half of scale, per axis.
+
+Usage: python -m vrprim.imposter.sphere.trajectory input.xyz|input.pdb output.traj [--quantize]
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import numpy
+
+
+TRAJECTORY_MAGIC = b'VRTRAJ01'
+HEADER_BYTES = 64
+ENCODING_FLOAT32 = 0
+ENCODING_INT16 = 1
+TRAJECTORY_HEADER = numpy.dtype([
+    ('magic', 'S8'),
+    ('sphere_count', '<u4'),
+    ('frame_count', '<u4'),
+    ('encoding', '<u4'),
+    ('reserved', '<u4'),
+    ('origin', '<f4', 3),
+    ('scale', '<f4', 3),
+])
+
+
+class TrajectoryFile(object):
+    """
+    Read-only, memory-mapped trajectory. Frames are paged in from disk only when read.
+    """
+    def __init__(self, path):
+        header = numpy.fromfile(path, dtype=TRAJECTORY_HEADER, count=1)[0]
+        if header['magic'] != TRAJECTORY_MAGIC:
+            raise ValueError("%s is not a trajectory file" % path)
+        self.sphere_count = int(header['sphere_count'])
+        self.frame_count = int(header['frame_count'])
+        self.encoding = int(header['encoding'])
+        self.origin = header['origin'].copy()
+        self.scale = header['scale'].copy()
+        dtype = '<i2' if self.encoding == ENCODING_INT16 else '<f4'
+        self.frames = numpy.memmap(path, dtype=dtype, mode='r', offset=HEADER_BYTES,
+                                   shape=(self.frame_count, self.sphere_count, 3))
+
+    def __len__(self):
+        return self.frame_count
+
+    def frame(self, index):
+        "Sphere centers at one frame, as a new float32 array of shape (sphere_count, 3)"
+        data = self.frames[index]
+        if self.encoding == ENCODING_INT16:
+            return self.origin + self.scale * data.astype(numpy.float32)
+        return numpy.array(data, dtype=numpy.float32)
+
+
+def write_trajectory(path, frames, sphere_count, quantize=False, bounds=None):
+    """
+    Write an iterable of (sphere_count, 3) position arrays to a trajectory file.
+    Quantized files need the (min_xyz, max_xyz) bounds of all frames in advance.
+    Returns the number of frames written.
+    """
+    header = numpy.zeros(1, dtype=TRAJECTORY_HEADER)
+    header['magic'] = TRAJECTORY_MAGIC
+    header['sphere_count'] = sphere_count
+    header['encoding'] = ENCODING_FLOAT32
+    header['scale'] = 1.0
+    if quantize:
+        lo, hi = [numpy.asarray(b, dtype=numpy.float64) for b in bounds]
+        origin = 0.5 * (lo + hi)
+        scale = numpy.maximum(0.5 * (hi - lo) / 32767.0, 1e-30)
+        header['encoding'] = ENCODING_INT16
+        header['origin'] = origin
+        header['scale'] = scale
+    frame_count = 0
+    with open(path, 'wb') as fh:
+        fh.write(b'\0' * HEADER_BYTES)  # header is written last, once the frame count is known
+        for xyz in frames:
+            xyz = numpy.asarray(xyz, dtype=numpy.float64).reshape(sphere_count, 3)
+            if quantize:
+                q = numpy.clip(numpy.rint((xyz - origin) / scale), -32767, 32767)
+                fh.write(q.astype('<i2').tobytes())
+            else:
+                fh.write(xyz.astype('<f4').tobytes())
+            frame_count += 1
+        header['frame_count'] = frame_count
+        fh.seek(0)
+        fh.write(header.tobytes())
+    return frame_count
+
+
+def read_xyz_frames(path):
+    "Generate (atom_count, 3) position arrays from a multi-frame XYZ file"
+    with open(path) as fh:
+        while True:
+            line = fh.readline()
+            if not line.strip():
+                return
+            atom_count = int(line)
+            fh.readline()  # comment line
+            text = [fh.readline().split()[1:4] for _ in range(atom_count)]
+            yield numpy.array(text, dtype=numpy.float64)
+
+
+def read_pdb_frames(path):
+    "Generate (atom_count, 3) position arrays from the MODEL records of a PDB file"
+    coords = []
+    with open(path) as fh:
+        for line in fh:
+            record = line[0:6]
+            if record in ('ATOM  ', 'HETATM'):
+                coords.append((line[30:38], line[38:46], line[46:54]))
+            elif record == 'ENDMDL' and coords:
+                yield numpy.array(coords, dtype=numpy.float64)
+                coords = []
+    if coords:  # single model without MODEL/ENDMDL records
+        yield numpy.array(coords, dtype=numpy.float64)
+
+
+def convert_to_trajectory(src_path, dst_path, quantize=False):
+    "Convert an XYZ or PDB text trajectory into the binary trajectory format"
+    reader = read_pdb_frames if src_path.lower().endswith(('.pdb', '.ent')) else read_xyz_frames
+    first = next(reader(src_path))
+    bounds = None
+    if quantize:  # first pass: bounds of all frames
+        lo = first.min(axis=0)
+        hi = first.max(axis=0)
+        for xyz in reader(src_path):
+            lo = numpy.minimum(lo, xyz.min(axis=0))
+            hi = numpy.maximum(hi, xyz.max(axis=0))
+        bounds = (lo, hi)
+    return write_trajectory(dst_path, reader(src_path), len(first), quantize=quantize, bounds=bounds)
+
+
+class TrajectoryPlayer(object):
+    """
+    Plays a TrajectoryFile into a dynamic SphereActor, at a fixed frame rate.
+    Upcoming frames are read and decoded on a background thread, so update()
+    only has to copy a ready array into the actor's mapped buffer.
+    """
+    def __init__(self, trajectory, sphere_actor, frames_per_second=30.0, prefetch_count=8, loop=True):
+        self.trajectory = trajectory
+        self.actor = sphere_actor
+        self.frames_per_second = frames_per_second
+        self.prefetch_count = prefetch_count
+        self.loop = loop
+        self.start_time = None
+        self.current_frame = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._prefetched = OrderedDict()  # frame index -> Future
+
+    def start(self, now=None):
+        self.start_time = time.time() if now is None else now
+        self.current_frame = None
+
+    def _frame_index(self, now):
+        index = int((now - self.start_time) * self.frames_per_second)
+        if self.loop:
+            return index % len(self.trajectory)
+        return min(index, len(self.trajectory) - 1)
+
+    def _prefetch(self, index):
+        "Queue reads of the frames following index, and forget frames already passed"
+        if self.loop:
+            wanted = [(index + i) % len(self.trajectory) for i in range(self.prefetch_count + 1)]
+        else:
+            wanted = list(range(index, min(index + self.prefetch_count + 1, len(self.trajectory))))
+        for stale in [k for k in self._prefetched if k not in wanted]:
+            self._prefetched.pop(stale).cancel()
+        for k in wanted:
+            if k not in self._prefetched:
+                self._prefetched[k] = self._executor.submit(self.trajectory.frame, k)
+
+    def update(self, now=None):
+        """
+        Show the frame for the current time. Call once per rendered frame, on the OpenGL thread.
+        Never waits for the disk: the previous frame stays on screen until the new one has been read.
+        Returns the index of the frame shown, or None before the first frame is ready.
+        """
+        if self.start_time is None:
+            self.start(now)
+        index = self._frame_index(time.time() if now is None else now)
+        if index != self.current_frame:
+            self._prefetch(index)
+            future = self._prefetched[index]
+            if future.done():
+                self.actor.update_spheres(centers=future.result())
+                self.current_frame = index
+        return self.current_frame
+
+    def close(self):
+        for future in self._prefetched.values():
+            future.cancel()
+        self._prefetched.clear()
+        self._executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    frame_count = convert_to_trajectory(args[0], args[1], quantize='--quantize' in sys.argv)
+    print("wrote %d frames to %s" % (frame_count, args[1]))
@@ -0,0 +1,245 @@
+"""
+Static batching of many different meshes into shared vertex and index arenas,
+drawn with a single glMultiDrawElementsIndirect call.
+Each mesh becomes one indirect draw command; its model and normal matrices are
+read in the vertex shader from a shader storage buffer, indexed by gl_DrawIDARB.
+"""
+
+import ctypes
+
+import numpy
+from OpenGL import GL
+from OpenGL.GL.shaders import compileShader, compileProgram
+
+from openvr.glframework import shader_string
+from openvr.glframework.glmatrix import identity, pack
+from vrprim.gpu_memory import gpu_memory_manager
+from vrprim.mesh.culling import enclosing_bounds, transform_boxes
+from vrprim.mesh.instanced import instance_array
+from vrprim.mesh.mesh_build import VERTEX_FLOATS, index_dtype
+from vrprim.mesh.teapot import ObjActor
+
+
+# DrawElementsIndirectCommand
+DRAW_COMMAND_DTYPE = numpy.dtype([
+    ('count', '<u4'),
+    ('instance_count', '<u4'),
+    ('first_index', '<u4'),
+    ('base_vertex', '<i4'),
+    ('base_instance', '<u4'),
+])
+
+# std430 DrawTransform; the normal matrix is padded to a mat4
+DRAW_TRANSFORM_DTYPE = numpy.dtype([
+    ('model', numpy.float32, (4, 4)),
+    ('normal', numpy.float32, (4, 4)),
+])
+
+
+def draw_transforms(model_matrices):
+    "DRAW_TRANSFORM_DTYPE record for each 4x4 model matrix"
+    instances = instance_array(model_matrices)
+    result = numpy.zeros(len(instances), dtype=DRAW_TRANSFORM_DTYPE)
+    result['model'] = instances['model']
+    result['normal'][:, 0:3, 0:3] = instances['normal']
+    result['normal'][:, 3, 3] = 1
+    return result
+
+
+class StaticMeshBatch(object):
+    """
+    Collects static meshes with add_mesh() or add_obj_actor(), then draws them all at once.
+    Meshes keep their own index numbering; the draw commands supply each one's base vertex.
+    Geometry is fixed after init_gl(), but set_model_matrix() may still move any mesh.
+    """
+    vertex_shader_source = shader_string("""
+        #extension GL_ARB_shader_draw_parameters : require
+
+        layout(location = 0) in vec3 in_Position;
+        layout(location = 1) in vec3 in_Normal;
+
+        layout(location = 0) uniform mat4 projection = mat4(1);
+        layout(location = 1) uniform mat4 model_view = mat4(1);
+        layout(location = 2) uniform mat3 normal_view = mat3(1);
+
+        struct DrawTransform {
+            mat4 model;
+            mat4 normal;
+        };
+
+        layout(std430, binding = 0) readonly buffer DrawTransforms {
+            DrawTransform draws[];
+        };
+
+        out vec3 normal;
+
+        void main()
+        {
+            DrawTransform draw = draws[gl_DrawIDARB];
+            gl_Position = projection * model_view * draw.model * vec4(in_Position, 1.0);
+            normal = normalize(normal_view * (mat3(draw.normal) * in_Normal));
+        }
+        """)
+    fragment_shader_source = ObjActor.fragment_shader_source
+    transform_binding = 0
+
+    def __init__(self):
+        self.model_matrix = identity()
+        self._meshes = []
+        self._model_matrices = []
+        self._boxes = []  # model space (minimum, maximum) of each mesh, kept for culling
+        self.vertices = None
+        self.indices = None
+        self.commands = None
+        self.transforms = None
+        self.vao = None
+        self.shader = None
+        self.buffers = None
+        self.index_type = None
+        self._gpu_bytes = 0
+        self._transforms_changed = False
+
+    @property
+    def draw_count(self):
+        return len(self._model_matrices)
+
+    def add_mesh(self, vertices, indices, model_matrix=None):
+        """
+        Add a mesh, given as a (vertex_count, VERTEX_FLOATS) vertex array and triangle indices.
+        Returns its draw index, for set_model_matrix().
+        """
+        if self.vao is not None:
+            raise RuntimeError("Cannot add meshes to a StaticMeshBatch after init_gl()")
+        vertices = numpy.asarray(vertices, dtype=numpy.float32).reshape(-1, VERTEX_FLOATS)
+        self._meshes.append((vertices, numpy.asarray(indices).ravel()))
+        if len(vertices):
+            self._boxes.append((vertices[:, 0:3].min(axis=0), vertices[:, 0:3].max(axis=0)))
+        else:
+            self._boxes.append((numpy.zeros(3), numpy.zeros(3)))
+        if model_matrix is None:
+            model_matrix = numpy.identity(4)
+        self._model_matrices.append(numpy.asarray(model_matrix, dtype=numpy.float64).reshape(4, 4))
+        self.vertices = None  # arenas need a rebuild
+        return len(self._meshes) - 1
+
+    def add_obj_actor(self, actor):
+        "Add the full detail mesh of a loaded ObjActor that has not been through init_gl(), at its model_matrix"
+        vertices, indices = actor.mesh.level_arrays(0)
+        rows = vertices.view('<f4').reshape(len(vertices), -1)[:, 0:VERTEX_FLOATS]  # without material indices
+        return self.add_mesh(rows, indices, actor.model_matrix)
+
+    def build(self):
+        "Concatenate the meshes into the vertex and index arenas, draw commands and transforms"
+        vertex_counts = numpy.array([len(v) for v, i in self._meshes], dtype=numpy.int64)
+        index_counts = numpy.array([len(i) for v, i in self._meshes], dtype=numpy.int64)
+        self.commands = numpy.zeros(len(self._meshes), dtype=DRAW_COMMAND_DTYPE)
+        self.commands['count'] = index_counts
+        self.commands['instance_count'] = 1
+        self.commands['first_index'] = numpy.cumsum(index_counts) - index_counts
+        self.commands['base_vertex'] = numpy.cumsum(vertex_counts) - vertex_counts
+        if self._meshes:
+            self.vertices = numpy.concatenate([v for v, i in self._meshes])
+            self.indices = numpy.concatenate([i for v, i in self._meshes]).astype(
+                index_dtype(vertex_counts.max()))
+        else:
+            self.vertices = numpy.zeros((0, VERTEX_FLOATS), dtype=numpy.float32)
+            self.indices = numpy.zeros(0, dtype=numpy.uint16)
+        self.transforms = draw_transforms(numpy.reshape(self._model_matrices, (-1, 4, 4)))
+
+    def set_model_matrix(self, draw_index, model_matrix):
+        self._model_matrices[draw_index] = numpy.asarray(model_matrix, dtype=numpy.float64).reshape(4, 4)
+        if self.transforms is not None:
+            self.transforms[draw_index] = draw_transforms(self._model_matrices[draw_index])[0]
+            self._transforms_changed = True
+
+    def init_gl(self):
+        if self.vertices is None:
+            self.build()
+        self.vao = GL.glGenVertexArrays(1)
+        GL.glBindVertexArray(self.vao)
+        # vertex arena, index arena, draw commands, draw transforms
+        self.buffers = GL.glGenBuffers(4)
+        for target, buf, arr in (
+                (GL.GL_ARRAY_BUFFER, self.buffers[0], self.vertices),
+                (GL.GL_ELEMENT_ARRAY_BUFFER, self.buffers[1], self.indices),
+                (GL.GL_DRAW_INDIRECT_BUFFER, self.buffers[2], self.commands.view(numpy.uint8)),
+                (GL.GL_SHADER_STORAGE_BUFFER, self.buffers[3], self.transforms.view(numpy.uint8))):
+            GL.glBindBuffer(target, buf)
+            GL.glBufferData(target, arr.nbytes, arr, GL.GL_STATIC_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[0])
+        float_size = self.vertices.dtype.itemsize
+        stride = VERTEX_FLOATS * float_size
+        GL.glEnableVertexAttribArray(0)  # vertex location
+        GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, False, stride, ctypes.c_void_p(0))
+        GL.glEnableVertexAttribArray(1)  # vertex normal
+        GL.glVertexAttribPointer(1, 3, GL.GL_FLOAT, False, stride, ctypes.c_void_p(3 * float_size))
+        GL.glBindVertexArray(0)
+        GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, 0)
+        GL.glBindBuffer(GL.GL_SHADER_STORAGE_BUFFER, 0)
+        self.index_type = GL.GL_UNSIGNED_SHORT if self.indices.dtype.itemsize == 2 else GL.GL_UNSIGNED_INT
+        vertex_shader = compileShader(self.vertex_shader_source, GL.GL_VERTEX_SHADER)
+        fragment_shader = compileShader(self.fragment_shader_source, GL.GL_FRAGMENT_SHADER)
+        self.shader = compileProgram(vertex_shader, fragment_shader)
+        GL.glEnable(GL.GL_DEPTH_TEST)
+        self._gpu_bytes = (self.vertices.nbytes + self.indices.nbytes
+                           + self.commands.nbytes + self.transforms.nbytes)
+        gpu_memory_manager.register(self)
+        if gpu_memory_manager.release_cpu_copies:
+            self.vertices = self.indices = None
+            self._meshes = []
+
+    def _batch_bounds(self):
+        "((box_min, box_max), (center, radius)) around every mesh at its model matrix, or None when empty"
+        if self.draw_count == 0:
+            return None
+        matrices = numpy.matmul(self._model_matrices, numpy.asarray(self.model_matrix, dtype=numpy.float64))
+        box_min, box_max = transform_boxes([b[0] for b in self._boxes], [b[1] for b in self._boxes], matrices)
+        center = 0.5 * (box_min + box_max)
+        return enclosing_bounds(box_min, box_max, center, numpy.linalg.norm(box_max - center, axis=1))
+
+    def bounding_sphere(self):
+        bounds = self._batch_bounds()
+        return None if bounds is None else bounds[1]
+
+    def bounding_box(self):
+        bounds = self._batch_bounds()
+        return None if bounds is None else bounds[0]
+
+    def gpu_bytes(self):
+        return self._gpu_bytes
+
+    def cpu_bytes(self):
+        total = sum(v.nbytes + i.nbytes for v, i in self._meshes)
+        for arr in (self.vertices, self.indices, self.commands, self.transforms):
+            if arr is not None:
+                total += arr.nbytes
+        return total
+
+    def display_gl(self, model_view, projection):
+        if self.draw_count == 0:
+            return
+        GL.glBindVertexArray(self.vao)
+        GL.glUseProgram(self.shader)
+        GL.glBindBufferBase(GL.GL_SHADER_STORAGE_BUFFER, self.transform_binding, self.buffers[3])
+        if self._transforms_changed:
+            GL.glBufferSubData(GL.GL_SHADER_STORAGE_BUFFER, 0, self.transforms.nbytes,
+                               self.transforms.view(numpy.uint8))
+            self._transforms_changed = False
+        m = numpy.asarray(self.model_matrix * model_view)
+        normal_view = numpy.linalg.inv(m[0:3, 0:3]).T
+        GL.glUniformMatrix4fv(0, 1, False, pack(projection))
+        GL.glUniformMatrix4fv(1, 1, False, pack(m))
+        GL.glUniformMatrix3fv(2, 1, False, pack(normal_view))
+        GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, self.buffers[2])
+        GL.glMultiDrawElementsIndirect(GL.GL_TRIANGLES, self.index_type, None, self.draw_count, 0)
+        GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, 0)
+
+    def dispose_gl(self):
+        if self.vao:
+            gpu_memory_manager.unregister(self)
+            GL.glDeleteVertexArrays(1, [self.vao, ])
+            GL.glDeleteBuffers(4, self.buffers)
+            GL.glDeleteProgram(self.shader)
+            self.vao = None
+            self.buffers = None
+            self._gpu_bytes = 0
@@ -0,0 +1,259 @@
+"""
+View frustum and occlusion culling of mesh actors, before their draw calls are issued.
+
+Actors report a world space bounding sphere and axis-aligned box, made from the bounds
+stored with their levels of detail (see mesh_build.MESH_LEVEL_DTYPE). A CullingGroup
+tests all of them at once. By default it culls in every display_gl() call, against that
+call's view only. To test once per frame against the frustums of both eyes, so an actor
+seen by either eye is drawn in both, pass it the renderer's eyes after init_gl():
+
+    group = CullingGroup(actors)
+    renderer = OpenVrGlRenderer([group, ])
+    with GlfwApp(renderer, "culled meshes") as app:
+        use_stereo_culling(renderer)  # calls group.set_cull_views(StereoCullViews.from_renderer(renderer))
+        while not glfw.window_should_close(app.window):
+            app.render_scene()
+
+(use_stereo_culling and StereoCullViews are in vrprim.imposter.sphere.spatial.)
+With occlusion queries, an actor that produced no samples in the previous frame
+only rasterizes its bounding box, without color or depth writes, until the box
+shows again.
+"""
+
+import numpy
+from OpenGL import GL
+from OpenGL.GL.shaders import compileShader, compileProgram
+
+from openvr.glframework import shader_string
+from openvr.glframework.glmatrix import pack
+from vrprim.imposter.sphere.spatial import boxes_in_frustum, frame_view_projections, frustum_planes
+
+
+def _affine_matrices(matrices):
+    return numpy.asarray(matrices, dtype=numpy.float64).reshape(-1, 4, 4)
+
+
+def transform_boxes(box_min, box_max, matrices):
+    """
+    (box_min, box_max) arrays of shape (N, 3), bounding axis-aligned boxes after affine
+    transforms, in this package's row-vector layout (world = xyzw * matrix)
+    """
+    m = _affine_matrices(matrices)
+    box_min = numpy.asarray(box_min, dtype=numpy.float64).reshape(-1, 3)
+    box_max = numpy.asarray(box_max, dtype=numpy.float64).reshape(-1, 3)
+    center = numpy.einsum('ni,nij->nj', 0.5 * (box_min + box_max), m[:, 0:3, 0:3]) + m[:, 3, 0:3]
+    half = numpy.einsum('ni,nij->nj', 0.5 * (box_max - box_min), numpy.abs(m[:, 0:3, 0:3]))
+    return center - half, center + half
+
+
+def transform_spheres(centers, radii, matrices):
+    "(centers, radii) of spheres after affine transforms, growing each radius by the largest scale"
+    m = _affine_matrices(matrices)
+    centers = numpy.asarray(centers, dtype=numpy.float64).reshape(-1, 3)
+    centers = numpy.einsum('ni,nij->nj', centers, m[:, 0:3, 0:3]) + m[:, 3, 0:3]
+    scale = numpy.linalg.norm(m[:, 0:3, 0:3], ord=2, axis=(1, 2))
+    return centers, numpy.asarray(radii, dtype=numpy.float64) * scale
+
+
+def enclosing_bounds(box_min, box_max, centers, radii):
+    "((box_min, box_max), (center, radius)) around several boxes and spheres"
+    low, high = box_min.min(axis=0), box_max.max(axis=0)
+    center = 0.5 * (low + high)
+    radius = (numpy.linalg.norm(centers - center, axis=1) + radii).max()
+    # the box corners may be closer than any sphere
+    radius = min(radius, 0.5 * numpy.linalg.norm(high - low))
+    return (low, high), (center, radius)
+
+
+def spheres_in_frustum(centers, radii, planes):
+    "Boolean mask of spheres not entirely outside any plane"
+    dist = centers.dot(planes[:, 0:3].T) + planes[:, 3]
+    return numpy.all(dist >= -radii[:, numpy.newaxis], axis=1)
+
+
+def visible_in_views(centers, radii, box_min, box_max, view_projections):
+    "Mask of bounding volumes, each a sphere and a box, inside the frustum of any view"
+    visible = numpy.zeros(len(centers), dtype=bool)
+    for vp in view_projections:
+        planes = frustum_planes(vp)
+        visible |= spheres_in_frustum(centers, radii, planes) & boxes_in_frustum(box_min, box_max, planes)
+    return visible
+
+
+def near_distance(projection):
+    "Near clip plane distance of a perspective projection matrix, in row-vector layout"
+    p = numpy.asarray(projection, dtype=numpy.float64)
+    return abs(p[3, 2] / (p[2, 2] - 1.0))
+
+
+class CullingGroup(object):
+    """
+    Draws a list of actors, skipping those outside the view frustum and, with
+    occlusion_queries=True, those hidden behind other geometry in the previous frame.
+    Actors without bounding_sphere() and bounding_box() methods, or not yet ready,
+    are always drawn.
+    Culling runs in every display_gl() call, or once per frame after set_cull_views().
+    drawn_count, frustum_culled_count and occlusion_culled_count count the actor draws
+    issued and skipped in the display_gl() calls since the last culling pass, so with
+    set_cull_views() they report whole frames.
+    """
+    box_vertex_shader_source = shader_string("""
+        layout(location = 0) uniform mat4 projection = mat4(1);
+        layout(location = 1) uniform mat4 model_view = mat4(1);
+        layout(location = 2) uniform vec3 box_min = vec3(0);
+        layout(location = 3) uniform vec3 box_max = vec3(1);
+
+        void main()
+        {
+            // unit cube corners of a 14 vertex triangle strip
+            int b = 1 << gl_VertexID;
+            vec3 corner = vec3((0x287a & b) != 0, (0x02af & b) != 0, (0x31e3 & b) != 0);
+            gl_Position = projection * model_view * vec4(mix(box_min, box_max, corner), 1.0);
+        }
+        """)
+    box_fragment_shader_source = shader_string("""
+        void main()
+        {
+        }
+        """)
+
+    def __init__(self, actors=None, occlusion_queries=False):
+        self.actors = list(actors) if actors is not None else []
+        self.occlusion_queries = occlusion_queries
+        self.cull_views = None
+        self.drawn_count = 0
+        self.frustum_culled_count = 0
+        self.occlusion_culled_count = 0
+        self._visible = None
+        self._bounds = None
+        self._call_count = 0  # display_gl() calls since set_cull_views()
+        self._queries = {}  # (actor index, eye) -> query object
+        self._occluded = {}  # (actor index, eye) -> no samples passed last time
+        self.box_program = None
+        self.box_vao = None
+
+    @property
+    def culled_count(self):
+        return self.frustum_culled_count + self.occlusion_culled_count
+
+    def add_actor(self, actor):
+        self.actors.append(actor)
+        if self.box_program is not None:
+            actor.init_gl()
+
+    def set_cull_views(self, view_projections):
+        """
+        Cull once per frame against the union of several views, for example both eyes,
+        instead of separately in each display_gl() call: either a spatial.StereoCullViews,
+        which follows the eyes every frame (see spatial.use_stereo_culling()), or a list of
+        fixed model-view-projection matrices. Each frame then makes one display_gl() call
+        per view, in order. Pass None to restore per-call culling.
+        """
+        self.cull_views = view_projections
+        self._visible = None
+        self._call_count = 0
+
+    def cull(self, view_projections):
+        "Mask of actors to draw, after testing their bounds against the union of the views"
+        count = len(self.actors)
+        centers = numpy.zeros((count, 3))
+        radii = numpy.zeros(count)
+        box_min = numpy.zeros((count, 3))
+        box_max = numpy.zeros((count, 3))
+        bounded = numpy.zeros(count, dtype=bool)
+        for i, actor in enumerate(self.actors):
+            if not getattr(actor, 'ready', True) or not hasattr(actor, 'bounding_box'):
+                continue
+            sphere, box = actor.bounding_sphere(), actor.bounding_box()
+            if sphere is None or box is None:
+                continue
+            centers[i], radii[i] = sphere
+            box_min[i], box_max[i] = box
+            bounded[i] = True
+        visible = ~bounded | visible_in_views(centers, radii, box_min, box_max, view_projections)
+        self._bounds = (centers, radii, box_min, box_max, bounded)
+        return visible
+
+    def init_gl(self):
+        for actor in self.actors:
+            actor.init_gl()
+        vertex_shader = compileShader(self.box_vertex_shader_source, GL.GL_VERTEX_SHADER)
+        fragment_shader = compileShader(self.box_fragment_shader_source, GL.GL_FRAGMENT_SHADER)
+        self.box_program = compileProgram(vertex_shader, fragment_shader)
+        self.box_vao = GL.glGenVertexArrays(1)  # the box shader needs no attributes
+
+    def display_gl(self, model_view, projection):
+        view_count = 1 if self.cull_views is None else len(self.cull_views)
+        eye = self._call_count % view_count
+        self._call_count += 1
+        if eye == 0:  # first view of a frame
+            self._visible = self.cull(frame_view_projections(self.cull_views, model_view, projection))
+            self.drawn_count = self.frustum_culled_count = self.occlusion_culled_count = 0
+        eye_position = numpy.linalg.inv(numpy.asarray(model_view, dtype=numpy.float64))[3, 0:3]
+        centers, radii, box_min, box_max, bounded = self._bounds
+        indices = numpy.flatnonzero(self._visible)
+        self.frustum_culled_count += len(self.actors) - len(indices)
+        # front to back, so near actors occlude far ones early
+        indices = indices[numpy.argsort(numpy.linalg.norm(centers[indices] - eye_position, axis=1))]
+        margin = near_distance(projection) if self.occlusion_queries else 0.0
+        for i in indices:
+            actor = self.actors[i]
+            if not self.occlusion_queries or not bounded[i] or numpy.all(
+                    (eye_position > box_min[i] - margin) & (eye_position < box_max[i] + margin)):
+                # the near plane could clip away the box of an actor around the viewer
+                actor.display_gl(model_view, projection)
+                self.drawn_count += 1
+                continue
+            key = (i, eye)
+            query = self._update_query(key)
+            if query is not None:
+                GL.glBeginQuery(GL.GL_ANY_SAMPLES_PASSED_CONSERVATIVE, query)
+            if self._occluded.get(key, False):
+                self._draw_box(model_view, projection, box_min[i], box_max[i])
+                self.occlusion_culled_count += 1
+            else:
+                actor.display_gl(model_view, projection)
+                self.drawn_count += 1
+            if query is not None:
+                GL.glEndQuery(GL.GL_ANY_SAMPLES_PASSED_CONSERVATIVE)
+
+    def _update_query(self, key):
+        "Query object to issue for an actor, after reading its last result; None while that result is pending"
+        query = self._queries.get(key)
+        if query is None:
+            query = self._queries[key] = GL.glGenQueries(1)
+            return query
+        if not GL.glGetQueryObjectuiv(query, GL.GL_QUERY_RESULT_AVAILABLE):
+            return None
+        self._occluded[key] = not GL.glGetQueryObjectuiv(query, GL.GL_QUERY_RESULT)
+        return query
+
+    def _draw_box(self, model_view, projection, box_min, box_max):
+        GL.glColorMask(False, False, False, False)
+        GL.glDepthMask(False)
+        cull_face = GL.glIsEnabled(GL.GL_CULL_FACE)
+        GL.glDisable(GL.GL_CULL_FACE)
+        GL.glBindVertexArray(self.box_vao)
+        GL.glUseProgram(self.box_program)
+        GL.glUniformMatrix4fv(0, 1, False, pack(projection))
+        GL.glUniformMatrix4fv(1, 1, False, pack(model_view))
+        GL.glUniform3f(2, *box_min)
+        GL.glUniform3f(3, *box_max)
+        GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0, 14)
+        if cull_face:
+            GL.glEnable(GL.GL_CULL_FACE)
+        GL.glDepthMask(True)
+        GL.glColorMask(True, True, True, True)
+
+    def dispose_gl(self):
+        for actor in self.actors:
+            actor.dispose_gl()
+        if self._queries:
+            GL.glDeleteQueries(len(self._queries), list(self._queries.values()))
+            self._queries = {}
+            self._occluded = {}
+        if self.box_vao is not None:
+            GL.glDeleteVertexArrays(1, [self.box_vao, ])
+            GL.glDeleteProgram(self.box_program)
+            self.box_vao = None
+            self.box_program = None
@@ -0,0 +1,132 @@
+"""
+Many copies of one mesh, drawn with a single instanced draw call.
+"""
+
+import numpy
+from OpenGL import GL
+from OpenGL.arrays import vbo
+
+from openvr.glframework import shader_string
+from openvr.glframework.glmatrix import pack
+from vrprim.gpu_memory import gpu_memory_manager
+from vrprim.mesh.culling import enclosing_bounds, transform_boxes, transform_spheres
+from vrprim.mesh.teapot import ObjActor
+
+
+# Per-instance vertex attributes; matrices use the same row-vector convention as ObjActor.model_matrix
+INSTANCE_DTYPE = numpy.dtype([
+    ('model', numpy.float32, (4, 4)),
+    ('normal', numpy.float32, (3, 3)),  # inverse transpose of the model rotation and scale
+])
+
+
+def instance_array(model_matrices):
+    "INSTANCE_DTYPE record for each 4x4 model matrix"
+    model = numpy.asarray(model_matrices, dtype=numpy.float64).reshape(-1, 4, 4)
+    result = numpy.empty(len(model), dtype=INSTANCE_DTYPE)
+    result['model'] = model
+    result['normal'] = numpy.linalg.inv(model[:, 0:3, 0:3]).transpose(0, 2, 1)
+    return result
+
+
+class InstancedObjActor(ObjActor):
+    """
+    Draws one OBJ mesh once for each of an array of model matrices, sharing the
+    mesh buffers and shader program, in one glDrawElementsInstanced call.
+    model_matrix still transforms the whole group.
+    """
+    vertex_shader_source = shader_string("""
+        layout(location = 0) in vec3 in_Position;
+        layout(location = 1) in vec3 in_Normal;
+        layout(location = 2) in mat4 instance_model;  // locations 2-5
+        layout(location = 6) in mat3 instance_normal;  // locations 6-8
+
+        layout(location = 0) uniform mat4 projection = mat4(1);
+        layout(location = 1) uniform mat4 model_view = mat4(1);
+        layout(location = 2) uniform mat3 normal_view = mat3(1);
+
+        out vec3 normal;
+
+        void main()
+        {
+            gl_Position = projection * model_view * instance_model * vec4(in_Position, 1.0);
+            normal = normalize(normal_view * (instance_normal * in_Normal));
+        }
+        """)
+
+    def __init__(self, obj_stream=None, obj_path=None, use_cache=True, model_matrices=None, asynchronous=False):
+        super(InstancedObjActor, self).__init__(obj_stream=obj_stream, obj_path=obj_path, use_cache=use_cache,
+                                                asynchronous=asynchronous)
+        if model_matrices is None:
+            model_matrices = numpy.identity(4)[numpy.newaxis]
+        self.instances = instance_array(model_matrices)
+        self.instance_vbo = vbo.VBO(self.instances.view(numpy.uint8), usage=GL.GL_DYNAMIC_DRAW)
+
+    @property
+    def instance_count(self):
+        return len(self.instances)
+
+    def set_model_matrices(self, model_matrices):
+        "Replace the per-instance model matrices, from an (N, 4, 4) array; uploaded at the next display"
+        self.instances = instance_array(model_matrices)
+        self.instance_vbo.set_array(self.instances.view(numpy.uint8))
+
+    def _init_instance_attributes(self):
+        self.instance_vbo.bind()
+        stride = INSTANCE_DTYPE.itemsize
+        for column in range(4):
+            location = 2 + column
+            GL.glEnableVertexAttribArray(location)
+            GL.glVertexAttribPointer(location, 4, GL.GL_FLOAT, False,
+                                     stride, self.instance_vbo + INSTANCE_DTYPE.fields['model'][1] + 16 * column)
+            GL.glVertexAttribDivisor(location, 1)
+        for column in range(3):
+            location = 6 + column
+            GL.glEnableVertexAttribArray(location)
+            GL.glVertexAttribPointer(location, 3, GL.GL_FLOAT, False,
+                                     stride, self.instance_vbo + INSTANCE_DTYPE.fields['normal'][1] + 12 * column)
+            GL.glVertexAttribDivisor(location, 1)
+
+    def _instance_bounds(self):
+        "((box_min, box_max), (center, radius)) around every instance, or None until loaded"
+        if self.mesh is None or self.instance_count == 0:
+            return None
+        matrices = numpy.matmul(self.instances['model'], numpy.asarray(self.model_matrix, dtype=numpy.float64))
+        box_min, box_max = transform_boxes(self.mesh.bounds[0], self.mesh.bounds[1], matrices)
+        centers, radii = transform_spheres(self.mesh.bounding_center, self.mesh.bounding_radius, matrices)
+        return enclosing_bounds(box_min, box_max, centers, radii)
+
+    def bounding_sphere(self):
+        bounds = self._instance_bounds()
+        return None if bounds is None else bounds[1]
+
+    def bounding_box(self):
+        bounds = self._instance_bounds()
+        return None if bounds is None else bounds[0]
+
+    def gpu_bytes(self):
+        return super(InstancedObjActor, self).gpu_bytes() + self.instance_vbo.size
+
+    def cpu_bytes(self):
+        return super(InstancedObjActor, self).cpu_bytes() + self.instances.nbytes
+
+    def display_gl(self, model_view, projection):
+        if self.vao is None and not self._finish_loading():
+            return
+        GL.glBindVertexArray(self.vao)
+        if not self.instance_vbo.copied:
+            self.instance_vbo.bind()  # uploads matrices changed since the last frame
+            gpu_memory_manager.register(self)
+        GL.glUseProgram(self.shader)
+        m = numpy.asarray(self.model_matrix * model_view)
+        normal_view = numpy.linalg.inv(m[0:3, 0:3]).T
+        GL.glUniformMatrix4fv(0, 1, False, pack(projection))
+        GL.glUniformMatrix4fv(1, 1, False, pack(m))
+        GL.glUniformMatrix3fv(2, 1, False, pack(normal_view))
+        GL.glDrawElementsInstanced(GL.GL_TRIANGLES, self.element_count, self.index_type,
+                                   None, self.instance_count)
+
+    def dispose_gl(self):
+        if self.instance_vbo.buffers:
+            self.instance_vbo.delete()
+        super(InstancedObjActor, self).dispose_gl()
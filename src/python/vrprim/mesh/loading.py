@@ -0,0 +1,148 @@
+"""
+Mesh loading off the rendering thread, and buffer uploads spread over frames.
+
+OBJ parsing, or loading from the binary mesh cache, runs on worker threads.
+Buffer objects are then filled on the OpenGL thread in pieces, with each
+frame's share limited by the shared UploadBudget, so that opening a large
+scene never stalls the headset.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import numpy
+from OpenGL import GL
+
+from vrprim.mesh.material import load_materials
+from vrprim.mesh.mesh_build import MeshBuffers, build_mesh
+from vrprim.mesh.mesh_cache import load_mesh_cache, write_mesh_cache
+from vrprim.mesh.obj_parser import parse_obj
+
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # NumPy and file reads release the GIL for much of the work
+        _executor = ThreadPoolExecutor(max_workers=4)
+    return _executor
+
+
+def load_obj_buffers(obj_stream=None, obj_path=None, use_cache=True, materials=False, max_texture_size=None,
+                     lod=False):
+    """
+    MeshBuffers for an OBJ file, given as an open file or a path.
+    When the path is known, buffers come memory-mapped from a valid binary cache, or else
+    are built from the OBJ text and then cached.
+    Coarser levels of detail are built only with lod=True; cached buffers may hold them anyway.
+    With materials=True, the materials of the OBJ file are loaded too, with their
+    textures decoded (see material.load_materials()).
+    """
+    if obj_path is None and os.path.isfile(str(getattr(obj_stream, 'name', ''))):
+        obj_path = obj_stream.name
+    use_cache = use_cache and obj_path is not None
+    cached = load_mesh_cache(obj_path, lod=lod) if use_cache else None
+    if cached is not None:
+        buffers = MeshBuffers(*cached)
+        buffers.loaded_from_cache = True
+    else:
+        mesh = parse_obj(obj_stream if obj_stream is not None else obj_path)
+        buffers = build_mesh(mesh) if lod else build_mesh(mesh, lod_fractions=())
+        buffers.parse_megabytes_per_second = mesh.megabytes_per_second
+        if use_cache:
+            write_mesh_cache(obj_path, buffers.vertices, buffers.indices, levels=buffers.levels,
+                             material_names=buffers.material_names,
+                             material_libraries=buffers.material_libraries, lod=lod)
+    if materials:
+        folder = os.path.dirname(os.path.abspath(obj_path)) if obj_path is not None else '.'
+        buffers.materials = load_materials(buffers.material_names, buffers.material_libraries,
+                                           folder, max_texture_size)
+    return buffers
+
+
+def load_obj_buffers_async(obj_stream=None, obj_path=None, use_cache=True, materials=False, max_texture_size=None,
+                           lod=False):
+    """
+    Start load_obj_buffers() on a worker thread.
+    Returns a concurrent.futures.Future whose result() is the MeshBuffers.
+    An obj_stream must stay open until then.
+    """
+    return _get_executor().submit(load_obj_buffers, obj_stream, obj_path, use_cache, materials, max_texture_size,
+                                  lod)
+
+
+class UploadBudget(object):
+    """
+    Limits the bytes copied to the GPU per frame, shared by every deferred upload.
+    A token bucket refilled at bytes_per_frame every frame_seconds, so callers
+    need no notice of frame boundaries. Spending may overdraw the bucket once, so that
+    uploads larger than a frame's budget still proceed, delaying the uploads after them.
+    """
+    def __init__(self, bytes_per_frame=8 << 20, frame_seconds=1.0 / 90):
+        self.bytes_per_frame = bytes_per_frame
+        self.frame_seconds = frame_seconds
+        self._available = bytes_per_frame
+        self._time = time.time()
+
+    def available(self):
+        now = time.time()
+        refill = (now - self._time) / self.frame_seconds * self.bytes_per_frame
+        self._available = min(self.bytes_per_frame, self._available + refill)
+        self._time = now
+        return self._available
+
+    def try_spend(self, byte_count):
+        "Whether byte_count may be uploaded now; if so, the bytes are counted against the budget"
+        if self.available() <= 0:
+            return False
+        self._available -= byte_count
+        return True
+
+
+# Shared budget used by all deferred vrprim uploads
+gpu_upload_budget = UploadBudget()
+
+
+class BufferUpload(object):
+    """
+    Fills an OpenGL.arrays.vbo.VBO from its array in pieces, with the OpenGL context current.
+    Afterwards the VBO counts as copied, so bind() will not upload it again.
+    Uploads go through the copy-write binding, leaving vertex array state alone.
+    """
+    def __init__(self, buffer_object, chunk_bytes=1 << 20):
+        self.vbo = buffer_object
+        self.chunk_bytes = chunk_bytes
+        self.offset = 0
+        self._bytes = numpy.ascontiguousarray(buffer_object.data).reshape(-1).view(numpy.uint8)
+
+    @property
+    def done(self):
+        return self.vbo.copied
+
+    def step(self, budget=None):
+        "Upload as much as the budget allows; returns True once the whole buffer is on the GPU"
+        if self.vbo.copied:
+            return True
+        if budget is None:
+            budget = gpu_upload_budget
+        target = GL.GL_COPY_WRITE_BUFFER
+        if not self.vbo.buffers:
+            self.vbo.create_buffers()
+            GL.glBindBuffer(target, self.vbo.buffer)
+            GL.glBufferData(target, len(self._bytes), None, self.vbo.resolve(self.vbo.usage))
+        else:
+            GL.glBindBuffer(target, self.vbo.buffer)
+        while self.offset < len(self._bytes):
+            chunk = self._bytes[self.offset:self.offset + self.chunk_bytes]
+            if not budget.try_spend(len(chunk)):
+                break
+            GL.glBufferSubData(target, self.offset, len(chunk), chunk)
+            self.offset += len(chunk)
+        GL.glBindBuffer(target, 0)
+        if self.offset >= len(self._bytes):
+            self.vbo.copied = True
+            self._bytes = None
+        return self.vbo.copied
@@ -0,0 +1,79 @@
+"""
+Wavefront MTL material libraries, reduced to what the mesh actors draw:
+a diffuse color and an optional diffuse texture ("Kd" and "map_Kd").
+"""
+
+import os
+
+import numpy
+from PIL import Image
+
+
+class Material(object):
+    """
+    Diffuse color, and diffuse texture path, of one named material.
+    image holds the decoded texture, as an RGB numpy array, after load_images().
+    """
+    def __init__(self, name, diffuse=(0.8, 0.8, 0.8), diffuse_texture=None):
+        self.name = name
+        self.diffuse = tuple(diffuse)
+        self.diffuse_texture = diffuse_texture
+        self.image = None
+
+    def load_image(self, max_size=None):
+        "Decode the diffuse texture, reduced to at most max_size pixels per side; missing files leave image None"
+        if self.diffuse_texture is None or not os.path.isfile(self.diffuse_texture):
+            return None
+        img = Image.open(self.diffuse_texture)
+        if max_size is not None:
+            img.thumbnail((max_size, max_size), Image.LANCZOS)  # reduces JPEG images while decoding
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        self.image = numpy.array(img)
+        return self.image
+
+
+def parse_mtl(path):
+    """
+    Dictionary of Material by name, from a MTL file.
+    Texture paths are made absolute, relative to the MTL file.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    materials = {}
+    material = None
+    with open(path, 'rb') as fh:
+        for line in fh:
+            words = line.decode('utf-8', 'replace').split()
+            if len(words) < 2:
+                continue
+            keyword = words[0]
+            if keyword == 'newmtl':
+                name = ' '.join(words[1:])
+                material = materials[name] = Material(name)
+            elif material is None:
+                continue
+            elif keyword == 'Kd' and len(words) >= 4:
+                material.diffuse = tuple(float(x) for x in words[1:4])
+            elif keyword == 'map_Kd':
+                # options such as "-s 1 1 1" come before the file name
+                material.diffuse_texture = os.path.join(folder, words[-1].replace('\\', '/'))
+    return materials
+
+
+def load_materials(material_names, material_libraries, folder='.', max_texture_size=None):
+    """
+    List of Material for each name, looked up in the MTL files listed in material_libraries,
+    relative to folder, with their diffuse textures decoded, at most max_texture_size pixels per side.
+    Names not found in any library get the default material.
+    """
+    library = {}
+    for file_name in material_libraries:
+        path = os.path.join(folder, file_name)
+        if os.path.isfile(path):
+            library.update(parse_mtl(path))
+    result = []
+    for name in material_names:
+        material = library.get(name) or Material(name)
+        material.load_image(max_texture_size)
+        result.append(material)
+    return result
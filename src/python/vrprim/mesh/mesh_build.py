@@ -0,0 +1,276 @@
+"""
+Build stage from parsed OBJ data to indexed triangle buffers ready for upload.
+
+Every triangle corner becomes a (position, normal, texture coordinate) tuple, plus a
+material index in meshes that use materials,
+and identical tuples are welded into one vertex, using a vectorized hash of their bits.
+So split normals, texture seams and material borders survive, while smooth regions
+share vertices.
+Triangles are then reordered with Tipsify (Sander, Nehab and Barczak 2007) for
+post-transform vertex cache locality, and vertices are renumbered in order of
+first use. Indices are 16-bit when the vertex count allows, 32-bit otherwise.
+Coarser levels of detail (see simplify) follow the full mesh in the same buffers.
+
+Usage: python -m vrprim.mesh.mesh_build model.obj
+"""
+
+import time
+
+import numpy
+
+from vrprim.mesh.obj_parser import parse_obj
+
+
+# position xyz, normal xyz, texture coordinate uv
+VERTEX_FLOATS = 8
+# the same, followed by a material index (-1 for none), in meshes that use materials
+MATERIAL_VERTEX_FLOATS = 9
+
+# Range of one level of detail within the vertex and index buffers. Indices of each
+# level count from its first vertex. error is the largest distance, in model units,
+# between the level and the full mesh. The level's axis-aligned bounding box and
+# bounding sphere, in model units, are computed once at build time, for culling.
+MESH_LEVEL_DTYPE = numpy.dtype([
+    ('first_vertex', '<u4'),
+    ('vertex_count', '<u4'),
+    ('first_index', '<u4'),
+    ('index_count', '<u4'),
+    ('error', '<f4'),
+    ('box_min', '<f4', (3,)),
+    ('box_max', '<f4', (3,)),
+    ('sphere_center', '<f4', (3,)),
+    ('sphere_radius', '<f4'),
+])
+
+
+class MeshBuffers(object):
+    """
+    Interleaved float32 vertex array, with shape (vertex_count, VERTEX_FLOATS), or
+    (vertex_count, MATERIAL_VERTEX_FLOATS) when the mesh uses materials, and
+    triangle index array, holding each level of detail listed in levels, finest first,
+    with post-transform cache statistics of the full mesh.
+    ACMR is the average number of vertex shader runs per triangle.
+    Vertex material indices refer to material_names, defined in the material_libraries
+    named by the OBJ file.
+    """
+    def __init__(self, vertices, indices, levels=None, material_names=None, material_libraries=None,
+                 acmr_before=None, acmr_after=None, seconds=0.0):
+        self.vertices = vertices
+        self.indices = indices
+        if levels is None:
+            levels = single_level(len(vertices), len(indices), vertices[:, 0:3])
+        self.levels = levels
+        self.material_names = material_names or []
+        self.material_libraries = material_libraries or []
+        self.acmr_before = acmr_before
+        self.acmr_after = acmr_after
+        self.seconds = seconds
+        # set by loading.load_obj_buffers()
+        self.loaded_from_cache = False
+        self.parse_megabytes_per_second = None
+        self.materials = None  # material.Material list, when loaded with the buffers
+
+
+def corner_attributes(mesh):
+    """
+    Attribute values for every triangle corner of an ObjMesh, with shape (corner_count, VERTEX_FLOATS),
+    or (corner_count, MATERIAL_VERTEX_FLOATS) if the mesh names any materials
+    """
+    positions = mesh.triangle_positions.ravel()
+    width = MATERIAL_VERTEX_FLOATS if mesh.material_names else VERTEX_FLOATS
+    result = numpy.zeros((len(positions), width), dtype=numpy.float32)
+    result[:, 0:3] = mesh.positions[positions]
+    result[:, 3:6] = mesh.vertex_normals()[positions]
+    normals = mesh.triangle_normals.ravel()
+    has_normal = normals >= 0
+    result[has_normal, 3:6] = mesh.normals[normals[has_normal]]
+    texcoords = mesh.triangle_texcoords.ravel()
+    has_texcoord = texcoords >= 0
+    result[has_texcoord, 6:8] = mesh.texcoords[texcoords[has_texcoord]]
+    if width == MATERIAL_VERTEX_FLOATS:
+        result[:, 8] = numpy.repeat(mesh.triangle_materials, 3)
+    return result
+
+
+def weld_vertices(corners):
+    """
+    Merge bitwise-identical rows; returns (unique rows, index of each input row's unique row)
+    """
+    corners = numpy.ascontiguousarray(corners, dtype=numpy.float32) + numpy.float32(0)  # -0.0 to 0.0
+    bits = corners.view(numpy.uint32)
+    # FNV-1a over the 32-bit words of each row
+    key = numpy.full(len(bits), 14695981039346656037, dtype=numpy.uint64)
+    for column in bits.T:
+        key ^= column
+        key *= numpy.uint64(1099511628211)
+    key, first, inverse = numpy.unique(key, return_index=True, return_inverse=True)
+    if not numpy.array_equal(bits[first][inverse], bits):
+        # hash collision; compare whole rows instead
+        rows = bits.view(numpy.dtype((numpy.void, bits.shape[1] * 4))).ravel()
+        key, first, inverse = numpy.unique(rows, return_index=True, return_inverse=True)
+    return corners[first], inverse.ravel()
+
+
+def set_level_bounds(level, positions):
+    "Fill the bounding box and sphere of a MESH_LEVEL_DTYPE record from an (N, 3) position array"
+    positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+    if len(positions) == 0:
+        return
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    center = 0.5 * (low + high)
+    level['box_min'] = low
+    level['box_max'] = high
+    level['sphere_center'] = center
+    # round up, so float32 never puts a vertex outside the sphere
+    level['sphere_radius'] = numpy.nextafter(numpy.float32(
+        numpy.sqrt(((positions - center) ** 2).sum(axis=1).max())), numpy.float32(numpy.inf))
+
+
+def single_level(vertex_count, index_count, positions=None):
+    "MESH_LEVEL_DTYPE table for buffers without coarser levels, bounding the given positions"
+    levels = numpy.zeros(1, dtype=MESH_LEVEL_DTYPE)
+    levels['vertex_count'] = vertex_count
+    levels['index_count'] = index_count
+    if positions is not None:
+        set_level_bounds(levels[0], positions)
+    return levels
+
+
+def concatenate_levels(meshes):
+    """
+    Vertices, indices and MESH_LEVEL_DTYPE table for a list of (vertices, indices, error),
+    finest first
+    """
+    levels = numpy.zeros(len(meshes), dtype=MESH_LEVEL_DTYPE)
+    levels['vertex_count'] = [len(v) for v, i, e in meshes]
+    levels['index_count'] = [len(i) for v, i, e in meshes]
+    levels['first_vertex'] = numpy.cumsum(levels['vertex_count']) - levels['vertex_count']
+    levels['first_index'] = numpy.cumsum(levels['index_count']) - levels['index_count']
+    # coarser levels never claim less error than finer ones
+    levels['error'] = numpy.maximum.accumulate([e for v, i, e in meshes])
+    for level, (v, i, e) in zip(levels, meshes):
+        set_level_bounds(level, numpy.reshape(v, (len(v), -1))[:, 0:3])
+    vertices = numpy.concatenate([v for v, i, e in meshes])
+    dtype = index_dtype(levels['vertex_count'].max())
+    indices = numpy.concatenate([i for v, i, e in meshes]).astype(dtype)
+    return vertices, indices, levels
+
+
+def index_dtype(vertex_count):
+    return numpy.dtype(numpy.uint16 if vertex_count <= 1 << 16 else numpy.uint32)
+
+
+def acmr(indices, cache_size=16):
+    "Average cache miss ratio of triangle indices, for a FIFO post-transform vertex cache"
+    triangle_count = len(indices) // 3
+    if triangle_count == 0:
+        return 0.0
+    indices = numpy.asarray(indices)
+    # a vertex is cached while fewer than cache_size misses followed its own
+    stamp = [-cache_size - 1] * (int(indices.max()) + 1)
+    misses = 0
+    for v in indices.tolist():
+        if misses - stamp[v] > cache_size:
+            stamp[v] = misses
+            misses += 1
+    return misses / float(triangle_count)
+
+
+def tipsify(indices, vertex_count, cache_size=16):
+    """
+    Triangle order for post-transform cache locality, after "Fast triangle reordering
+    for vertex locality and reduced overdraw", Sander, Nehab and Barczak, 2007
+    """
+    triangles = numpy.asarray(indices).reshape(-1, 3)
+    flat = triangles.ravel()
+    live = numpy.bincount(flat, minlength=vertex_count)
+    offsets = numpy.r_[0, numpy.cumsum(live)].tolist()
+    adjacency = (numpy.argsort(flat, kind='stable') // 3).tolist()
+    live = live.tolist()
+    corners = triangles.tolist()
+    stamp = [0] * vertex_count
+    emitted = [False] * len(triangles)
+    dead_end = []
+    order = []
+    clock = cache_size + 1
+    cursor = 0
+    fan = 0 if vertex_count else -1
+    while fan >= 0:
+        candidates = []
+        for t in adjacency[offsets[fan]:offsets[fan + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            order.append(t)
+            for v in corners[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if clock - stamp[v] > cache_size:
+                    stamp[v] = clock
+                    clock += 1
+        # next fanning vertex: the oldest candidate that will still be cached after its fan
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if clock - stamp[v] + 2 * live[v] <= cache_size:
+                    priority = clock - stamp[v]
+                if priority > best:
+                    best = priority
+                    fan = v
+        while fan < 0 and dead_end:
+            v = dead_end.pop()
+            if live[v] > 0:
+                fan = v
+        while fan < 0 and cursor < vertex_count:
+            if live[cursor] > 0:
+                fan = cursor
+            cursor += 1
+    return numpy.array(order, dtype=numpy.int64)
+
+
+def renumber_vertices(vertices, indices):
+    "Vertices in order of first use, dropping unused ones, and matching indices"
+    used, first_use = numpy.unique(indices, return_index=True)
+    old = used[numpy.argsort(first_use)]
+    new = numpy.zeros(len(vertices), dtype=numpy.int64)
+    new[old] = numpy.arange(len(old))
+    return vertices[old], new[indices]
+
+
+def build_mesh(mesh, cache_size=16, lod_fractions=(0.5, 0.25, 0.125, 0.0625)):
+    """
+    MeshBuffers for an ObjMesh, with a coarser level of detail for each fraction of
+    the original triangle count, as far as the mesh allows
+    """
+    from vrprim.mesh.simplify import level_of_detail_meshes
+
+    t0 = time.time()
+    vertices, indices = weld_vertices(corner_attributes(mesh))
+    acmr_before = acmr(indices, cache_size)
+    order = tipsify(indices, len(vertices), cache_size)
+    indices = indices.reshape(-1, 3)[order].ravel()
+    vertices, indices = renumber_vertices(vertices, indices)
+    acmr_after = acmr(indices, cache_size)
+    meshes = [(vertices, indices, 0.0), ]
+    meshes.extend(level_of_detail_meshes(vertices, indices, lod_fractions, cache_size=cache_size))
+    vertices, indices, levels = concatenate_levels(meshes)
+    return MeshBuffers(vertices, indices, levels, mesh.material_names, mesh.material_libraries,
+                       acmr_before=acmr_before, acmr_after=acmr_after,
+                       seconds=time.time() - t0)
+
+
+if __name__ == '__main__':
+    import sys
+
+    for path in sys.argv[1:]:
+        buffers = build_mesh(parse_obj(path))
+        level = buffers.levels[0]
+        print("%s: %d vertices, %d triangles, %s indices, ACMR %.3f before, %.3f after, %.3f s" % (
+            path, level['vertex_count'], level['index_count'] // 3, buffers.indices.dtype,
+            buffers.acmr_before, buffers.acmr_after, buffers.seconds))
+        for k, level in enumerate(buffers.levels[1:]):
+            print("  level %d: %d vertices, %d triangles, error %.3g" % (
+                k + 1, level['vertex_count'], level['index_count'] // 3, level['error']))
@@ -0,0 +1,175 @@
+"""
+Compiled binary cache of mesh vertex and index buffers, so warm starts skip text parsing.
+
+File layout: a 128-byte header (MESH_CACHE_HEADER), the table of levels of detail
+(mesh_build.MESH_LEVEL_DTYPE), the material names and libraries as UTF-8 JSON,
+the interleaved float32 vertex buffer, then the index buffer, each starting on a
+16-byte boundary. Coarser levels of detail are only present when built with lod=True.
+Cache files live in a user cache directory ($XDG_CACHE_HOME/vrprim/meshes), or next to
+the source file when asked and the source directory is writable. Each is named after
+its source path, and is valid while the source modification time and size match, or,
+failing that, while the SHA-1 hash of the source content matches; the cached
+modification time is then updated, so the source is hashed only once.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy
+
+from vrprim.mesh.mesh_build import MESH_LEVEL_DTYPE, single_level
+
+
+MESH_CACHE_MAGIC = b'VRMESH01'
+# Increment when the vertex or index buffer layout produced for a source changes
+MESH_CACHE_VERSION = 7
+HEADER_BYTES = 128
+MESH_CACHE_HEADER = numpy.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('floats_per_vertex', '<u4'),
+    ('vertex_count', '<u8'),
+    ('index_count', '<u8'),
+    ('index_dtype', 'S4'),
+    ('source_size', '<u8'),
+    ('source_mtime', '<f8'),
+    ('source_sha1', 'S20'),
+    ('level_count', '<u4'),
+    ('material_bytes', '<u4'),
+    ('lod', '<u4'),  # whether coarser levels of detail were generated
+])
+
+
+def _aligned(offset, alignment=16):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def user_cache_directory():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'vrprim', 'meshes')
+
+
+def cache_path(source_path, cache_dir=None, next_to_source=False):
+    """
+    Where the cache file for a source file is stored: in cache_dir, by default the user
+    cache directory, or with next_to_source=True beside the source, if that is writable
+    """
+    source_path = os.path.abspath(source_path)
+    if next_to_source and os.access(os.path.dirname(source_path), os.W_OK):
+        return source_path + '.vrmesh'
+    if cache_dir is None:
+        cache_dir = user_cache_directory()
+    key = hashlib.sha1(source_path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, '%s-%s.vrmesh' % (os.path.basename(source_path), key[:16]))
+
+
+def file_sha1(path, chunk_bytes=1 << 24):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _refresh_source_mtime(path, mtime):
+    "Record a new source modification time in the header of a cache file that is still valid"
+    offset = MESH_CACHE_HEADER.fields['source_mtime'][1]
+    try:
+        with open(path, 'r+b') as fh:
+            fh.seek(offset)
+            fh.write(numpy.array(mtime, dtype='<f8').tobytes())
+    except (IOError, OSError):
+        pass  # read-only cache; the hash is compared again next time
+
+
+def load_mesh_cache(source_path, cache_dir=None, next_to_source=False, lod=False):
+    """
+    Memory-mapped (vertices, indices, levels) arrays, with the material_names and
+    material_libraries lists, for a source file, or None if there is no valid cache.
+    vertices has shape (vertex_count, floats_per_vertex).
+    With lod=True, caches written without coarser levels of detail are not valid.
+    """
+    path = cache_path(source_path, cache_dir, next_to_source)
+    if not os.path.exists(path):
+        return None
+    header = numpy.fromfile(path, dtype=MESH_CACHE_HEADER, count=1)
+    if len(header) < 1:
+        return None
+    header = header[0]
+    if header['magic'] != MESH_CACHE_MAGIC or header['version'] != MESH_CACHE_VERSION:
+        return None
+    if lod and not header['lod']:
+        return None
+    stat = os.stat(source_path)
+    if header['source_size'] != stat.st_size:
+        return None
+    if header['source_mtime'] != stat.st_mtime:
+        # e.g. a fresh checkout of the same file; compare content instead
+        if header['source_sha1'] != file_sha1(source_path):
+            return None
+        _refresh_source_mtime(path, stat.st_mtime)
+    levels = numpy.fromfile(path, dtype=MESH_LEVEL_DTYPE, count=int(header['level_count']),
+                            offset=HEADER_BYTES)
+    material_offset = _aligned(HEADER_BYTES + levels.nbytes)
+    with open(path, 'rb') as fh:
+        fh.seek(material_offset)
+        materials = json.loads(fh.read(int(header['material_bytes'])).decode('utf-8'))
+    vertex_count = int(header['vertex_count'])
+    floats_per_vertex = int(header['floats_per_vertex'])
+    vertex_offset = _aligned(material_offset + int(header['material_bytes']))
+    vertices = numpy.memmap(path, dtype='<f4', mode='r', offset=vertex_offset,
+                            shape=(vertex_count, floats_per_vertex))
+    index_offset = _aligned(vertex_offset + vertices.nbytes)
+    indices = numpy.memmap(path, dtype=numpy.dtype(header['index_dtype'].decode('ascii')), mode='r',
+                           offset=index_offset, shape=(int(header['index_count']),))
+    return vertices, indices, levels, materials['names'], materials['libraries']
+
+
+def write_mesh_cache(source_path, vertices, indices, cache_dir=None, levels=None,
+                     material_names=(), material_libraries=(), next_to_source=False, lod=False):
+    """
+    Store compiled buffers, their levels of detail table, and material names, for a source file.
+    lod tells whether coarser levels of detail were generated, even if the mesh had none.
+    Returns the cache file path, or None if no cache location is writable.
+    """
+    path = cache_path(source_path, cache_dir, next_to_source)
+    stat = os.stat(source_path)
+    vertices = numpy.ascontiguousarray(vertices, dtype='<f4')
+    indices = numpy.ascontiguousarray(indices)
+    if levels is None:
+        levels = single_level(len(vertices), len(indices), vertices[:, 0:3])
+    materials = json.dumps({'names': list(material_names), 'libraries': list(material_libraries)}).encode('utf-8')
+    header = numpy.zeros(1, dtype=MESH_CACHE_HEADER)
+    header['magic'] = MESH_CACHE_MAGIC
+    header['version'] = MESH_CACHE_VERSION
+    header['floats_per_vertex'] = vertices.shape[1]
+    header['vertex_count'] = vertices.shape[0]
+    header['index_count'] = indices.size
+    header['index_dtype'] = indices.dtype.newbyteorder('<').str.encode('ascii')
+    header['source_size'] = stat.st_size
+    header['source_mtime'] = stat.st_mtime
+    header['source_sha1'] = file_sha1(source_path)
+    header['level_count'] = len(levels)
+    header['material_bytes'] = len(materials)
+    header['lod'] = lod
+    temp_path = path + '.tmp%d' % os.getpid()
+    try:
+        cache_dir = os.path.dirname(path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(temp_path, 'wb') as fh:
+            fh.write(header.tobytes().ljust(HEADER_BYTES, b'\0'))
+            fh.write(numpy.asarray(levels, dtype=MESH_LEVEL_DTYPE).tobytes())
+            fh.write(b'\0' * (_aligned(fh.tell()) - fh.tell()))
+            fh.write(materials)
+            fh.write(b'\0' * (_aligned(fh.tell()) - fh.tell()))
+            fh.write(vertices.tobytes())
+            fh.write(b'\0' * (_aligned(fh.tell()) - fh.tell()))
+            fh.write(indices.astype(indices.dtype.newbyteorder('<')).tobytes())
+        os.replace(temp_path, path)  # readers never see a partial file
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    return path
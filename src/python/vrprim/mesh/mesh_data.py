@@ -0,0 +1,103 @@
+"""
+Compact, array-backed mesh storage shared by the mesh actors.
+"""
+
+import numpy
+
+from vrprim.mesh.mesh_build import MATERIAL_VERTEX_FLOATS, VERTEX_FLOATS, single_level
+
+
+# Same bytes as one row of VERTEX_FLOATS float32 values
+MESH_VERTEX_DTYPE = numpy.dtype([
+    ('position', '<f4', (3,)),
+    ('normal', '<f4', (3,)),
+    ('texcoord', '<f4', (2,)),
+])
+
+# Same bytes as one row of MATERIAL_VERTEX_FLOATS float32 values
+MATERIAL_MESH_VERTEX_DTYPE = numpy.dtype(MESH_VERTEX_DTYPE.descr + [
+    ('material', '<f4'),  # index into the mesh material names, or -1
+])
+
+
+class MeshData(object):
+    """
+    A structured MESH_VERTEX_DTYPE vertex array, or MATERIAL_MESH_VERTEX_DTYPE for meshes
+    that use materials, triangle index array, and levels of detail
+    table (mesh_build.MESH_LEVEL_DTYPE), which holds the bounds of each level.
+    The arrays may be memory-mapped. Once uploaded, release_cpu_copies() drops them,
+    keeping the counts, levels and bounds needed for drawing and culling.
+    """
+    def __init__(self, vertices, indices, levels=None):
+        vertices = numpy.asarray(vertices)
+        if vertices.dtype not in (MESH_VERTEX_DTYPE, MATERIAL_MESH_VERTEX_DTYPE):
+            # view float rows in place, without copying memory-mapped data
+            vertices = numpy.ascontiguousarray(vertices, dtype='<f4')
+            width = vertices.shape[-1] if vertices.ndim == 2 else VERTEX_FLOATS
+            dtype = MATERIAL_MESH_VERTEX_DTYPE if width == MATERIAL_VERTEX_FLOATS else MESH_VERTEX_DTYPE
+            vertices = vertices.reshape(-1, width).view(dtype).reshape(-1)
+        self.vertices = vertices
+        self.vertex_dtype = vertices.dtype
+        self.indices = numpy.asarray(indices).reshape(-1)
+        if levels is None:
+            levels = single_level(len(self.vertices), len(self.indices), self.vertices['position'])
+        self.levels = levels
+        self.vertex_count = len(self.vertices)
+        self.index_count = len(self.indices)
+        self.index_dtype = self.indices.dtype
+
+    @property
+    def has_materials(self):
+        "Whether vertices carry a material index"
+        return 'material' in self.vertex_dtype.names
+
+    @property
+    def bounds(self):
+        "(minimum corner, maximum corner) of the full detail level"
+        return numpy.array([self.levels[0]['box_min'], self.levels[0]['box_max']])
+
+    @property
+    def bounding_center(self):
+        return self.levels[0]['sphere_center']
+
+    @property
+    def bounding_radius(self):
+        return float(self.levels[0]['sphere_radius'])
+
+    @property
+    def positions(self):
+        "Positions of the full detail level, or None after release_cpu_copies()"
+        if self.vertices is None:
+            return None
+        return self.vertices['position'][0:self.levels[0]['vertex_count']]
+
+    @property
+    def triangles(self):
+        "Vertex indices of the full detail triangles, or None after release_cpu_copies()"
+        if self.indices is None:
+            return None
+        return self.indices[0:self.levels[0]['index_count']].reshape(-1, 3)
+
+    def level_arrays(self, level=0):
+        "(vertices, indices) of one level of detail, with indices counting from its first vertex"
+        record = self.levels[level]
+        first_vertex, first_index = record['first_vertex'], record['first_index']
+        return (self.vertices[first_vertex:first_vertex + record['vertex_count']],
+                self.indices[first_index:first_index + record['index_count']])
+
+    def cpu_bytes(self):
+        "Memory held by the arrays; memory-mapped arrays count in full, though only touched pages are resident"
+        total = self.levels.nbytes
+        if self.vertices is not None:
+            total += self.vertices.nbytes
+        if self.indices is not None:
+            total += self.indices.nbytes
+        return total
+
+    def gpu_bytes(self):
+        "Size of the vertex and index buffers made from these arrays"
+        return self.vertex_count * self.vertex_dtype.itemsize + self.index_count * self.index_dtype.itemsize
+
+    def release_cpu_copies(self):
+        self.vertices = None
+        self.indices = None
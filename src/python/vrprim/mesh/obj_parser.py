@@ -0,0 +1,276 @@
+"""
+Bulk Wavefront OBJ parser.
+
+The file is read in large chunks. Line types are classified with NumPy byte masks,
+and all numbers of one kind in a chunk are converted in a single vectorized call,
+so parse time is dominated by memory bandwidth, not by the Python interpreter.
+Supports "v", "vt", "vn" and "f" records, with v, v/vt, v//vn, and v/vt/vn face
+corners, negative (relative) indices, and polygons of any size, which are
+fan triangulated. "usemtl" assigns a material to the faces that follow, and
+"mtllib" names material library files (see material). Other records are ignored.
+
+Usage: python -m vrprim.mesh.obj_parser model.obj
+"""
+
+import time
+import warnings
+
+import numpy
+
+
+_SPACE, _TAB, _CR, _LF, _SLASH = 32, 9, 13, 10, 47
+
+
+def _is_space(b):
+    return (b == _SPACE) | (b == _TAB) | (b == _CR) | (b == _LF)
+
+
+def _bulk_numbers(blob, dtype):
+    "All whitespace-separated numbers in a byte string, or None if anything else is there"
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        try:
+            return numpy.fromstring(blob, dtype=dtype, sep=' ')
+        except (ValueError, DeprecationWarning):
+            return None
+
+
+class ObjMesh(object):
+    """
+    Parsed OBJ contents. Indices are zero-based, and -1 where a face corner has no
+    texture coordinate or normal. Triangle corner indices have shape (triangle_count, 3).
+    triangle_materials indexes material_names for each triangle, or is -1 before any usemtl.
+    """
+    def __init__(self, positions, texcoords, normals, triangle_positions,
+                 triangle_texcoords, triangle_normals, byte_count=0, seconds=0.0,
+                 triangle_materials=None, material_names=None, material_libraries=None):
+        self.positions = positions
+        self.texcoords = texcoords
+        self.normals = normals
+        self.triangle_positions = triangle_positions
+        self.triangle_texcoords = triangle_texcoords
+        self.triangle_normals = triangle_normals
+        if triangle_materials is None:
+            triangle_materials = numpy.full(len(triangle_positions), -1, dtype=numpy.int64)
+        self.triangle_materials = triangle_materials
+        self.material_names = material_names or []
+        self.material_libraries = material_libraries or []
+        self.byte_count = byte_count
+        self.seconds = seconds
+
+    @property
+    def megabytes_per_second(self):
+        if self.seconds <= 0:
+            return 0.0
+        return self.byte_count / self.seconds / 1e6
+
+    def vertex_normals(self):
+        """
+        One normal per position: the OBJ normal of the last face corner using each position,
+        or the area-weighted face normal where no corner has one.
+        """
+        result = numpy.zeros_like(self.positions)
+        p = self.positions[self.triangle_positions]
+        face_normals = numpy.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+        for corner in range(3):
+            numpy.add.at(result, self.triangle_positions[:, corner], face_normals)
+        length = numpy.linalg.norm(result, axis=1)[:, numpy.newaxis]
+        result /= numpy.where(length > 0, length, 1)
+        if len(self.normals):
+            has_normal = self.triangle_normals >= 0
+            result[self.triangle_positions[has_normal]] = self.normals[self.triangle_normals[has_normal]]
+        return result
+
+
+class _ChunkParser(object):
+    "Accumulates parsed records from consecutive chunks of whole lines"
+    def __init__(self):
+        self.vectors = {b'v': [], b'vt': [], b'vn': []}
+        self.counts = {b'v': 0, b'vt': 0, b'vn': 0}
+        self.corners = []  # (v, vt, vn) index arrays
+        self.face_sizes = []
+        self.face_materials = []
+        self.material_names = []
+        self.material_libraries = []
+        self.material = -1  # set by the last usemtl record
+
+    def parse(self, chunk):
+        buf = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        line_end = numpy.flatnonzero(buf == _LF)
+        line_start = numpy.r_[0, line_end[:-1] + 1]
+        padded = numpy.r_[buf, _LF, _LF]
+        c0, c1, c2 = padded[line_start], padded[line_start + 1], padded[line_start + 2]
+        kinds = [
+            (b'v', (c0 == ord('v')) & _is_space(c1), 1),
+            (b'vt', (c0 == ord('v')) & (c1 == ord('t')) & _is_space(c2), 2),
+            (b'vn', (c0 == ord('v')) & (c1 == ord('n')) & _is_space(c2), 2),
+            (b'f', (c0 == ord('f')) & _is_space(c1), 1),
+        ]
+        line_length = line_end - line_start + 1
+        # positions, texture coordinates and normals defined before each line, for relative indices
+        before = {}
+        for key, is_kind, keyword_length in kinds:
+            if key != b'f':
+                before[key] = self.counts[key] + numpy.cumsum(is_kind) - is_kind
+        face_lines = numpy.flatnonzero(kinds[3][1])
+        statements = numpy.flatnonzero((c0 == ord('u')) | (c0 == ord('m')))
+        self.face_materials.append(self._parse_materials(buf, line_start, line_end, statements, face_lines))
+        for key, is_kind, keyword_length in kinds:
+            line_count = numpy.count_nonzero(is_kind)
+            if line_count == 0:
+                continue
+            text = buf[numpy.repeat(is_kind, line_length)]
+            # blank out the record keyword of each selected line
+            starts = numpy.r_[0, numpy.cumsum(line_length[is_kind])[:-1]]
+            for k in range(keyword_length):
+                text[starts + k] = _SPACE
+            if key == b'f':
+                self._parse_faces(text, before, face_lines)
+            else:
+                self._parse_vectors(key, text, line_count)
+
+    def _parse_materials(self, buf, line_start, line_end, statements, face_lines):
+        "Material index of each face line, from the usemtl and mtllib lines, which are few"
+        usemtl_lines = []
+        usemtl_materials = []
+        for line in statements:
+            words = buf[line_start[line]:line_end[line]].tobytes().decode('utf-8', 'replace').split(None, 1)
+            if len(words) < 2:
+                continue
+            keyword, name = words[0], words[1].strip()
+            if keyword == 'usemtl':
+                if name not in self.material_names:
+                    self.material_names.append(name)
+                usemtl_lines.append(line)
+                usemtl_materials.append(self.material_names.index(name))
+            elif keyword == 'mtllib':
+                self.material_libraries.extend(
+                    library for library in name.split() if library not in self.material_libraries)
+        materials = numpy.array([self.material, ] + usemtl_materials, dtype=numpy.int64)
+        self.material = materials[-1]
+        return materials[numpy.searchsorted(usemtl_lines, face_lines, 'right')]
+
+    def _parse_vectors(self, key, text, line_count):
+        width = 2 if key == b'vt' else 3
+        values = _bulk_numbers(text.tobytes(), numpy.float64)
+        if values is not None and len(values) % line_count == 0 and len(values) >= width * line_count:
+            vectors = values.reshape(line_count, -1)[:, 0:width]
+        else:  # uneven or unusual lines
+            vectors = numpy.array([[float(x) for x in line.split()[0:width]]
+                                   for line in text.tobytes().splitlines() if line.strip()])
+        self.vectors[key].append(vectors.astype(numpy.float32))
+        self.counts[key] += line_count
+
+    def _parse_faces(self, text, before, face_lines):
+        # one token per face corner
+        space = _is_space(text)
+        token_start = numpy.flatnonzero(~space & numpy.r_[True, space[:-1]])
+        token_count = len(token_start)
+        line_end = numpy.flatnonzero(text == _LF)
+        face_sizes = numpy.bincount(numpy.searchsorted(line_end, token_start),
+                                    minlength=len(face_lines))
+        slash = numpy.flatnonzero(text == _SLASH)
+        double = slash[:-1][numpy.diff(slash) == 1]
+        slash_count = numpy.bincount(numpy.searchsorted(token_start, slash, 'right') - 1,
+                                     minlength=token_count)
+        double_count = numpy.bincount(numpy.searchsorted(token_start, double, 'right') - 1,
+                                      minlength=token_count)
+        numbers_per_token = 1 + slash_count - double_count
+        text[slash] = _SPACE
+        values = _bulk_numbers(text.tobytes(), numpy.int64)
+        if values is None or len(values) != numbers_per_token.sum():
+            raise ValueError("Unreadable OBJ face record")
+        first = numpy.cumsum(numbers_per_token) - numbers_per_token
+        token_line = face_lines[numpy.repeat(numpy.arange(len(face_lines)), face_sizes)]
+        has_vt = (slash_count >= 1) & (double_count == 0)
+        has_vn = slash_count == 2
+        vt_slot = first + 1
+        vn_slot = first + numpy.where(double_count > 0, 1, 2)
+        corners = []
+        for key, present, slot in ((b'v', numpy.ones(token_count, dtype=bool), first),
+                                   (b'vt', has_vt, vt_slot),
+                                   (b'vn', has_vn, vn_slot)):
+            index = numpy.full(token_count, -1, dtype=numpy.int64)
+            raw = values[slot[present]]
+            relative_base = before[key][token_line[present]]
+            index[present] = numpy.where(raw < 0, relative_base + raw, raw - 1)
+            corners.append(index)
+        self.corners.append(corners)
+        self.face_sizes.append(face_sizes)
+
+    def result(self):
+        vectors = {}
+        for key, width in ((b'v', 3), (b'vt', 2), (b'vn', 3)):
+            parts = self.vectors[key]
+            vectors[key] = numpy.concatenate(parts) if parts else numpy.zeros((0, width), dtype=numpy.float32)
+        if self.corners:
+            corners = [numpy.concatenate([c[i] for c in self.corners]) for i in range(3)]
+            face_sizes = numpy.concatenate(self.face_sizes)
+        else:
+            corners = [numpy.zeros(0, dtype=numpy.int64), ] * 3
+            face_sizes = numpy.zeros(0, dtype=numpy.int64)
+        triangles = fan_triangles(face_sizes)
+        triangle_materials = numpy.repeat(numpy.concatenate(self.face_materials + [numpy.zeros(0, dtype=numpy.int64)]),
+                                          numpy.maximum(face_sizes - 2, 0))
+        return ObjMesh(vectors[b'v'], vectors[b'vt'], vectors[b'vn'],
+                       *[c[triangles] for c in corners],
+                       triangle_materials=triangle_materials, material_names=self.material_names,
+                       material_libraries=self.material_libraries)
+
+
+def fan_triangles(face_sizes):
+    """
+    Corner indices of a fan triangulation of consecutive polygons, with shape (triangle_count, 3)
+
+    >>> fan_triangles(numpy.array([3, 4])).tolist()
+    [[0, 1, 2], [3, 4, 5], [3, 5, 6]]
+    """
+    face_sizes = numpy.asarray(face_sizes, dtype=numpy.int64)
+    triangle_counts = numpy.maximum(face_sizes - 2, 0)
+    face_first = numpy.cumsum(face_sizes) - face_sizes
+    face = numpy.repeat(numpy.arange(len(face_sizes)), triangle_counts)
+    fan_index = numpy.arange(triangle_counts.sum()) - numpy.repeat(numpy.cumsum(triangle_counts) - triangle_counts,
+                                                                   triangle_counts)
+    a = face_first[face]
+    return numpy.stack([a, a + fan_index + 1, a + fan_index + 2], axis=1)
+
+
+def parse_obj(source, chunk_bytes=1 << 24):
+    """
+    Parse an OBJ file, given a path or an open file object, text or binary, into an ObjMesh.
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as fh:
+            return parse_obj(fh, chunk_bytes)
+    t0 = time.time()
+    parser = _ChunkParser()
+    byte_count = 0
+    remainder = b''
+    while True:
+        data = source.read(chunk_bytes)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        byte_count += len(data)
+        if not data:
+            break
+        data = remainder + data
+        cut = data.rfind(b'\n') + 1
+        remainder = data[cut:]
+        if cut > 0:
+            parser.parse(data[:cut])
+    if remainder:
+        parser.parse(remainder + b'\n')
+    mesh = parser.result()
+    mesh.byte_count = byte_count
+    mesh.seconds = time.time() - t0
+    return mesh
+
+
+if __name__ == '__main__':
+    import sys
+
+    for path in sys.argv[1:]:
+        mesh = parse_obj(path)
+        print("%s: %d positions, %d triangles, %.1f MB in %.3f s, %.1f MB/s" % (
+            path, len(mesh.positions), len(mesh.triangle_positions),
+            mesh.byte_count / 1e6, mesh.seconds, mesh.megabytes_per_second))
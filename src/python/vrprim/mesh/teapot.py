@@ -4,6 +4,7 @@ Created on Apr 18, 2017
 @author: Christopher Bruns
 """
 
+import ctypes
 import os
 
 import numpy
@@ -13,6 +14,11 @@ from OpenGL.arrays import vbo
 
 from openvr.glframework.glmatrix import identity, pack, rotate_y, scale
 from openvr.glframework import shader_string
+from vrprim.gpu_memory import gpu_memory_manager, release_vbo_cpu_copy
+from vrprim.mesh.culling import transform_boxes, transform_spheres
+from vrprim.mesh.loading import BufferUpload, gpu_upload_budget, load_obj_buffers, load_obj_buffers_async
+from vrprim.mesh.mesh_data import MeshData
+from vrprim.mesh.texture_atlas import TextureAtlas
 
 
 class TriangleActor(object):
@@ -76,6 +82,12 @@ class TriangleActor(object):
             """,
             GL.GL_FRAGMENT_SHADER)
         self.program = compileProgram(vertex_shader, fragment_shader)
+        gpu_memory_manager.register(self)
+        if gpu_memory_manager.release_cpu_copies:
+            release_vbo_cpu_copy(self.vertices)
+
+    def gpu_bytes(self):
+        return self.vertices.size
 
     def display_gl(self, model_view, projection):
         GL.glBindVertexArray(self.vao)
@@ -85,139 +97,367 @@ class TriangleActor(object):
         GL.glDrawArrays(GL.GL_TRIANGLES, 0, 3)
 
     def dispose_gl(self):
+        gpu_memory_manager.unregister(self)
         if self.vao:
             GL.glDeleteVertexArrays(1, [self.vao, ])
         self.vertices.delete()
         GL.glDeleteProgram(self.program)
 
 
+def select_lod_level(errors, pixels_per_unit, current=0, pixel_error=1.0, hysteresis=0.25):
+    """
+    Coarsest level of detail whose error projects to at most pixel_error pixels.
+    To avoid popping back and forth near a threshold, the level only coarsens once the
+    new error is below pixel_error / (1 + hysteresis), and only refines once the
+    current error exceeds pixel_error * (1 + hysteresis).
+    errors must be non-decreasing, starting with zero for the full mesh.
+    """
+    projected = numpy.asarray(errors) * pixels_per_unit
+    target = int(numpy.flatnonzero(projected <= pixel_error)[-1])
+    if target > current:
+        coarser = numpy.flatnonzero(projected[current:target + 1] <= pixel_error / (1.0 + hysteresis))
+        target = current + int(coarser[-1]) if len(coarser) else current
+    elif target < current and projected[current] <= pixel_error * (1.0 + hysteresis):
+        target = current
+    return target
+
+
 class ObjActor(object):
-    def __init__(self, obj_stream):
+    """
+    Mesh actor for Wavefront OBJ files. When the file path is known, compiled vertex and
+    index buffers are cached in a binary file (see mesh_cache), and later loaded
+    memory-mapped, without parsing the OBJ text.
+    The mesh arrays are kept in a MeshData, released once uploaded when the
+    gpu_memory_manager is set to release CPU copies.
+    With lod=True, the buffers also hold coarser levels of detail, and display_gl() draws
+    the coarsest one whose error stays below lod_pixel_error pixels. Both eyes share
+    one hysteresis state, so they usually agree on the level. Without lod, only the
+    full detail level is uploaded.
+    With asynchronous=True, loading runs on a worker thread (see loading), and the
+    buffers upload over the following frames within the shared gpu_upload_budget;
+    the actor draws nothing until it is ready. If loading fails, load_error holds the
+    exception and the actor never becomes ready.
+    bounding_sphere() and bounding_box() place the mesh bounds at model_matrix,
+    for culling (see culling.CullingGroup).
+    With materials=True, or a TextureAtlas shared by several actors, the diffuse colors
+    and textures of the OBJ materials are packed into the atlas, and each material's
+    texture coordinates are remapped to its tile in the fragment shader, through a
+    per-actor tile table buffer texture, so the model draws with one program and two
+    texture binds, the shared atlas and the tile table. Faces without a material keep
+    the normal coloring. Asynchronous actors upload their tiles within gpu_upload_budget.
+    """
+    vertex_shader_source = shader_string("""
+        layout(location = 0) in vec3 in_Position;
+        layout(location = 1) in vec3 in_Normal;
+
+        layout(location = 0) uniform mat4 projection = mat4(1);
+        layout(location = 1) uniform mat4 model_view = mat4(1);
+
+        out vec3 normal;
+
+        void main() 
+        {
+            gl_Position = projection * model_view * vec4(in_Position, 1.0);
+            mat4 normal_matrix = transpose(inverse(model_view));
+            normal = normalize((normal_matrix * vec4(in_Normal, 0)).xyz);
+        }
+        """)
+    fragment_shader_source = shader_string("""
+        in vec3 normal;
+        out vec4 fragColor;
+
+        vec4 color_by_normal(in vec3 n) {
+            return vec4(0.5 * (normalize(n) + vec3(1)), 1);
+        }
+
+        void main() 
+        {
+            fragColor = color_by_normal(normal);
+        }
+        """)
+    textured_vertex_shader_source = shader_string("""
+        layout(location = 0) in vec3 in_Position;
+        layout(location = 1) in vec3 in_Normal;
+        layout(location = 2) in vec2 in_TexCoord;
+        layout(location = 3) in float in_Material;
+
+        layout(location = 0) uniform mat4 projection = mat4(1);
+        layout(location = 1) uniform mat4 model_view = mat4(1);
+
+        out vec3 normal;
+        out vec2 texcoord;
+        flat out int material;
+
+        void main()
+        {
+            gl_Position = projection * model_view * vec4(in_Position, 1.0);
+            mat4 normal_matrix = transpose(inverse(model_view));
+            normal = normalize((normal_matrix * vec4(in_Normal, 0)).xyz);
+            texcoord = in_TexCoord;
+            material = int(in_Material);
+        }
+        """)
+    textured_fragment_shader_source = shader_string("""
+        in vec3 normal;
+        in vec2 texcoord;
+        flat in int material;
+        out vec4 fragColor;
+
+        layout(binding = 0) uniform sampler2DArray diffuse_atlas;
+        layout(binding = 1) uniform samplerBuffer tile_table;  // per material: tile rect, then atlas layer
+
+        vec4 color_by_normal(in vec3 n) {
+            return vec4(0.5 * (normalize(n) + vec3(1)), 1);
+        }
+
+        void main()
+        {
+            if (material < 0) {
+                fragColor = color_by_normal(normal);
+                return;
+            }
+            vec4 rect = texelFetch(tile_table, 2 * material);
+            float layer = texelFetch(tile_table, 2 * material + 1).r;
+            // wrap within the tile, like GL_REPEAT; gradients of the unwrapped
+            // coordinates keep the mipmap level steady across the wrap
+            vec2 uv = rect.xy + fract(texcoord) * rect.zw;
+            vec4 color = textureGrad(diffuse_atlas, vec3(uv, layer),
+                                     dFdx(texcoord) * rect.zw, dFdy(texcoord) * rect.zw);
+            float headlight = 0.3 + 0.7 * abs(normalize(normal).z);
+            fragColor = vec4(headlight * color.rgb, 1);
+        }
+        """)
+
+    def __init__(self, obj_stream=None, obj_path=None, use_cache=True,
+                 lod=False, lod_pixel_error=1.0, lod_hysteresis=0.25, asynchronous=False,
+                 materials=False, atlas=None):
         self.model_matrix = identity()
         self.vao = None
         self.shader = None
-        self.vertexes = list()
-        vertex_normals = list()
-        self.normal_for_vertex = dict()
-        self.faces = list()
-        fh = obj_stream
-        for line in fh:
-            if line.startswith('#'):
-                # e.g. "# Blender v2.65 (sub 0) OBJ File"
-                continue  # ignore comments
-            elif line.startswith('o '):
-                # e.g. "o teapot.005"
-                continue  # ignore object names
-            elif line.startswith('v '):
-                # e.g. "v -0.498530 0.712498 -0.039883"
-                vec3 = [float(x) for x in line.split()[1:4]]
-                self.vertexes.append(vec3)
-            elif line.startswith('vn '):
-                # e.g. "vn -0.901883 0.415418 0.118168"
-                vec3 = [float(x) for x in line.split()[1:4]]
-                vertex_normals.append(vec3)
-            elif line.startswith('s '):
-                continue  # ignore whatever "s" is
-                # print(line)
-            elif line.startswith('f '):
-                face = list()
-                for c in line.split()[1:]:
-                    v, n = [int(x) for x in c.split('/')[0:3:2]]
-                    face.append(v - 1)  # vertex index
-                    self.normal_for_vertex[v - 1] = vertex_normals[n - 1]
-                    self.faces.append(face)
-                    # print(line)
-                    # print(face)
-            else:
-                print(line)
-                break
-        self.vbo = list()
-        ibo = list()
-        for i in range(len(self.vertexes)):
-            v = self.vertexes[i]
-            n = self.normal_for_vertex[i]
-            self.vbo.append(v)
-            self.vbo.append(n)
-        for f in self.faces:
-            for v in f:
-                ibo.append(v)
-                # todo: only works for single triangle faces at the moment...
-        self.element_count = len(ibo)
-        self.vbo = numpy.array(self.vbo, 'float32')
-        ibo = numpy.array(ibo, 'int16')
-        self.vbo = vbo.VBO(self.vbo)
-        self.ibo = vbo.VBO(ibo, target=GL.GL_ELEMENT_ARRAY_BUFFER)
+        self.lod = lod
+        self.lod_pixel_error = lod_pixel_error
+        self.lod_hysteresis = lod_hysteresis
+        self.lod_level = 0
+        self.mesh = None
+        self.vbo = None
+        self.ibo = None
+        self.loaded_from_cache = False
+        self.parse_megabytes_per_second = None
+        # post-transform vertex cache miss ratios, known when the mesh is built rather than cached
+        self.acmr_before = None
+        self.acmr_after = None
+        self._load_future = None
+        self._uploads = None
+        self.load_error = None
+        if atlas is None and materials:
+            atlas = TextureAtlas()
+        self.atlas = atlas
+        self.tile_table = None  # (material count, 2, 4) float32: tile rect, then atlas layer
+        self.tile_buffer = None
+        self.tile_texture = None
+        load_args = (obj_stream, obj_path, use_cache, atlas is not None,
+                     atlas.max_tile_size if atlas is not None else None, lod)
+        if asynchronous:
+            # display_gl() draws nothing until the buffers are loaded and uploaded
+            self._load_future = load_obj_buffers_async(*load_args)
+        else:
+            self._set_buffers(load_obj_buffers(*load_args))
+
+    @property
+    def ready(self):
+        "Whether the mesh is on the GPU and drawn"
+        return self.vao is not None
+
+    def _set_buffers(self, buffers):
+        self.loaded_from_cache = buffers.loaded_from_cache
+        self.parse_megabytes_per_second = buffers.parse_megabytes_per_second
+        self.acmr_before = buffers.acmr_before
+        self.acmr_after = buffers.acmr_after
+        vertices, indices, levels = buffers.vertices, buffers.indices, buffers.levels
+        if not self.lod:
+            # a cache written for lod=True also holds coarser levels, which would never be drawn
+            full = levels[0]
+            vertices, indices, levels = vertices[0:full['vertex_count']], indices[0:full['index_count']], levels[0:1]
+        self.mesh = MeshData(vertices, indices, levels)  # memory mapped when cached
+        self.levels = self.mesh.levels
+        self.element_count = int(self.levels[0]['index_count'])
+        self.index_type = GL.GL_UNSIGNED_SHORT if self.mesh.index_dtype.itemsize == 2 else GL.GL_UNSIGNED_INT
+        self.vbo = vbo.VBO(self.mesh.vertices.view(numpy.uint8))
+        self.ibo = vbo.VBO(self.mesh.indices, target=GL.GL_ELEMENT_ARRAY_BUFFER)
+        if self.atlas is not None:
+            tile_indices = self.atlas.add_materials(buffers.materials)
+            tiles = self.atlas.tiles[tile_indices]
+            self.tile_table = numpy.zeros((len(tiles), 2, 4), dtype=numpy.float32)
+            self.tile_table[:, 0] = tiles['rect']
+            self.tile_table[:, 1, 0] = tiles['layer']
 
     def init_gl(self):
+        if self.atlas is not None:
+            vertex_shader = compileShader(self.textured_vertex_shader_source, GL.GL_VERTEX_SHADER)
+            fragment_shader = compileShader(self.textured_fragment_shader_source, GL.GL_FRAGMENT_SHADER)
+            self.atlas.init_gl()
+            if self._load_future is None:
+                self.atlas.upload()
+        else:
+            vertex_shader = compileShader(self.vertex_shader_source, GL.GL_VERTEX_SHADER)
+            fragment_shader = compileShader(self.fragment_shader_source, GL.GL_FRAGMENT_SHADER)
+        self.shader = compileProgram(vertex_shader, fragment_shader)
+        GL.glEnable(GL.GL_DEPTH_TEST)
+        if self._load_future is None:
+            self._init_vertex_array()
+
+    def _finish_loading(self):
+        "Continue an asynchronous load; returns True once the mesh is ready to draw"
+        if self.load_error is not None:
+            return False
+        if self._load_future is not None:
+            if not self._load_future.done():
+                return False
+            future, self._load_future = self._load_future, None
+            try:
+                buffers = future.result()
+            except Exception as error:  # e.g. a missing or malformed file; reported once, not every frame
+                self.load_error = error
+                return False
+            self._set_buffers(buffers)
+            self._uploads = [BufferUpload(self.vbo), BufferUpload(self.ibo)]
+        for upload in self._uploads:
+            if not upload.step(gpu_upload_budget):
+                return False
+        if self.atlas is not None and not self.atlas.upload_step(gpu_upload_budget):
+            return False
+        self._uploads = None
+        self._init_vertex_array()
+        return True
+
+    def _init_vertex_array(self):
+        "Create the vertex array, uploading any buffers not yet on the GPU"
         self.vao = GL.glGenVertexArrays(1)
         GL.glBindVertexArray(self.vao)
         self.ibo.bind()
         self.vbo.bind()
+        stride = self.mesh.vertex_dtype.itemsize
+        fields = self.mesh.vertex_dtype.fields
         GL.glEnableVertexAttribArray(0)  # vertex location
-        float_size = self.vbo.dtype.itemsize  # 4 bytes per float32
         GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, False,
-                                 6 * float_size, self.vbo + 0 * float_size)
+                                 stride, self.vbo + fields['position'][1])
         GL.glEnableVertexAttribArray(1)  # vertex normal
         GL.glVertexAttribPointer(1, 3, GL.GL_FLOAT, False,
-                                 6 * float_size, self.vbo + 3 * float_size)
-        vertex_shader = compileShader(
-            shader_string("""
-            layout(location = 0) in vec3 in_Position;
-            layout(location = 1) in vec3 in_Normal;
+                                 stride, self.vbo + fields['normal'][1])
+        if self.atlas is not None and self.mesh.has_materials:
+            GL.glEnableVertexAttribArray(2)  # texture coordinate
+            GL.glVertexAttribPointer(2, 2, GL.GL_FLOAT, False,
+                                     stride, self.vbo + fields['texcoord'][1])
+            GL.glEnableVertexAttribArray(3)  # material index
+            GL.glVertexAttribPointer(3, 1, GL.GL_FLOAT, False,
+                                     stride, self.vbo + fields['material'][1])
+        self._init_instance_attributes()
+        GL.glBindVertexArray(0)
+        if self.tile_table is not None and len(self.tile_table):
+            self._init_tile_table()
+        gpu_memory_manager.register(self)
+        if gpu_memory_manager.release_cpu_copies:
+            release_vbo_cpu_copy(self.vbo)
+            release_vbo_cpu_copy(self.ibo)
+            self.mesh.release_cpu_copies()
 
-            layout(location = 0) uniform mat4 projection = mat4(1);
-            layout(location = 1) uniform mat4 model_view = mat4(1);
+    def _init_tile_table(self):
+        "Upload the tile of each material as a buffer texture, two RGBA32F texels per material"
+        self.tile_buffer = GL.glGenBuffers(1)
+        self.tile_texture = GL.glGenTextures(1)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, self.tile_buffer)
+        GL.glBufferData(GL.GL_TEXTURE_BUFFER, self.tile_table.nbytes, self.tile_table, GL.GL_STATIC_DRAW)
+        GL.glBindTexture(GL.GL_TEXTURE_BUFFER, self.tile_texture)
+        GL.glTexBuffer(GL.GL_TEXTURE_BUFFER, GL.GL_RGBA32F, self.tile_buffer)
+        GL.glBindTexture(GL.GL_TEXTURE_BUFFER, 0)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, 0)
 
-            out vec3 normal;
+    def _init_instance_attributes(self):
+        "Per-instance vertex attributes, for subclasses that draw instances"
+        pass
 
-            void main() 
-            {
-                gl_Position = projection * model_view * vec4(in_Position, 1.0);
-                mat4 normal_matrix = transpose(inverse(model_view));
-                normal = normalize((normal_matrix * vec4(in_Normal, 0)).xyz);
-            }
-            """),
-            GL.GL_VERTEX_SHADER)
-        fragment_shader = compileShader(
-            shader_string("""            in vec3 normal;
-            out vec4 fragColor;
+    def gpu_bytes(self):
+        tile_bytes = self.tile_table.nbytes if self.tile_texture is not None else 0
+        return self.vbo.size + self.ibo.size + tile_bytes
 
-            vec4 color_by_normal(in vec3 n) {
-                return vec4(0.5 * (normalize(n) + vec3(1)), 1);
-            }
-
-            void main() 
-            {
-                fragColor = color_by_normal(normal);
-            }
-            """),
-            GL.GL_FRAGMENT_SHADER)
-        self.shader = compileProgram(vertex_shader, fragment_shader)
-        GL.glEnable(GL.GL_DEPTH_TEST)
+    def cpu_bytes(self):
+        "Memory held by the mesh arrays, which the buffer objects share until released"
+        return self.mesh.cpu_bytes() if self.mesh is not None else 0
 
     def display_gl(self, model_view, projection):
+        if self.vao is None and not self._finish_loading():
+            return
         GL.glBindVertexArray(self.vao)
         GL.glUseProgram(self.shader)
         m = self.model_matrix * model_view
         GL.glUniformMatrix4fv(0, 1, False, pack(projection))
         GL.glUniformMatrix4fv(1, 1, False, pack(m))
-        GL.glDrawElements(GL.GL_TRIANGLES, self.element_count, GL.GL_UNSIGNED_SHORT, None)
+        if self.tile_texture is not None:
+            self.atlas.bind(0)
+            GL.glActiveTexture(GL.GL_TEXTURE1)
+            GL.glBindTexture(GL.GL_TEXTURE_BUFFER, self.tile_texture)
+            GL.glActiveTexture(GL.GL_TEXTURE0)
+        elif self.atlas is not None:
+            GL.glVertexAttrib1f(3, -1.0)  # mesh without materials: normal coloring
+        if len(self.levels) == 1:
+            GL.glDrawElements(GL.GL_TRIANGLES, self.element_count, self.index_type, None)
+            return
+        viewport_height = GL.glGetIntegerv(GL.GL_VIEWPORT)[3]
+        self.lod_level = select_lod_level(self.levels['error'], self.pixels_per_unit(m, projection, viewport_height),
+                                          self.lod_level, self.lod_pixel_error, self.lod_hysteresis)
+        level = self.levels[self.lod_level]
+        index_size = 2 if self.index_type == GL.GL_UNSIGNED_SHORT else 4
+        GL.glDrawElementsBaseVertex(GL.GL_TRIANGLES, int(level['index_count']), self.index_type,
+                                    ctypes.c_void_p(int(level['first_index']) * index_size),
+                                    int(level['first_vertex']))
+
+    def bounding_sphere(self):
+        "(center, radius) around the mesh at model_matrix, or None until loaded"
+        if self.mesh is None:
+            return None
+        centers, radii = transform_spheres(self.mesh.bounding_center, self.mesh.bounding_radius, self.model_matrix)
+        return centers[0], radii[0]
+
+    def bounding_box(self):
+        "(minimum, maximum) corners of an axis-aligned box around the mesh at model_matrix, or None until loaded"
+        if self.mesh is None:
+            return None
+        box_min, box_max = transform_boxes(self.mesh.bounds[0], self.mesh.bounds[1], self.model_matrix)
+        return box_min[0], box_max[0]
+
+    def pixels_per_unit(self, model_view, projection, viewport_height):
+        "Screen pixels per model space unit at the nearest point of the bounding sphere"
+        m = numpy.asarray(model_view, dtype=numpy.float64)
+        center = numpy.append(self.mesh.bounding_center, 1.0).dot(m)[0:3]
+        scale = numpy.linalg.norm(m[0:3, 0:3], axis=1).max()
+        distance = max(numpy.linalg.norm(center) - self.mesh.bounding_radius * scale, 1e-6)
+        return 0.5 * viewport_height * abs(projection[1][1]) * scale / distance
 
     def dispose_gl(self):
         if self.vao:
+            gpu_memory_manager.unregister(self)
             GL.glDeleteVertexArrays(1, [self.vao, ])
+            self.vao = None
+        if self.vbo is not None:
             self.ibo.delete()
             self.vbo.delete()
+        if self.tile_texture is not None:
+            GL.glDeleteTextures([self.tile_texture, ])
+            GL.glDeleteBuffers(1, [self.tile_buffer, ])
+            self.tile_texture = None
+            self.tile_buffer = None
+        if self.shader is not None:
             GL.glDeleteProgram(self.shader)
-            self.vao = None
+            self.shader = None
+            if self.atlas is not None:
+                self.atlas.dispose_gl()
 
 
 class TeapotActor(ObjActor):
     def __init__(self):
         src_folder = os.path.dirname(os.path.abspath(__file__))
         obj_path = os.path.join(src_folder, 'wt_teapot.obj')
-        with open(obj_path) as fh:
-            super(TeapotActor, self).__init__(obj_stream=fh)
+        super(TeapotActor, self).__init__(obj_path=obj_path)
 
 
 if __name__ == "__main__":
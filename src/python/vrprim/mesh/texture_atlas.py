@@ -0,0 +1,233 @@
+"""
+Diffuse textures of many materials packed into the pages of one texture array,
+so that a model, or a set of models, draws with a single texture bind.
+
+Tiles are placed on shelves, tallest first. Each tile is surrounded by a gutter of
+wrapped texels, so filtering across tile edges matches GL_REPEAT, and starts on a
+multiple of the gutter width, so that mipmap levels up to log2(gutter) never mix
+neighboring tiles; coarser levels are left out. Textured tiles are multiplied by
+their material's diffuse color, and untextured materials get a small tile of theirs.
+"""
+
+import numpy
+from OpenGL import GL
+
+from vrprim.gpu_memory import gpu_memory_manager, texture_bytes
+from vrprim.mesh.loading import gpu_upload_budget
+
+
+# Where one texture is stored: texture coordinates of its lower left corner and its
+# size, as fractions of the page size, and the texture array layer of its page
+ATLAS_TILE_DTYPE = numpy.dtype([
+    ('rect', '<f4', (4,)),
+    ('layer', '<f4'),
+])
+
+
+def downsample(image):
+    "Half size image, averaging 2x2 blocks, for arrays with even width and height"
+    h, w = image.shape[0] // 2, image.shape[1] // 2
+    blocks = image[0:2 * h, 0:2 * w].reshape(h, 2, w, 2, -1).astype(numpy.float32)
+    return (blocks.mean(axis=(1, 3)) + 0.5).astype(image.dtype)
+
+
+class TextureAtlas(object):
+    """
+    Packs RGB images into square pages of page_size texels, kept as one GL_TEXTURE_2D_ARRAY.
+    add_materials() returns the tile index of each material; tiles holds the placement of
+    each tile, for remapping texture coordinates in the shader.
+    The texture is shared: each user calls init_gl() and dispose_gl() once, and the
+    last dispose_gl() deletes it. Tiles added after init_gl() are uploaded by upload() or,
+    a few at a time within an UploadBudget, by upload_step(); texture layers are allocated
+    ahead of the pages, and only grow by copying on the GPU.
+    """
+    def __init__(self, page_size=2048, gutter=8, color_tile_size=4):
+        if gutter & (gutter - 1) or page_size % (4 * gutter):
+            raise ValueError("gutter must be a power of two, and page_size a multiple of four gutters")
+        self.page_size = page_size
+        self.gutter = gutter
+        self.color_tile_size = color_tile_size
+        self.max_level = gutter.bit_length() - 1
+        self.pages = []  # (page_size, page_size, 3) uint8 arrays, row 0 at texture coordinate v = 0
+        self.tiles = numpy.zeros(0, dtype=ATLAS_TILE_DTYPE)
+        self._shelves = []  # for each page, a list of [y, height, next x]
+        self._tile_keys = {}
+        self._regions = []  # (page, x, y, width, height) of each tile with its gutter
+        self._pending = []  # indices of tiles not yet uploaded
+        self.texture = None
+        self._users = 0
+        self._layer_capacity = 0
+
+    @property
+    def max_tile_size(self):
+        "Largest texture width and height that fits on one page"
+        return self.page_size - 2 * self.gutter
+
+    def add_image(self, image, key=None):
+        "Store an RGB image, row 0 at the top; returns its tile index. Images with the same key are stored once."
+        if key is not None and key in self._tile_keys:
+            return self._tile_keys[key]
+        image = numpy.asarray(image, dtype=numpy.uint8)
+        while max(image.shape[0:2]) > self.max_tile_size:
+            image = downsample(image)
+        image = image[::-1]  # OBJ texture coordinates start at the bottom left
+        h, w = image.shape[0:2]
+        g = self.gutter
+        padded_height = -(-(h + 2 * g) // g) * g
+        padded_width = -(-(w + 2 * g) // g) * g
+        page, x, y = self._place(padded_width, padded_height)
+        self.pages[page][y:y + padded_height, x:x + padded_width] = numpy.pad(
+            image, ((g, padded_height - h - g), (g, padded_width - w - g), (0, 0)), mode='wrap')
+        tile = numpy.zeros(1, dtype=ATLAS_TILE_DTYPE)
+        tile['rect'] = numpy.array([x + g, y + g, w, h], dtype=numpy.float32) / self.page_size
+        tile['layer'] = page
+        self.tiles = numpy.concatenate([self.tiles, tile])
+        index = len(self.tiles) - 1
+        self._regions.append((page, x, y, padded_width, padded_height))
+        self._pending.append(index)
+        if key is not None:
+            self._tile_keys[key] = index
+        return index
+
+    def add_materials(self, materials):
+        "Tile index of each material.Material, adding the tiles not yet stored"
+        def tile_image(material):
+            color = numpy.clip(material.diffuse, 0, 1)
+            if material.image is None:
+                return numpy.full((self.color_tile_size, self.color_tile_size, 3), color * 255 + 0.5, dtype=numpy.uint8)
+            return (material.image * color + 0.5).astype(numpy.uint8)
+        keys = [(m.diffuse_texture if m.image is not None else None, m.diffuse) for m in materials]
+        result = numpy.zeros(len(materials), dtype=numpy.int32)
+        # tallest first packs shelves tightly
+        heights = [m.image.shape[0] if m.image is not None else 0 for m in materials]
+        for i in numpy.argsort(heights, kind='stable')[::-1]:
+            if keys[i] in self._tile_keys:
+                result[i] = self._tile_keys[keys[i]]
+            else:
+                result[i] = self.add_image(tile_image(materials[i]), keys[i])
+        return result
+
+    def _place(self, width, height):
+        "(page, x, y) of a free region, on the lowest shelf tall enough, or on a new shelf or page"
+        best = None
+        for page, shelves in enumerate(self._shelves):
+            for shelf in shelves:
+                if shelf[1] >= height and shelf[2] + width <= self.page_size:
+                    if best is None or shelf[1] < best[1][1]:
+                        best = (page, shelf)
+        if best is None:
+            for page, shelves in enumerate(self._shelves):
+                top = shelves[-1][0] + shelves[-1][1] if shelves else 0
+                if top + height <= self.page_size:
+                    shelves.append([top, height, 0])
+                    best = (page, shelves[-1])
+                    break
+        if best is None:
+            self.pages.append(numpy.zeros((self.page_size, self.page_size, 3), dtype=numpy.uint8))
+            self._shelves.append([[0, height, 0]])
+            best = (len(self.pages) - 1, self._shelves[-1][0])
+        page, shelf = best
+        x = shelf[2]
+        shelf[2] += width
+        return page, x, shelf[0]
+
+    def mipmaps(self, page):
+        "Mipmap levels 0 through max_level of one page"
+        levels = [self.pages[page]]
+        for level in range(self.max_level):
+            levels.append(downsample(levels[-1]))
+        return levels
+
+    def gpu_bytes(self):
+        # drivers store RGB8 texels in four bytes
+        return texture_bytes(self.page_size, self.page_size, 4, self.max_level + 1, self._layer_capacity)
+
+    def cpu_bytes(self):
+        return sum(page.nbytes for page in self.pages) + self.tiles.nbytes
+
+    @property
+    def uploaded(self):
+        "Whether every tile is on the GPU"
+        return self.texture is not None and not self._pending
+
+    def init_gl(self):
+        self._users += 1
+        if self.texture is None:
+            self.texture = GL.glGenTextures(1)
+            self._layer_capacity = 0
+            self._pending = list(range(len(self.tiles)))
+
+    def bind(self, unit=0):
+        GL.glActiveTexture(GL.GL_TEXTURE0 + unit)
+        GL.glBindTexture(GL.GL_TEXTURE_2D_ARRAY, self.texture)
+
+    def upload(self):
+        "Upload every pending tile now"
+        self._upload_tiles(None)
+
+    def upload_step(self, budget=None):
+        """
+        Upload pending tiles, with their mipmap levels, as far as the budget (by default
+        loading.gpu_upload_budget) allows; returns True once every tile is on the GPU
+        """
+        return self._upload_tiles(budget if budget is not None else gpu_upload_budget)
+
+    def _upload_tiles(self, budget):
+        if not self._pending:
+            return True
+        target = GL.GL_TEXTURE_2D_ARRAY
+        if len(self.pages) > self._layer_capacity:
+            self._grow(max(len(self.pages), 2 * self._layer_capacity))
+        GL.glBindTexture(target, self.texture)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)  # coarse levels of a tile may have odd widths
+        while self._pending:
+            page, x, y, width, height = self._regions[self._pending[0]]
+            region = self.pages[page][y:y + height, x:x + width]
+            # tiles start and end on multiples of 2**max_level, so their mipmaps match the page's
+            levels = [region]
+            for level in range(self.max_level):
+                levels.append(downsample(levels[-1]))
+            if budget is not None and not budget.try_spend(sum(level.nbytes for level in levels)):
+                break
+            for level, data in enumerate(levels):
+                GL.glTexSubImage3D(target, level, x >> level, y >> level, page,
+                                   data.shape[1], data.shape[0], 1, GL.GL_RGB, GL.GL_UNSIGNED_BYTE,
+                                   numpy.ascontiguousarray(data))
+            self._pending.pop(0)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+        GL.glBindTexture(target, 0)
+        return not self._pending
+
+    def _grow(self, layer_count):
+        "Allocate texture storage with more layers, copying any uploaded ones on the GPU"
+        target = GL.GL_TEXTURE_2D_ARRAY
+        # immutable storage: a texture that already has some is replaced
+        new_texture = GL.glGenTextures(1) if self._layer_capacity > 0 else self.texture
+        GL.glBindTexture(target, new_texture)
+        GL.glTexStorage3D(target, self.max_level + 1, GL.GL_RGB8, self.page_size, self.page_size, layer_count)
+        GL.glTexParameteri(target, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(target, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR_MIPMAP_LINEAR)
+        GL.glTexParameteri(target, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(target, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(target, GL.GL_TEXTURE_MAX_LEVEL, self.max_level)
+        GL.glBindTexture(target, 0)
+        if self._layer_capacity > 0:
+            for level in range(self.max_level + 1):
+                size = self.page_size >> level
+                GL.glCopyImageSubData(
+                        self.texture, target, level, 0, 0, 0,
+                        new_texture, target, level, 0, 0, 0,
+                        size, size, self._layer_capacity)
+            GL.glDeleteTextures([self.texture, ])
+        self.texture = new_texture
+        self._layer_capacity = layer_count
+        gpu_memory_manager.register(self)
+
+    def dispose_gl(self):
+        self._users -= 1
+        if self._users <= 0 and self.texture is not None:
+            gpu_memory_manager.unregister(self)
+            GL.glDeleteTextures([self.texture, ])
+            self.texture = None
+            self._layer_capacity = 0
+            self._users = 0
@@ -5,6 +5,9 @@ from OpenGL.GL.EXT.texture_filter_anisotropic import GL_MAX_TEXTURE_MAX_ANISOTRO
 from PIL import Image
 
 from openvr.glframework import shader_string, shader_substring
+from vrprim.gpu_memory import gpu_memory_manager, mipmap_level_count, texture_bytes
+from vrprim.photosphere.conv import cube_map_from_equirect_texture, cube_tile_size
+from vrprim.photosphere.decode import decode_image_async
 
 
 class BasicShaderComponent(object):
@@ -20,50 +23,143 @@ class BasicShaderComponent(object):
     def vrtx_shader_main_substring(self):
         return ""
 
+    def init_gl(self):
+        pass
+
     def display_gl(self, gl_context=None):
         pass
 
+    def dispose_gl(self):
+        pass
+
 
 class PanoramaRaster(BasicShaderComponent):
-    def __init__(self, img_path=None, texture_unit=0, img_array=None):
-        if img_path and not img_array:
-            img = Image.open(img_path)
-            self.image = numpy.array(img)
+    """
+    Image file loading begins immediately on a background thread;
+    the "image" attribute blocks until decoding has finished.
+    Use max_width to decode large images at reduced resolution.
+    After upload, the texture is registered with the shared GpuMemoryManager,
+    which may release the decoded image and shrink the texture to stay within budget.
+    """
+    equirectangular = False  # reduce images to exactly 2:1 when decoding
+
+    def __init__(self, img_path=None, texture_unit=0, img_array=None, max_width=None):
+        self._image = None
+        self._image_future = None
+        if img_path is not None and img_array is None:
+            self._image_future = decode_image_async(img_path, max_width=max_width,
+                                                    equirectangular=self.equirectangular)
         else:
-            self.image = img_array
+            self._image = img_array
+            self._check_image()
         self.texture_unit = texture_unit
         self.target = GL.GL_TEXTURE_2D
+        self.internal_format = GL.GL_RGB8
         self.texture_handle = None
+        self.texture_size = None  # (width, height) of finest mipmap level, once uploaded
+        self.texture_levels = 0
+
+    @property
+    def image(self):
+        if self._image_future is not None:
+            self._image = self._image_future.result()
+            self._image_future = None
+            self._check_image()
+        return self._image
+
+    @image.setter
+    def image(self, img_array):
+        self._image_future = None
+        self._image = img_array
+
+    def _check_image(self):
+        "Subclasses may verify the dimensions of self._image here"
+        pass
 
-    def _upload_texture(self):
-        GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_S, GL.GL_REPEAT)
-        GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_T, GL.GL_MIRRORED_REPEAT)
+    def _set_texture_parameters(self):
+        GL.glTexParameteri(self.target, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(self.target, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR_MIPMAP_LINEAR)
+        if self.target == GL.GL_TEXTURE_CUBE_MAP:
+            # Always use GL_CLAMP_TO_EDGE with cubemaps
+            GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_R, GL.GL_CLAMP_TO_EDGE)
+        else:
+            GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_S, GL.GL_REPEAT)
+            GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_T, GL.GL_MIRRORED_REPEAT)
         aniso = GL.glGetFloatv(GL_MAX_TEXTURE_MAX_ANISOTROPY_EXT)
-        GL.glTexParameterf(GL.GL_TEXTURE_2D, GL_TEXTURE_MAX_ANISOTROPY_EXT, aniso)
+        GL.glTexParameterf(self.target, GL_TEXTURE_MAX_ANISOTROPY_EXT, aniso)
+
+    def _upload_texture(self):
         GL.glTexImage2D(self.target, 
                      0, 
-                     GL.GL_RGB8,
+                     self.internal_format,
                      self.image.shape[1], # width 
                      self.image.shape[0], # height
                      0,
                      GL.GL_RGB, 
                      GL.GL_UNSIGNED_BYTE, 
                      self.image)        
+        self.texture_size = (self.image.shape[1], self.image.shape[0])
 
     def init_gl(self):
+        if self.texture_handle is not None:
+            return  # already uploaded; one raster may be shared by several panoramas
         self.texture_handle = GL.glGenTextures(1)
         GL.glBindTexture(self.target, self.texture_handle)
-        GL.glTexParameteri(self.target, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
-        GL.glTexParameteri(self.target, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR_MIPMAP_LINEAR)
+        self._set_texture_parameters()
         self._upload_texture()
         GL.glGenerateMipmap(self.target)
         GL.glBindTexture(self.target, 0)
+        self.texture_levels = mipmap_level_count(*self.texture_size)
+        gpu_memory_manager.register(self)
+        if gpu_memory_manager.release_cpu_copies:
+            self.image = None
         
     def display_gl(self):
+        gpu_memory_manager.touch(self)
         GL.glBindTexture(self.target, self.texture_handle)
         
     def dispose_gl(self):
-        GL.glDeleteTextures([self.texture_handle,])            
+        if self.texture_handle is not None:
+            gpu_memory_manager.unregister(self)
+            GL.glDeleteTextures([self.texture_handle,])
+            self.texture_handle = None
+
+    def gpu_bytes(self):
+        if self.texture_handle is None:
+            return 0
+        faces = 6 if self.target == GL.GL_TEXTURE_CUBE_MAP else 1
+        # assume 8-bit RGB textures are padded to four bytes per texel
+        return texture_bytes(self.texture_size[0], self.texture_size[1], 4, self.texture_levels, faces)
+
+    def reduce_gpu_memory(self):
+        """
+        Replace the texture with a copy lacking its finest mipmap level.
+        Returns the number of bytes freed.
+        """
+        if self.texture_handle is None or self.texture_levels < 2:
+            return 0
+        bytes_before = self.gpu_bytes()
+        w, h = self.texture_size
+        faces = 6 if self.target == GL.GL_TEXTURE_CUBE_MAP else 1
+        new_handle = GL.glGenTextures(1)
+        GL.glBindTexture(self.target, new_handle)
+        GL.glTexStorage2D(self.target, self.texture_levels - 1, self.internal_format,
+                          max(1, w // 2), max(1, h // 2))
+        self._set_texture_parameters()
+        # copy the existing coarser mipmap levels, without a round trip to the CPU
+        for level in range(1, self.texture_levels):
+            GL.glCopyImageSubData(
+                    self.texture_handle, self.target, level, 0, 0, 0,
+                    new_handle, self.target, level - 1, 0, 0, 0,
+                    max(1, w >> level), max(1, h >> level), faces)
+        GL.glBindTexture(self.target, 0)
+        GL.glDeleteTextures([self.texture_handle,])
+        self.texture_handle = new_handle
+        self.texture_size = (max(1, w // 2), max(1, h // 2))
+        self.texture_levels -= 1
+        return bytes_before - self.gpu_bytes()
 
     def frag_shader_decl_substring(self):
         """
@@ -92,34 +188,80 @@ class PanoramaRaster(BasicShaderComponent):
         """ % self.texture_unit)
 
 
+def cube_map_frag_shader_decl_substring(texture_unit):
+    "fragment of fragment-shader preamble needed to access pixels from a cube map photosphere"
+    return shader_substring("""
+        layout(binding = %d) uniform samplerCube cubemap_image;
+
+        vec4 color_for_direction(in vec3 d) {
+            return texture(cubemap_image, d);
+        }
+    """ % texture_unit)
+
+
 class EquirectangularRaster(PanoramaRaster):
+    """
+    Spherical panorama raster in 2:1 equirectangular format.
+    If resample_to_cube_map is True, init_gl() converts the image once on the GPU into
+    a cube map texture, so rendering uses the cheaper cube map lookup, and the
+    equirectangular texture is deleted afterwards.
+    """
+    equirectangular = True
+
     def __init__(self, *args, **kwargs):
+        self.resample_to_cube_map = kwargs.pop('resample_to_cube_map', False)
         super(EquirectangularRaster, self).__init__(*args, **kwargs)
+
+    def _check_image(self):
         # Verify 2:1 aspect ratio
-        shp = self.image.shape
+        shp = self._image.shape
         assert(shp[1] == 2 * shp[0])
-    
+
+    def init_gl(self):
+        if self.texture_handle is not None:
+            return
+        # compute cube size before the base class releases the image
+        tile_size = cube_tile_size(self.image.shape[1])
+        super(EquirectangularRaster, self).init_gl()
+        if not self.resample_to_cube_map:
+            return
+        equirect_handle = self.texture_handle
+        max_size = GL.glGetIntegerv(GL.GL_MAX_CUBE_MAP_TEXTURE_SIZE)
+        tile_size = min(tile_size, max_size)
+        self.texture_handle = cube_map_from_equirect_texture(equirect_handle, tile_size)
+        GL.glDeleteTextures([equirect_handle,])
+        self.target = GL.GL_TEXTURE_CUBE_MAP
+        self.internal_format = GL.GL_RGBA8
+        self.texture_size = (tile_size, tile_size)
+        self.texture_levels = mipmap_level_count(tile_size, tile_size)
+        gpu_memory_manager.register(self)  # update size
+        GL.glEnable(GL.GL_TEXTURE_CUBE_MAP_SEAMLESS)
+
+    def frag_shader_decl_substring(self):
+        if self.resample_to_cube_map:
+            return cube_map_frag_shader_decl_substring(self.texture_unit)
+        return super(EquirectangularRaster, self).frag_shader_decl_substring()
+
 
 class CubeMapRaster(PanoramaRaster):
     def __init__(self, *args, **kwargs):
         super(CubeMapRaster, self).__init__(*args, **kwargs)
+        self.target = GL.GL_TEXTURE_CUBE_MAP
+
+    def _check_image(self):
         # Verify 4:3 aspect ratio
-        shp = self.image.shape
+        shp = self._image.shape
         tile = shp[0] / 3
         assert(shp[0] == 3 * tile)
         assert(shp[1] == 4 * tile)
-        self.target = GL.GL_TEXTURE_CUBE_MAP
         
     def init_gl(self):
         super(CubeMapRaster, self).init_gl()
         GL.glEnable(GL.GL_TEXTURE_CUBE_MAP_SEAMLESS)
 
     def _upload_texture(self):
-        # Always use GL_CLAMP_TO_EDGE with cubemaps
-        GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
-        GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
-        GL.glTexParameteri(self.target, GL.GL_TEXTURE_WRAP_R, GL.GL_CLAMP_TO_EDGE)
         sz = int(self.image.shape[0] / 3)
+        self.texture_size = (sz, sz)
         # Extract faces from combined cubemap image
         # a[::, ::-1] flips image array "a" left-right
         face_left = numpy.array(self.image[sz:sz*2, sz*0:sz*1][::, ::-1])
@@ -155,13 +297,7 @@ class CubeMapRaster(PanoramaRaster):
      
     def frag_shader_decl_substring(self):
         "fragment of fragment-shader preamble needed to access pixels from this photosphere"
-        return shader_substring("""
-            layout(binding = %d) uniform samplerCube cubemap_image;
-
-            vec4 color_for_direction(in vec3 d) {
-                return texture(cubemap_image, d);
-            }
-        """ % self.texture_unit)
+        return cube_map_frag_shader_decl_substring(self.texture_unit)
 
 
 class SphericalPanorama(object):
@@ -175,6 +311,7 @@ class SphericalPanorama(object):
         self.vao = GL.glGenVertexArrays(1)
         GL.glBindVertexArray(self.vao)
         self.raster.init_gl()
+        self.proxy_geometry.init_gl()
         # Set up shaders for rendering
         shader_components = [self.raster, self.proxy_geometry]
         decls = ''.join([a.vrtx_shader_decl_substring() for a in shader_components])
@@ -258,6 +395,7 @@ class SphericalPanorama(object):
 
     def dispose_gl(self):
         self.raster.dispose_gl()
+        self.proxy_geometry.dispose_gl()
         if self.vao:
             GL.glDeleteVertexArrays(1, [self.vao,])
         if self.shader:
@@ -387,6 +525,186 @@ class InfinitePlane(BasicShaderComponent):
         """ % ('true' if self.do_anti_alias_horizon else 'false'))
 
 
+def min_max_depth_pyramid(depth, max_levels=16):
+    """
+    Build a list of min/max depth mipmap levels from a 2D equirectangular depth array.
+    Each level is a float32 array of shape (height, width, 2), holding the minimum and
+    maximum depth of the level-zero texels covered by each cell.
+    Levels are added while both dimensions remain even, so each cell covers exactly
+    four cells of the previous level.
+    """
+    depth = numpy.asarray(depth, dtype=numpy.float32)
+    levels = [numpy.stack([depth, depth], axis=-1)]
+    while len(levels) < max_levels:
+        prev = levels[-1]
+        h, w = prev.shape[0:2]
+        if h % 2 != 0 or w % 2 != 0 or h < 2:
+            break
+        blocks = prev.reshape(h // 2, 2, w // 2, 2, 2)
+        min_depth = blocks[..., 0].min(axis=(1, 3))
+        max_depth = blocks[..., 1].max(axis=(1, 3))
+        levels.append(numpy.stack([min_depth, max_depth], axis=-1))
+    return levels
+
+
+class DepthMapProxy(BasicShaderComponent):
+    """
+    Proxy geometry defined by a per-pixel equirectangular depth panorama, measured
+    as distance from the original camera position, in the same orientation as
+    the color raster.
+    View rays are marched through a min/max depth pyramid, skipping large empty
+    regions at coarse levels, so the number of steps grows with the logarithm of
+    the depth map resolution. max_steps caps the per-fragment step count.
+    """
+    def __init__(self, depth_path=None, depth_array=None, depth_scale=1.0,
+                 original_camera_position=(0, 2, 0), max_steps=64, texture_unit=1):
+        if depth_array is None:
+            depth_array = numpy.array(Image.open(depth_path), dtype=numpy.float32)
+        if depth_array.ndim == 3:
+            depth_array = depth_array[..., 0]
+        depth_array = depth_array * depth_scale
+        # Verify 2:1 aspect ratio
+        shp = depth_array.shape
+        assert(shp[1] == 2 * shp[0])
+        self.pyramid = min_max_depth_pyramid(depth_array)
+        self.level_count = len(self.pyramid)
+        self.texture_size = (shp[1], shp[0])
+        self.original_camera_position = original_camera_position
+        self.max_steps = max_steps
+        self.texture_unit = texture_unit
+        self.texture_handle = None
+
+    def init_gl(self):
+        if self.texture_handle is not None:
+            return  # already uploaded, and the pyramid may have been released
+        self.texture_handle = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture_handle)
+        w, h = self.texture_size
+        level_count = self.level_count
+        GL.glTexStorage2D(GL.GL_TEXTURE_2D, level_count, GL.GL_RG32F, w, h)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+        for level, arr in enumerate(self.pyramid):
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, level, 0, 0, arr.shape[1], arr.shape[0],
+                               GL.GL_RG, GL.GL_FLOAT, arr)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAX_LEVEL, level_count - 1)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST_MIPMAP_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        gpu_memory_manager.register(self)
+        if gpu_memory_manager.release_cpu_copies:
+            self.pyramid = None
+
+    def gpu_bytes(self):
+        if self.texture_handle is None:
+            return 0
+        return texture_bytes(self.texture_size[0], self.texture_size[1], 8, self.level_count)
+
+    def display_gl(self, gl_context=None):
+        gpu_memory_manager.touch(self)
+        GL.glActiveTexture(GL.GL_TEXTURE0 + self.texture_unit)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture_handle)
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+        GL.glDepthRange(0, 1)  # Use ordinary depth range
+        GL.glDepthFunc(GL.GL_LEQUAL)
+
+    def dispose_gl(self):
+        if self.texture_handle is not None:
+            gpu_memory_manager.unregister(self)
+            GL.glDeleteTextures([self.texture_handle,])
+            self.texture_handle = None
+
+    def frag_shader_decl_substring(self):
+        c = self.original_camera_position
+        return shader_substring("""
+            layout(binding = %d) uniform sampler2D depth_pyramid;
+            layout(location = 1) uniform mat4 projection = mat4(1);
+            layout(location = 2) uniform mat4 model_view = mat4(1);
+
+            const vec3 original_camera_position = vec3(%f, %f, %f);
+            const int depth_max_steps = %d;
+            const int depth_top_level = %d;
+
+            vec3 depth_map_hit; // ray intersection, relative to original camera position
+            const float DEPTH_EPSILON = 1e-4;
+
+            // Longitude, in range [-PI, PI], and latitude, in range [-PI/2, PI/2], of direction d
+            vec2 depth_lon_lat(in vec3 d) {
+                return vec2(atan(d.x, -d.z), atan(d.y, length(d.xz)));
+            }
+
+            // Equirectangular texture coordinate of a longitude and latitude
+            vec2 depth_tex_coord(in vec2 lon_lat) {
+                const float PI = 3.1415926535897932384626433832795;
+                return vec2(0.5 * lon_lat.x / PI + 0.5, -lon_lat.y / PI + 0.5);
+            }
+
+            // Distance along ray, from q, at which the ray leaves the sphere of radius d
+            float sphere_exit_distance(in vec3 q, in vec3 v, in float d) {
+                float b = dot(q, v);
+                return -b + sqrt(max(0, b*b - dot(q, q) + d*d));
+            }
+
+            // March ray eye + t*v outward through the min/max depth pyramid
+            vec3 trace_depth_map(in vec3 eye, in vec3 v) {
+                const float PI = 3.1415926535897932384626433832795;
+                vec3 q = eye - original_camera_position;
+                if (length(q) < DEPTH_EPSILON) {
+                    // At the original camera position the ray follows a single depth
+                    // map direction, so it hits exactly at the depth stored there.
+                    float depth = textureLod(depth_pyramid, depth_tex_coord(depth_lon_lat(v)), 0).r;
+                    return v * max(depth, DEPTH_EPSILON);
+                }
+                int level = depth_top_level;
+                for (int i = 0; i < depth_max_steps; ++i) {
+                    float r = length(q);
+                    vec2 lon_lat = depth_lon_lat(q);
+                    float longitude = lon_lat.x;
+                    float latitude = lon_lat.y;
+                    vec2 tex_coord = depth_tex_coord(lon_lat);
+                    ivec2 size = textureSize(depth_pyramid, level);
+                    ivec2 cell = clamp(ivec2(tex_coord * size), ivec2(0), size - ivec2(1));
+                    vec2 min_max = texelFetch(depth_pyramid, cell, level).rg;
+                    if (r >= min_max.x) { // ray might have crossed the surface in this cell
+                        if (level == 0)
+                            return q;
+                        // behind the farthest sample? skip straight to the finest level
+                        level = (r >= min_max.y) ? 0 : level - 1;
+                        continue;
+                    }
+                    // Ray is in free space; advance until it leaves either the cell or the sphere of radius min depth
+                    vec2 cell_min = vec2(cell) / size;
+                    vec2 cell_max = vec2(cell + ivec2(1)) / size;
+                    float lon0 = (2.0 * cell_min.x - 1.0) * PI;
+                    float lon1 = (2.0 * cell_max.x - 1.0) * PI;
+                    float lat0 = (0.5 - cell_max.y) * PI;
+                    float lat1 = (0.5 - cell_min.y) * PI;
+                    float dlat = min(latitude - lat0, lat1 - latitude);
+                    float dlon = min(min(longitude - lon0, lon1 - longitude), 0.5 * PI);
+                    // angular distance to nearest cell boundary
+                    float angle = min(dlat, asin(sin(dlon) * cos(latitude)));
+                    float s = min(r * sin(angle), sphere_exit_distance(q, v, min_max.x));
+                    q += (s + 1e-4 * r) * v; // small bias to step across cell boundaries
+                    level = min(level + 1, depth_top_level);
+                }
+                return q; // step budget exhausted
+            }
+
+            vec3 adjusted_view_direction(in vec3 local_view_direction, in vec3 eye_location)
+            {
+                if (dot(depth_map_hit, depth_map_hit) < DEPTH_EPSILON * DEPTH_EPSILON)
+                    return local_view_direction; // degenerate hit has no direction
+                return depth_map_hit;
+            }
+            """ % (self.texture_unit, c[0], c[1], c[2], self.max_steps, self.level_count - 1))
+
+    def frag_shader_main_substring(self):
+        return shader_substring("""
+                depth_map_hit = trace_depth_map(camPos, normalize(viewDir));
+                vec4 depth_map_clip = projection * model_view * vec4(depth_map_hit + original_camera_position, 1);
+                gl_FragDepth = (depth_map_clip.z / depth_map_clip.w + 1.0) / 2.0;
+        """)
+
+
 if __name__ == "__main__":
     # Open equirectangular photosphere
     import os
@@ -397,7 +715,7 @@ if __name__ == "__main__":
     src_folder = os.path.dirname(os.path.abspath(__file__))
     if False:
         img_path = os.path.join(src_folder, '../../../../assets/images/_0010782_stitch2.jpg')
-        raster = EquirectangularRaster(img_path)
+        raster = EquirectangularRaster(img_path, resample_to_cube_map=True)
     else:
         img_path = os.path.join(src_folder, '../../../../assets/images/lauterbrunnen_cube.jpg')
         raster = CubeMapRaster(img_path)
@@ -5,8 +5,6 @@ Convert spherical panorama in equirectangular format into cubemap format
 from math import pi, log2
 
 import numpy
-from libtiff import TIFF
-import png
 import glfw
 from OpenGL import GL
 from OpenGL.GL import shaders
@@ -14,6 +12,30 @@ from OpenGL.GL.EXT.texture_filter_anisotropic import GL_MAX_TEXTURE_MAX_ANISOTRO
 from PIL import Image
 
 
+# GLSL mapping from view direction to equirectangular texture coordinate,
+# shared by the offline Converter and runtime cube map resampling
+EQUIRECT_FROM_XYZ = """
+            const float PI = 3.14159265359;
+
+            vec2 equirect_from_xyz(in vec3 xyz) {
+                float r = length(xyz.xz);
+                float lat = atan(xyz.y, r);
+                float lon = atan(xyz.x, -xyz.z);
+                return 0.5 * (vec2(lon / PI, -2.0 * lat / PI) + vec2(1));
+            }
+"""
+
+
+def cube_tile_size(equirect_width):
+    """
+    Cube face edge length, in pixels, for an equirectangular image of the given width
+    """
+    scale = 4.0 / pi # tan(a)/a [a == 45 degrees] # so cube face center resolution matches equirectangular equator resolution
+    tile_size = int(scale * equirect_width / 4.0)
+    # clip to nearest power of two subtile size
+    return int(pow(2.0, int(log2(tile_size))))
+
+
 class Converter(object):
     def render_scene(self):
         GL.glClear(GL.GL_COLOR_BUFFER_BIT)
@@ -32,12 +54,7 @@ class Converter(object):
         ew = arr.shape[1]
         print(ew, eh)
         # Cubemap has same width, and height *  1.5, right? todo:
-        scale = 4.0 / pi # tan(a)/a [a == 45 degrees] # so cube face center resolution matches equirectangular equator resolution
-        # scale = 1.0
-        # scale *= 1.0 / 4.0 # optional: smaller for faster testing
-        tile_size = int(scale * ew / 4.0)
-        # optional: clip to nearest power of two subtile size
-        tile_size = int(pow(2.0, int(log2(tile_size))))
+        tile_size = cube_tile_size(ew)
         print("tile size = ", tile_size, " pixels")
         cw = 4 * tile_size
         ch = 3 * tile_size
@@ -97,8 +114,7 @@ class Converter(object):
 
             in vec2 tex_coord;
             out vec4 frag_color;
-
-            const float PI = 3.14159265359;
+            %s
 
             vec3 xyz_from_equirect(in vec2 eq) {
                 vec2 c = 2*eq - vec2(1); // centered
@@ -108,13 +124,6 @@ class Converter(object):
                 return vec3(s*sin(lon), sin(lat), -s*cos(lon));
             }
 
-            vec2 equirect_from_xyz(in vec3 xyz) {
-                float r = length(xyz.xz);
-                float lat = atan(xyz.y, r);
-                float lon = atan(xyz.x, -xyz.z);
-                return 0.5 * (vec2(lon / PI, -2.0 * lat / PI) + vec2(1));
-            }
-
             vec3 xyz_from_cube(in vec2 cube) {
                 if (cube.y > 2.0/3.0) { // lower strip
                     if (cube.x < 1.0/4.0) {
@@ -177,7 +186,7 @@ class Converter(object):
                 // frag_color = vec4(tex_coord, 1, 1);
                 // frag_color = vec4(xyz_from_equirect(tex_coord), 1);
             }
-            """, GL.GL_FRAGMENT_SHADER)
+            """ % EQUIRECT_FROM_XYZ, GL.GL_FRAGMENT_SHADER)
         self.shader = shaders.compileProgram(vtx, frg)
         # Bind the input equirectangular image
         equi_tex = GL.glGenTextures(1)
@@ -223,6 +232,122 @@ class Converter(object):
         # raise NotImplementedError()
         return result
 
+def cube_map_from_equirect_texture(equirect_texture, tile_size, internal_format=GL.GL_RGBA8):
+    """
+    Resample an existing equirectangular GL_TEXTURE_2D into a new GL_TEXTURE_CUBE_MAP,
+    using the current OpenGL context. Returns the new cube map texture handle.
+    The caller remains responsible for deleting the equirectangular texture.
+    """
+    vtx = shaders.compileShader("""#version 450
+        #line 243
+
+        out vec2 tex_coord;
+
+        const vec4 SCREEN_QUAD[4] = vec4[4](
+            vec4(-1, -1, 0.5, 1),
+            vec4( 1, -1, 0.5, 1),
+            vec4(-1,  1, 0.5, 1),
+            vec4( 1,  1, 0.5, 1));
+
+        void main() {
+            vec4 c = SCREEN_QUAD[gl_VertexID]; // corner location
+            gl_Position = c;
+            tex_coord = c.xy; // range [-1, 1]
+        }
+        """, GL.GL_VERTEX_SHADER)
+    frg = shaders.compileShader("""#version 450
+        #line 260
+
+        layout(binding=0) uniform sampler2D equirect;
+        layout(location=0) uniform int face = 0; // 0-5 in order +X, -X, +Y, -Y, +Z, -Z
+
+        in vec2 tex_coord;
+        out vec4 frag_color;
+        %s
+
+        // direction for each texel, using the OpenGL cube map face orientation conventions
+        vec3 xyz_from_face(in vec2 st) {
+            float s = st.x;
+            float t = st.y;
+            if (face == 0) return vec3(1, -t, -s);
+            if (face == 1) return vec3(-1, -t, s);
+            if (face == 2) return vec3(s, 1, t);
+            if (face == 3) return vec3(s, -1, -t);
+            if (face == 4) return vec3(s, -t, 1);
+            return vec3(-s, -t, -1);
+        }
+
+        void main() {
+            vec3 xyz = normalize(xyz_from_face(tex_coord));
+            vec2 eq = equirect_from_xyz(xyz);
+            // Use explicit gradients, to avoid seam at lon==PI
+            vec2 dpdx = dFdx(eq);
+            if (dpdx.x > 0.5) dpdx.x -= 1; // use "repeat" wrapping on gradient
+            if (dpdx.x < -0.5) dpdx.x += 1;
+            vec2 dpdy = dFdy(eq);
+            if (dpdy.x > 0.5) dpdy.x -= 1;
+            if (dpdy.x < -0.5) dpdy.x += 1;
+            frag_color = textureGrad(equirect, eq, dpdx, dpdy);
+        }
+        """ % EQUIRECT_FROM_XYZ, GL.GL_FRAGMENT_SHADER)
+    program = shaders.compileProgram(vtx, frg)
+    # Remember state we are about to clobber
+    old_viewport = GL.glGetIntegerv(GL.GL_VIEWPORT)
+    old_draw_framebuffer = GL.glGetIntegerv(GL.GL_DRAW_FRAMEBUFFER_BINDING)
+    old_read_framebuffer = GL.glGetIntegerv(GL.GL_READ_FRAMEBUFFER_BINDING)
+    old_vao = GL.glGetIntegerv(GL.GL_VERTEX_ARRAY_BINDING)
+    old_depth_test = GL.glIsEnabled(GL.GL_DEPTH_TEST)
+    old_blend = GL.glIsEnabled(GL.GL_BLEND)
+    # Allocate the cube map
+    cube_tex = GL.glGenTextures(1)
+    GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, cube_tex)
+    levels = int(log2(tile_size)) + 1
+    GL.glTexStorage2D(GL.GL_TEXTURE_CUBE_MAP, levels, internal_format, tile_size, tile_size)
+    GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+    GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+    GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_R, GL.GL_CLAMP_TO_EDGE)
+    GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+    GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR_MIPMAP_LINEAR)
+    GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, 0)
+    # Render each face from the equirectangular texture
+    vao = GL.glGenVertexArrays(1)
+    GL.glBindVertexArray(vao)
+    fb = GL.glGenFramebuffers(1)
+    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, fb)
+    GL.glDisable(GL.GL_DEPTH_TEST)
+    GL.glDisable(GL.GL_BLEND)
+    GL.glViewport(0, 0, tile_size, tile_size)
+    GL.glUseProgram(program)
+    GL.glActiveTexture(GL.GL_TEXTURE0)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, equirect_texture)
+    for face in range(6):
+        GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0,
+                                  GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X + face, cube_tex, 0)
+        if GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER) != GL.GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("Incomplete cube map framebuffer")
+        GL.glUniform1i(0, face)
+        GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0, 4)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+    GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, cube_tex)
+    GL.glGenerateMipmap(GL.GL_TEXTURE_CUBE_MAP)
+    GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, 0)
+    # clean up
+    GL.glUseProgram(0)
+    GL.glDeleteFramebuffers([fb,])
+    GL.glDeleteVertexArrays(1, [vao,])
+    GL.glDeleteProgram(program)
+    # binding GL_FRAMEBUFFER above replaced both the draw and the read framebuffer
+    GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, old_draw_framebuffer)
+    GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, old_read_framebuffer)
+    GL.glBindVertexArray(old_vao)
+    GL.glViewport(*old_viewport)
+    if old_depth_test:
+        GL.glEnable(GL.GL_DEPTH_TEST)
+    if old_blend:
+        GL.glEnable(GL.GL_BLEND)
+    return cube_tex
+
+
 def to_cube(arr):
     w = arr.shape[0]
     h = arr.shape[1]
@@ -256,6 +381,9 @@ def main(arr):
 
 
 if __name__ == "__main__":
+    from libtiff import TIFF
+    import png
+
     if True:
         tif = TIFF.open('1w180.9.tiff', 'r')
         arr = tif.read_image()
@@ -0,0 +1,53 @@
+"""
+Decode panorama images into numpy arrays, optionally at reduced resolution,
+on background worker threads.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from PIL import Image
+
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # PIL releases the GIL while decoding, so several images decode in parallel
+        _executor = ThreadPoolExecutor(max_workers=4)
+    return _executor
+
+
+def decode_image(img_path, max_width=None, equirectangular=False):
+    """
+    Load an image file (path or file object) into an RGB numpy array of shape (height, width, 3).
+    If max_width is given, larger images are reduced to that width, preserving aspect ratio.
+    With equirectangular=True, reduced images are exactly 2:1, max_width rounded down to even.
+    JPEG images are reduced during decoding, in the DCT domain, which is much faster
+    than decoding at full resolution and resizing afterwards.
+    """
+    img = Image.open(img_path)
+    if max_width is not None and img.size[0] > max_width:
+        w, h = img.size
+        if equirectangular:
+            max_width -= max_width % 2
+            max_height = max_width // 2
+        else:
+            max_height = int(h * max_width / w)
+        # draft() only chooses among 1/2, 1/4, and 1/8 scale, never smaller than requested
+        img.draft('RGB', (max_width, max_height))
+        if img.size != (max_width, max_height):
+            img = img.resize((max_width, max_height), Image.LANCZOS)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return numpy.array(img)
+
+
+def decode_image_async(img_path, max_width=None, equirectangular=False):
+    """
+    Start decoding an image on a worker thread.
+    Returns a concurrent.futures.Future whose result() is the numpy array from decode_image().
+    """
+    return _get_executor().submit(decode_image, img_path, max_width, equirectangular)
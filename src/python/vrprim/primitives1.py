@@ -12,6 +12,7 @@ from openvr.tracked_devices_actor import TrackedDevicesActor
 from vrprim.photosphere import SphericalPanorama, CubeMapRaster, InfiniteBackground, InfinitePlane
 from vrprim.mesh.teapot import TeapotActor
 from vrprim.imposter.sphere import SphereActor
+from vrprim.imposter.sphere.spatial import use_stereo_culling
 
 if __name__ == "__main__":
 
@@ -37,6 +38,7 @@ if __name__ == "__main__":
     ]
     renderer = OpenVrGlRenderer(actors, multisample=4)
     with GlfwApp(renderer, "photosphere test") as glfw_app:
+        use_stereo_culling(renderer)  # cull once per frame, against both eyes
         controllers = TrackedDevicesActor(glfw_app.renderer.poses)
         renderer.append(controllers)
         while not glfw.window_should_close(glfw_app.window):
@@ -0,0 +1,61 @@
+#!/bin/env python
+
+import unittest
+
+from vrprim.gpu_memory import GpuMemoryManager, texture_bytes, mipmap_level_count
+
+
+class FakeTexture(object):
+    def __init__(self, size):
+        self.size = size
+
+    def gpu_bytes(self):
+        return self.size
+
+    def reduce_gpu_memory(self):
+        if self.size <= 1:
+            return 0
+        old_size = self.size
+        self.size //= 4
+        return old_size - self.size
+
+
+class TestGpuMemoryManager(unittest.TestCase):
+    def test_texture_bytes(self):
+        self.assertEqual(mipmap_level_count(4, 2), 3)
+        self.assertEqual(texture_bytes(4, 2, 4, 3), 4 * (8 + 2 + 1))
+        self.assertEqual(texture_bytes(4, 4, 1, 1, faces=6), 96)
+
+    def test_least_recently_displayed_shrinks_first(self):
+        manager = GpuMemoryManager(budget_bytes=100)
+        a = FakeTexture(64)
+        b = FakeTexture(64)
+        manager.register(a)
+        manager.register(b)  # over budget: shrinks a
+        self.assertEqual(a.size, 16)
+        self.assertEqual(b.size, 64)
+        manager.touch(a)
+        c = FakeTexture(64)
+        manager.register(c)  # over budget: shrinks b, now least recent
+        self.assertEqual(b.size, 16)
+        self.assertEqual(manager.used_bytes(), 96)
+        manager.unregister(c)
+        self.assertEqual(manager.used_bytes(), 32)
+
+    def test_cpu_copies_kept_by_default(self):
+        # actors with update methods need their CPU copies, so releasing them is opt-in
+        self.assertFalse(GpuMemoryManager().release_cpu_copies)
+        self.assertTrue(GpuMemoryManager(release_cpu_copies=True).release_cpu_copies)
+
+    def test_footprints(self):
+        manager = GpuMemoryManager()
+        a = FakeTexture(64)
+        a.cpu_bytes = lambda: 10
+        b = FakeTexture(32)
+        manager.register(a)
+        manager.register(b)
+        self.assertEqual(manager.footprints(), [(a, 64, 10), (b, 32, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
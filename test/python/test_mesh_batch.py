@@ -0,0 +1,43 @@
+#!/bin/env python
+
+import unittest
+
+import numpy
+
+from vrprim.mesh.batch import StaticMeshBatch, DRAW_COMMAND_DTYPE
+from vrprim.mesh.mesh_build import VERTEX_FLOATS
+
+
+def random_mesh(rng, vertex_count, triangle_count):
+    vertices = rng.uniform(-1, 1, size=(vertex_count, VERTEX_FLOATS)).astype(numpy.float32)
+    indices = rng.randint(0, vertex_count, size=3 * triangle_count).astype(numpy.uint16)
+    return vertices, indices
+
+
+class TestStaticMeshBatch(unittest.TestCase):
+    def test_command_size(self):
+        self.assertEqual(DRAW_COMMAND_DTYPE.itemsize, 20)
+
+    def test_arenas(self):
+        rng = numpy.random.RandomState(0)
+        meshes = [random_mesh(rng, 10 + 5 * k, 4 + k) for k in range(5)]
+        batch = StaticMeshBatch()
+        for k, (vertices, indices) in enumerate(meshes):
+            model = numpy.identity(4)
+            model[3, 0:3] = k
+            self.assertEqual(batch.add_mesh(vertices, indices, model), k)
+        batch.build()
+        self.assertEqual(batch.draw_count, 5)
+        self.assertEqual(batch.indices.dtype, numpy.uint16)
+        # each draw command reproduces its own mesh triangles
+        for (vertices, indices), command in zip(meshes, batch.commands):
+            first = command['first_index']
+            drawn = batch.indices[first:first + command['count']].astype(numpy.int64) + command['base_vertex']
+            self.assertTrue(numpy.array_equal(batch.vertices[drawn], vertices[indices]))
+        self.assertTrue(numpy.array_equal(batch.transforms['model'][:, 3, 0], numpy.arange(5)))
+        batch.set_model_matrix(2, numpy.diag([2.0, 2.0, 2.0, 1.0]))
+        self.assertTrue(numpy.allclose(batch.transforms['normal'][2], numpy.diag([0.5, 0.5, 0.5, 1.0])))
+
+
+if __name__ == '__main__':
+    unittest.main()
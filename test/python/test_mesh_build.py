@@ -0,0 +1,62 @@
+#!/bin/env python
+
+import io
+import unittest
+
+import numpy
+
+from vrprim.mesh.obj_parser import parse_obj
+from vrprim.mesh.mesh_build import VERTEX_FLOATS, acmr, build_mesh, index_dtype, tipsify, weld_vertices
+
+
+def grid_obj(rows, columns):
+    "OBJ text of a flat grid of quads, without normals"
+    lines = ['v %d %d 0' % (i, j) for i in range(rows) for j in range(columns)]
+    for i in range(rows - 1):
+        for j in range(columns - 1):
+            a = i * columns + j + 1
+            lines.append('f %d %d %d %d' % (a, a + columns, a + columns + 1, a + 1))
+    return '\n'.join(lines) + '\n'
+
+
+class TestMeshBuild(unittest.TestCase):
+    def test_weld(self):
+        corners = numpy.array([[0, 1], [2, 3], [0, 1], [-0.0, 1]], dtype=numpy.float32)
+        vertices, indices = weld_vertices(corners)
+        self.assertEqual(len(vertices), 2)
+        self.assertTrue(numpy.array_equal(vertices[indices], numpy.abs(corners)))
+
+    def test_split_normals(self):
+        # two triangles sharing an edge, with different normals
+        obj = ('v 0 0 0\nv 1 0 0\nv 0 1 0\nv 0 0 1\nvn 0 0 1\nvn 1 0 0\n'
+               'f 1//1 2//1 3//1\nf 1//2 3//2 4//2\n')
+        buffers = build_mesh(parse_obj(io.StringIO(obj)))
+        self.assertEqual(buffers.vertices.shape, (6, VERTEX_FLOATS))  # no material column without materials
+        normals = buffers.vertices[buffers.indices.astype(numpy.int64), 3:6].reshape(2, 3, 3)
+        self.assertEqual(len(numpy.unique(normals.reshape(-1, 3), axis=0)), 2)
+
+    def test_index_dtype(self):
+        self.assertEqual(index_dtype(65536), numpy.uint16)
+        self.assertEqual(index_dtype(65537), numpy.uint32)
+
+    def test_reorder(self):
+        mesh = parse_obj(io.StringIO(grid_obj(40, 40)))
+        buffers = build_mesh(mesh, lod_fractions=())
+        self.assertEqual(len(buffers.vertices), 40 * 40)
+        self.assertEqual(len(buffers.indices), len(mesh.triangle_positions) * 3)
+        self.assertLess(buffers.acmr_after, buffers.acmr_before)
+        self.assertAlmostEqual(buffers.acmr_after, acmr(buffers.indices))
+        # every triangle is kept, with its corners in the same winding
+        before = mesh.positions[mesh.triangle_positions].reshape(-1, 9)
+        triangles = buffers.indices.astype(numpy.int64).reshape(-1, 3)
+        after = buffers.vertices[triangles, 0:3].reshape(-1, 9)
+        self.assertTrue(numpy.array_equal(before[numpy.lexsort(before.T)], after[numpy.lexsort(after.T)]))
+
+    def test_tipsify_permutation(self):
+        indices = numpy.random.RandomState(0).randint(0, 50, size=300)
+        order = tipsify(indices, 50)
+        self.assertTrue(numpy.array_equal(numpy.sort(order), numpy.arange(100)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from vrprim.mesh.mesh_build import concatenate_levels
+from vrprim.mesh.mesh_cache import (MESH_CACHE_HEADER, cache_path, load_mesh_cache,
+                                    user_cache_directory, write_mesh_cache)
+
+
+class TestMeshCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'quad.obj')
+        with open(self.source, 'w') as fh:
+            fh.write('v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3 4\n')
+        self.vertices = numpy.arange(24, dtype=numpy.float32).reshape(4, 6)
+        self.indices = numpy.array([0, 1, 2, 0, 2, 3], dtype=numpy.uint16)
+        self.environment = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(self.folder, 'user')})
+        self.environment.start()
+
+    def tearDown(self):
+        self.environment.stop()
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        self.assertIsNone(load_mesh_cache(self.source))
+        path = write_mesh_cache(self.source, self.vertices, self.indices)
+        self.assertEqual(path, cache_path(self.source))
+        self.assertEqual(os.path.dirname(path), user_cache_directory())
+        vertices, indices, levels, material_names, material_libraries = load_mesh_cache(self.source)
+        self.assertIsInstance(vertices, numpy.memmap)
+        self.assertTrue(numpy.array_equal(vertices, self.vertices))
+        self.assertTrue(numpy.array_equal(indices, self.indices))
+        self.assertEqual(indices.dtype, numpy.uint16)
+        self.assertEqual(len(levels), 1)
+        self.assertEqual(levels[0]['index_count'], len(self.indices))
+        self.assertEqual(material_names, [])
+
+    def test_materials(self):
+        write_mesh_cache(self.source, self.vertices, self.indices,
+                         material_names=['brick', u'\u00e9rable'], material_libraries=['scene.mtl'])
+        vertices, indices, levels, material_names, material_libraries = load_mesh_cache(self.source)
+        self.assertEqual(material_names, ['brick', u'\u00e9rable'])
+        self.assertEqual(material_libraries, ['scene.mtl'])
+        self.assertTrue(numpy.array_equal(vertices, self.vertices))
+
+    def test_levels(self):
+        levels = concatenate_levels([(self.vertices, self.indices, 0.0),
+                                     (self.vertices[0:3], self.indices[0:3], 0.5)])[2]
+        write_mesh_cache(self.source, self.vertices, self.indices, levels=levels)
+        self.assertIsNone(load_mesh_cache(self.source, lod=True))  # written without lod=True
+        write_mesh_cache(self.source, self.vertices, self.indices, levels=levels, lod=True)
+        self.assertTrue(numpy.array_equal(load_mesh_cache(self.source, lod=True)[2], levels))
+        self.assertTrue(numpy.array_equal(load_mesh_cache(self.source)[2], levels))
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.folder, 'cache')
+        path = write_mesh_cache(self.source, self.vertices, self.indices, cache_dir=cache_dir)
+        self.assertEqual(os.path.dirname(path), cache_dir)
+        self.assertIsNone(load_mesh_cache(self.source))
+        self.assertIsNotNone(load_mesh_cache(self.source, cache_dir=cache_dir))
+
+    def test_next_to_source(self):
+        path = write_mesh_cache(self.source, self.vertices, self.indices, next_to_source=True)
+        self.assertEqual(path, self.source + '.vrmesh')
+        self.assertIsNone(load_mesh_cache(self.source))
+        self.assertIsNotNone(load_mesh_cache(self.source, next_to_source=True))
+
+    def test_source_changed(self):
+        write_mesh_cache(self.source, self.vertices, self.indices)
+        with open(self.source, 'a') as fh:
+            fh.write('f 1 3 4\n')
+        self.assertIsNone(load_mesh_cache(self.source))
+
+    def test_same_content_new_mtime(self):
+        write_mesh_cache(self.source, self.vertices, self.indices)
+        stat = os.stat(self.source)
+        os.utime(self.source, (stat.st_atime, stat.st_mtime + 100))
+        self.assertIsNotNone(load_mesh_cache(self.source))
+        # the new mtime is recorded, so the next load does not hash the source
+        header = numpy.fromfile(cache_path(self.source), dtype=MESH_CACHE_HEADER, count=1)[0]
+        self.assertEqual(header['source_mtime'], os.stat(self.source).st_mtime)
+        with mock.patch('vrprim.mesh.mesh_cache.file_sha1') as file_sha1:
+            self.assertIsNotNone(load_mesh_cache(self.source))
+            self.assertFalse(file_sha1.called)
+        # same size and new mtime, but different content
+        with open(self.source, 'r+') as fh:
+            fh.write('v 2')
+        os.utime(self.source, (stat.st_atime, stat.st_mtime + 200))
+        self.assertIsNone(load_mesh_cache(self.source))
+
+
+if __name__ == '__main__':
+    unittest.main()
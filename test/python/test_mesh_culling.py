@@ -0,0 +1,121 @@
+#!/bin/env python
+
+import unittest
+
+import numpy
+
+from vrprim.imposter.sphere.spatial import StereoCullViews
+from vrprim.mesh.culling import (CullingGroup, enclosing_bounds, near_distance,
+                                 transform_boxes, transform_spheres)
+
+
+def perspective(fov_y_degrees, aspect, n, f):
+    t = n * numpy.tan(numpy.radians(fov_y_degrees) / 2.0)
+    r = aspect * t
+    return numpy.array(
+            [[n/r, 0.0, 0.0, 0.0],
+            [0.0, n/t, 0.0, 0.0],
+            [0.0, 0.0, -(f+n)/(f-n), -1.0],
+            [0.0, 0.0, -2.0*f*n/(f-n), 0.0]])
+
+
+def random_affine(rng):
+    m = numpy.identity(4)
+    rotation, r = numpy.linalg.qr(rng.normal(size=(3, 3)))
+    m[0:3, 0:3] = rotation.dot(numpy.diag(rng.uniform(0.5, 2.0, 3))).dot(rotation.T)
+    m[3, 0:3] = rng.uniform(-5, 5, 3)
+    return m
+
+
+class BoundedActor(object):
+    def __init__(self, center, radius, ready=True):
+        self.center = numpy.asarray(center, dtype=numpy.float64)
+        self.radius = radius
+        self.ready = ready
+
+    def bounding_sphere(self):
+        return self.center, self.radius
+
+    def bounding_box(self):
+        return self.center - self.radius, self.center + self.radius
+
+
+class TestMeshCulling(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.points = rng.uniform(-1, 1, size=(200, 3))
+        self.matrices = numpy.array([random_affine(rng) for i in range(10)])
+
+    def test_transformed_bounds_contain_points(self):
+        box_min, box_max = transform_boxes(self.points.min(axis=0), self.points.max(axis=0), self.matrices)
+        center = 0.5 * (self.points.min(axis=0) + self.points.max(axis=0))
+        radius = numpy.linalg.norm(self.points - center, axis=1).max()
+        centers, radii = transform_spheres(center, radius, self.matrices)
+        for i, m in enumerate(self.matrices):
+            world = numpy.c_[self.points, numpy.ones(len(self.points))].dot(m)[:, 0:3]
+            self.assertTrue(numpy.all(world >= box_min[i] - 1e-9))
+            self.assertTrue(numpy.all(world <= box_max[i] + 1e-9))
+            self.assertLessEqual(numpy.linalg.norm(world - centers[i], axis=1).max(), radii[i] + 1e-9)
+        (low, high), (c, r) = enclosing_bounds(box_min, box_max, centers, radii)
+        self.assertTrue(numpy.all(low <= box_min.min(axis=0)))
+        self.assertLessEqual((numpy.linalg.norm(centers - c, axis=1) + radii).max(), r + 1e-9)
+        self.assertLessEqual(numpy.linalg.norm(box_max - c, axis=1).max(), r + 1e-9)
+
+    def test_stereo_cull(self):
+        projection = perspective(60.0, 1.0, 0.1, 100.0)
+        self.assertAlmostEqual(near_distance(projection), 0.1)
+        views = []
+        for eye_x in (-0.5, 0.5):
+            model_view = numpy.identity(4)
+            model_view[3, 0] = -eye_x
+            views.append(model_view.dot(projection))
+        group = CullingGroup([
+            BoundedActor([0, 0, -5], 0.5),  # in front of both eyes
+            BoundedActor([0, 0, 5], 0.5),  # behind
+            BoundedActor([3.6, 0, -5], 0.3),  # seen only by the right eye
+            BoundedActor([0, 0, 5], 0.5, ready=False),  # still loading, so always drawn
+        ])
+        self.assertEqual(group.cull(views[0:1]).tolist(), [True, False, False, True])
+        self.assertEqual(group.cull(views).tolist(), [True, False, True, True])
+
+    def test_cull_views_each_frame(self):
+        projection = perspective(60.0, 1.0, 0.1, 100.0)
+        model_view = numpy.identity(4)
+        actors = [BoundedActor([0, 0, -5], 0.5), BoundedActor([0, 0, -10], 0.5)]
+        for actor in actors:
+            actor.display_gl = lambda model_view, projection: None
+        group = CullingGroup(actors)
+        group.set_cull_views([model_view.dot(projection)] * 2)  # set once, for two eyes
+        for frame in range(3):
+            if frame == 2:
+                actors[1].center = numpy.array([0.0, 0.0, 5.0])  # moved behind the viewer
+            for eye in range(2):
+                group.display_gl(model_view, projection)
+            self.assertEqual(group.drawn_count, 4 if frame < 2 else 2)
+            self.assertEqual(group.frustum_culled_count, 0 if frame < 2 else 2)
+
+    def test_stereo_cull_views(self):
+        projection = perspective(60.0, 1.0, 0.1, 100.0)
+        eye_views = [numpy.identity(4), numpy.identity(4)]
+        eye_views[0][3, 0] = 0.5  # head to left eye
+        eye_views[1][3, 0] = -0.5
+        drawn = []
+        actors = [BoundedActor([0, 0, -5], 0.5), BoundedActor([3.6, 0, -5], 0.3)]  # right eye only
+        for i, actor in enumerate(actors):
+            actor.display_gl = lambda model_view, projection, i=i: drawn.append(i)
+        group = CullingGroup(actors)
+        group.set_cull_views(StereoCullViews(eye_views, [projection, projection]))
+        for eye_view in eye_views:  # head at the origin
+            group.display_gl(eye_view, projection)
+        self.assertEqual(sorted(drawn), [0, 0, 1, 1])  # drawn in both eyes
+        del drawn[:]
+        head = numpy.identity(4)
+        head[3, 0] = 10.0  # everything is now far right of both eyes
+        for eye_view in eye_views:
+            group.display_gl(head.dot(eye_view), projection)
+        self.assertEqual(drawn, [])
+        self.assertEqual(group.frustum_culled_count, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/bin/env python
+
+import unittest
+
+import numpy
+
+from vrprim.mesh.mesh_build import MATERIAL_VERTEX_FLOATS, VERTEX_FLOATS, concatenate_levels
+from vrprim.mesh.mesh_data import MeshData, MATERIAL_MESH_VERTEX_DTYPE, MESH_VERTEX_DTYPE
+
+
+class TestMeshData(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.rows = rng.uniform(-1, 1, size=(20, VERTEX_FLOATS)).astype(numpy.float32)
+        self.indices = rng.randint(0, 20, size=30).astype(numpy.uint16)
+
+    def test_layout(self):
+        self.assertEqual(MESH_VERTEX_DTYPE.itemsize, 4 * VERTEX_FLOATS)
+        self.assertEqual(MATERIAL_MESH_VERTEX_DTYPE.itemsize, 4 * MATERIAL_VERTEX_FLOATS)
+        mesh = MeshData(self.rows, self.indices)
+        self.assertTrue(numpy.shares_memory(mesh.vertices, self.rows))
+        self.assertFalse(mesh.has_materials)
+        self.assertTrue(numpy.array_equal(mesh.vertices['normal'], self.rows[:, 3:6]))
+        self.assertTrue(numpy.array_equal(mesh.triangles, self.indices.reshape(-1, 3)))
+        rows = numpy.c_[self.rows, numpy.arange(20, dtype=numpy.float32)]
+        mesh = MeshData(rows, self.indices)
+        self.assertTrue(mesh.has_materials)
+        self.assertTrue(numpy.array_equal(mesh.vertices['material'], numpy.arange(20)))
+        self.assertEqual(mesh.gpu_bytes(), rows.nbytes + self.indices.nbytes)
+
+    def test_bounds(self):
+        mesh = MeshData(self.rows, self.indices)
+        self.assertTrue(numpy.array_equal(mesh.bounds[0], self.rows[:, 0:3].min(axis=0)))
+        distance = numpy.linalg.norm(self.rows[:, 0:3] - mesh.bounding_center, axis=1)
+        self.assertAlmostEqual(distance.max(), mesh.bounding_radius, places=5)
+        self.assertLessEqual(distance.max(), mesh.bounding_radius)
+
+    def test_levels(self):
+        rows, indices, levels = concatenate_levels([(self.rows, self.indices, 0.0),
+                                                    (self.rows[0:5], self.indices[0:3] % 5, 0.1)])
+        mesh = MeshData(rows, indices, levels)
+        self.assertEqual(len(mesh.positions), 20)
+        vertices, indices = mesh.level_arrays(1)
+        self.assertTrue(numpy.array_equal(vertices['position'], self.rows[0:5, 0:3]))
+        self.assertEqual(len(indices), 3)
+        self.assertTrue(numpy.array_equal(mesh.levels[1]['box_max'], self.rows[0:5, 0:3].max(axis=0)))
+
+    def test_release(self):
+        mesh = MeshData(self.rows, self.indices)
+        self.assertEqual(mesh.cpu_bytes(), self.rows.nbytes + self.indices.nbytes
+                         + mesh.levels.nbytes)
+        gpu_bytes = mesh.gpu_bytes()
+        self.assertEqual(gpu_bytes, self.rows.nbytes + self.indices.nbytes)
+        mesh.release_cpu_copies()
+        self.assertIsNone(mesh.positions)
+        self.assertLess(mesh.cpu_bytes(), 200)
+        self.assertEqual(mesh.gpu_bytes(), gpu_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+#!/bin/env python
+
+import unittest
+
+import numpy
+
+from vrprim.mesh.instanced import instance_array, INSTANCE_DTYPE
+
+
+class TestInstanceArray(unittest.TestCase):
+    def test_layout(self):
+        self.assertEqual(INSTANCE_DTYPE.itemsize, (16 + 9) * 4)
+
+    def test_normal_matrix(self):
+        rng = numpy.random.RandomState(0)
+        model = numpy.zeros((5, 4, 4))
+        model[:, 0:3, 0:3] = rng.uniform(-1, 1, size=(5, 3, 3))  # rotation, scale and shear
+        model[:, 3, :] = (1, 2, 3, 1)  # row vector translation
+        instances = instance_array(model)
+        self.assertTrue(numpy.allclose(instances['model'], model))
+        # transformed normals stay perpendicular to transformed tangents
+        tangent = numpy.array([1.0, -1.0, 0.0])
+        normal = numpy.array([1.0, 1.0, 0.0])
+        for m, n in zip(instances['model'], instances['normal']):
+            # the shader sees the transpose of each row-major matrix, so n acts on the right
+            self.assertAlmostEqual(tangent.dot(m[0:3, 0:3]).dot(normal.dot(n)), 0, places=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
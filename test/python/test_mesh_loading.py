@@ -0,0 +1,76 @@
+#!/bin/env python
+
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy
+
+from vrprim.mesh.loading import UploadBudget, load_obj_buffers, load_obj_buffers_async
+from vrprim.mesh.teapot import ObjActor
+from test_mesh_simplify import sphere_obj
+
+
+class TestMeshLoading(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'quad.obj')
+        with open(self.source, 'w') as fh:
+            fh.write('v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3 4\n')
+        self.environment = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(self.folder, 'cache')})
+        self.environment.start()
+
+    def tearDown(self):
+        self.environment.stop()
+        shutil.rmtree(self.folder)
+
+    def test_async_matches_sync(self):
+        future = load_obj_buffers_async(obj_path=self.source)
+        buffers = future.result(timeout=30)
+        self.assertFalse(buffers.loaded_from_cache)
+        cached = load_obj_buffers(obj_path=self.source)
+        self.assertTrue(cached.loaded_from_cache)
+        self.assertTrue(numpy.array_equal(cached.vertices, buffers.vertices))
+        self.assertTrue(numpy.array_equal(cached.indices, buffers.indices))
+
+    def test_lod_cache(self):
+        with open(self.source, 'w') as fh:
+            fh.write(sphere_obj(rows=20, columns=40))
+        plain = load_obj_buffers(obj_path=self.source)
+        self.assertEqual(len(plain.levels), 1)
+        self.assertTrue(load_obj_buffers(obj_path=self.source).loaded_from_cache)
+        lod = load_obj_buffers(obj_path=self.source, lod=True)
+        self.assertFalse(lod.loaded_from_cache)  # the cached buffers had no coarser levels
+        self.assertGreater(len(lod.levels), 1)
+        cached = load_obj_buffers(obj_path=self.source, lod=True)
+        self.assertTrue(cached.loaded_from_cache)
+        self.assertTrue(numpy.array_equal(cached.levels, lod.levels))
+        self.assertTrue(numpy.array_equal(cached.indices, lod.indices))
+        self.assertTrue(load_obj_buffers(obj_path=self.source).loaded_from_cache)  # levels serve plain loads
+
+    def test_async_load_error(self):
+        actor = ObjActor(obj_path=os.path.join(self.folder, 'missing.obj'), asynchronous=True)
+        concurrent.futures.wait([actor._load_future, ], timeout=30)
+        for frame in range(3):
+            actor.display_gl(numpy.identity(4), numpy.identity(4))  # skips drawing, without raising
+        self.assertIsInstance(actor.load_error, (IOError, OSError))
+        self.assertFalse(actor.ready)
+        self.assertIsNone(actor.vao)
+
+    def test_budget(self):
+        budget = UploadBudget(bytes_per_frame=1000, frame_seconds=60.0)
+        self.assertTrue(budget.try_spend(600))
+        self.assertTrue(budget.try_spend(600))  # may overdraw once
+        self.assertFalse(budget.try_spend(1))
+        budget = UploadBudget(bytes_per_frame=1000, frame_seconds=0.001)
+        self.assertTrue(budget.try_spend(5000))
+        time.sleep(0.01)
+        self.assertTrue(budget.try_spend(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+from PIL import Image
+
+from vrprim.mesh.loading import UploadBudget, load_obj_buffers
+from vrprim.mesh.material import Material, parse_mtl
+from vrprim.mesh.texture_atlas import TextureAtlas
+
+
+class TestMaterials(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'quads.obj')
+        with open(self.source, 'w') as fh:
+            fh.write('mtllib quads.mtl\n'
+                     'v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nv 2 0 0\nv 2 1 0\n'
+                     'vt 0 0\nvt 1 0\nvt 1 1\nvt 0 1\n'
+                     'usemtl checker\nf 1/1 2/2 3/3 4/4\n'
+                     'usemtl red\nf 2/1 5/2 6/3 3/4\n')
+        with open(os.path.join(self.folder, 'quads.mtl'), 'w') as fh:
+            fh.write('newmtl checker\nKd 1 1 1\nmap_Kd -s 1 1 1 textures\\checker.png\n'
+                     'newmtl red\nKd 1 0 0\n')
+        os.mkdir(os.path.join(self.folder, 'textures'))
+        self.checker = numpy.zeros((8, 16, 3), dtype=numpy.uint8)
+        self.checker[0:4, 0:8] = 255
+        Image.fromarray(self.checker).save(os.path.join(self.folder, 'textures', 'checker.png'))
+        self.environment = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(self.folder, 'cache')})
+        self.environment.start()
+
+    def tearDown(self):
+        self.environment.stop()
+        shutil.rmtree(self.folder)
+
+    def test_parse_mtl(self):
+        materials = parse_mtl(os.path.join(self.folder, 'quads.mtl'))
+        self.assertEqual(sorted(materials), ['checker', 'red'])
+        self.assertEqual(materials['red'].diffuse, (1.0, 0.0, 0.0))
+        self.assertIsNone(materials['red'].diffuse_texture)
+        self.assertTrue(os.path.isfile(materials['checker'].diffuse_texture))
+
+    def test_load(self):
+        for loaded_from_cache in (False, True):
+            buffers = load_obj_buffers(obj_path=self.source, materials=True)
+            self.assertEqual(buffers.loaded_from_cache, loaded_from_cache)
+            self.assertEqual(buffers.material_names, ['checker', 'red'])
+            self.assertTrue(numpy.array_equal(buffers.materials[0].image, self.checker))
+            self.assertIsNone(buffers.materials[1].image)
+            full = buffers.levels[0]
+            materials = buffers.vertices[0:full['vertex_count'], 8]
+            # the two shared corners are split by material
+            self.assertEqual(len(materials), 8)
+            self.assertEqual(sorted(set(materials.tolist())), [0.0, 1.0])
+
+    def test_atlas(self):
+        atlas = TextureAtlas(page_size=64, gutter=4)
+        checker = Material('checker', diffuse=(1, 1, 1), diffuse_texture='checker.png')
+        checker.image = self.checker
+        red = Material('red', diffuse=(1, 0, 0))
+        tiles = atlas.add_materials([red, checker, red])
+        self.assertEqual(tiles[0], tiles[2])
+        self.assertEqual(len(atlas.tiles), 2)
+        x, y, w, h = (atlas.tiles[tiles[1]]['rect'] * atlas.page_size).round().astype(int)
+        self.assertEqual((w, h), (16, 8))
+        self.assertEqual((x % atlas.gutter, y % atlas.gutter), (0, 0))
+        page = atlas.pages[int(atlas.tiles[tiles[1]]['layer'])]
+        # stored bottom row first, with a wrapped gutter
+        self.assertTrue(numpy.array_equal(page[y:y + h, x:x + w], self.checker[::-1]))
+        self.assertTrue(numpy.array_equal(page[y - 1, x:x + w], self.checker[0]))
+        self.assertTrue(numpy.array_equal(page[y:y + h, x + w], self.checker[::-1, 0]))
+        x, y, w, h = (atlas.tiles[tiles[0]]['rect'] * atlas.page_size).round().astype(int)
+        self.assertTrue(numpy.all(page[y:y + h, x:x + w] == [255, 0, 0]))
+        self.assertEqual([level.shape[0] for level in atlas.mipmaps(0)], [64, 32, 16])
+
+    def test_atlas_pages(self):
+        atlas = TextureAtlas(page_size=32, gutter=4)
+        images = [numpy.full((20, 20, 3), i, dtype=numpy.uint8) for i in range(3)]
+        tiles = [atlas.add_image(image) for image in images]
+        self.assertEqual(len(atlas.pages), 3)
+        self.assertEqual(atlas.tiles['layer'][tiles].tolist(), [0, 1, 2])
+        big = atlas.add_image(numpy.zeros((100, 50, 3), dtype=numpy.uint8))
+        self.assertLessEqual(atlas.tiles[big]['rect'][3] * atlas.page_size, atlas.max_tile_size)
+
+    def test_atlas_upload_budget(self):
+        atlas = TextureAtlas(page_size=32, gutter=4)
+        for i in range(3):
+            atlas.add_image(numpy.full((20, 20, 3), i, dtype=numpy.uint8))  # one page each
+        with mock.patch('vrprim.mesh.texture_atlas.GL') as gl:
+            gl.glGenTextures.side_effect = [1, 2]
+            atlas.init_gl()
+            budget = UploadBudget(bytes_per_frame=1000, frame_seconds=60.0)
+            self.assertFalse(atlas.upload_step(budget))  # a tile overdraws the budget, once
+            self.assertEqual(gl.glTexStorage3D.call_count, 1)
+            self.assertEqual(gl.glTexSubImage3D.call_count, atlas.max_level + 1)
+            self.assertEqual(gl.glTexSubImage3D.call_args_list[0][0][0:8], (gl.GL_TEXTURE_2D_ARRAY, 0, 0, 0, 0, 28, 28, 1))
+            self.assertFalse(atlas.upload_step(budget))
+            self.assertFalse(atlas.uploaded)
+            atlas.add_image(numpy.zeros((20, 20, 3), dtype=numpy.uint8))
+            atlas.upload()
+            self.assertTrue(atlas.uploaded)
+            # the fourth page grows the texture, copying the uploaded layers instead of sending them again
+            self.assertEqual(gl.glTexSubImage3D.call_count, 4 * (atlas.max_level + 1))
+            self.assertEqual(gl.glCopyImageSubData.call_count, atlas.max_level + 1)
+            self.assertEqual(atlas.texture, 2)
+            self.assertEqual(atlas.gpu_bytes(), 6 * 4 * (32 * 32 + 16 * 16 + 8 * 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
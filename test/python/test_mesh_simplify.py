@@ -0,0 +1,82 @@
+#!/bin/env python
+
+import io
+import unittest
+
+import numpy
+
+from vrprim.mesh.mesh_build import build_mesh
+from vrprim.mesh.obj_parser import parse_obj
+from vrprim.mesh.simplify import _cluster_triangles, simplify
+from vrprim.mesh.teapot import select_lod_level
+
+
+def sphere_obj(rows=40, columns=80):
+    "OBJ text of a closed unit UV sphere"
+    theta = numpy.linspace(0, numpy.pi, rows + 1)[1:-1]
+    phi = numpy.linspace(0, 2 * numpy.pi, columns, endpoint=False)
+    t, p = numpy.meshgrid(theta, phi, indexing='ij')
+    points = numpy.stack([numpy.sin(t) * numpy.cos(p), numpy.sin(t) * numpy.sin(p), numpy.cos(t)], axis=-1)
+    lines = ['v 0 0 1'] + ['v %f %f %f' % tuple(x) for x in points.reshape(-1, 3)] + ['v 0 0 -1']
+    bottom = len(points.reshape(-1, 3)) + 2
+
+    def ring(i, j):
+        return 2 + i * columns + j % columns
+    for j in range(columns):
+        lines.append('f 1 %d %d' % (ring(0, j), ring(0, j + 1)))
+        lines.append('f %d %d %d' % (bottom, ring(rows - 2, j + 1), ring(rows - 2, j)))
+        for i in range(rows - 2):
+            lines.append('f %d %d %d %d' % (ring(i, j), ring(i + 1, j), ring(i + 1, j + 1), ring(i, j + 1)))
+    return '\n'.join(lines) + '\n'
+
+
+class TestSimplify(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.buffers = build_mesh(parse_obj(io.StringIO(sphere_obj())))
+
+    def test_levels(self):
+        levels = self.buffers.levels
+        self.assertGreater(len(levels), 2)
+        triangles = levels['index_count'].astype(numpy.int64) // 3
+        self.assertTrue(numpy.all(numpy.diff(triangles) < 0))
+        self.assertTrue(numpy.all(numpy.diff(levels['error']) >= 0))
+        self.assertEqual(levels['error'][0], 0)
+        for level in levels:
+            indices = self.buffers.indices[level['first_index']:level['first_index'] + level['index_count']]
+            self.assertLess(indices.max(), level['vertex_count'])
+
+    def test_shape_kept(self):
+        full = self.buffers.levels[0]
+        vertices = self.buffers.vertices[0:full['vertex_count']]
+        indices = self.buffers.indices[0:full['index_count']]
+        target = len(indices) // 3 // 4
+        simple_vertices, simple_indices, error = simplify(vertices, indices, target)
+        self.assertLessEqual(len(simple_indices) // 3, target)
+        self.assertGreater(len(simple_indices) // 3, target // 2)
+        radius = numpy.linalg.norm(simple_vertices[:, 0:3], axis=1)
+        self.assertTrue(numpy.all(numpy.abs(radius - 1) <= error + 1e-6))
+        self.assertLess(error, 0.25)
+
+    def test_cluster_triangles(self):
+        # cluster indices in the millions, where packing a triangle into one int64 overflows
+        cluster = numpy.array([5000000, 4999999, 7, 4000000, 3000000, 7], dtype=numpy.int64)
+        indices = numpy.array([0, 1, 2, 2, 1, 0, 0, 1, 3, 0, 1, 4, 2, 5, 3])
+        triangles = _cluster_triangles(cluster, indices)
+        # the reversed duplicate of the first triangle and the collapsed last one are dropped
+        self.assertEqual(triangles.tolist(), [[5000000, 4999999, 7], [5000000, 4999999, 4000000],
+                                              [5000000, 4999999, 3000000]])
+
+    def test_hysteresis(self):
+        errors = numpy.array([0.0, 1.0, 2.0, 4.0])
+        self.assertEqual(select_lod_level(errors, 10.0, 0), 0)
+        self.assertEqual(select_lod_level(errors, 0.6, 0), 1)
+        self.assertEqual(select_lod_level(errors, 0.1, 0), 3)
+        # just past the threshold in either direction, the level stays
+        self.assertEqual(select_lod_level(errors, 0.9, 0, pixel_error=1.0, hysteresis=0.25), 0)
+        self.assertEqual(select_lod_level(errors, 1.1, 1, pixel_error=1.0, hysteresis=0.25), 1)
+        self.assertEqual(select_lod_level(errors, 1.3, 1, pixel_error=1.0, hysteresis=0.25), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
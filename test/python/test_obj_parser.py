@@ -0,0 +1,67 @@
+#!/bin/env python
+
+import io
+import os
+import unittest
+
+import numpy
+
+import vrprim.mesh
+from vrprim.mesh.obj_parser import parse_obj, fan_triangles
+
+
+class TestObjParser(unittest.TestCase):
+    def test_teapot(self):
+        obj_path = os.path.join(os.path.dirname(vrprim.mesh.__file__), 'wt_teapot.obj')
+        mesh = parse_obj(obj_path)
+        self.assertEqual(mesh.positions.shape, (1292, 3))
+        self.assertEqual(mesh.normals.shape, (1289, 3))
+        self.assertEqual(mesh.triangle_positions.shape, (2464, 3))
+        self.assertTrue(numpy.all(mesh.triangle_texcoords == -1))
+        self.assertAlmostEqual(mesh.positions[0, 0], -0.498530)
+        self.assertEqual(mesh.triangle_positions[0].tolist(), [33, 1242, 592])
+        self.assertEqual(mesh.triangle_normals[0].tolist(), [0, 1, 2])
+        self.assertGreater(mesh.megabytes_per_second, 0)
+
+    def test_index_variants(self):
+        text = b"\n".join([
+            b"v 0 0 0", b"v 1 0 0", b"v 1 1 0", b"v 0 1 0",
+            b"vt 0 0", b"vt 1 0", b"vt 1 1",
+            b"vn 0 0 1",
+            b"f 1/1/1 2/2/1 3/3/1 4/1/1",  # quad
+            b"f -4 -3 -2",  # relative
+            b"f 1//1 2//1 3//1",
+            b"f 1/1 3/2 4/3",
+            b"g ignored",
+        ])
+        mesh = parse_obj(io.BytesIO(text), chunk_bytes=16)
+        self.assertEqual(mesh.triangle_positions.tolist(),
+                         [[0, 1, 2], [0, 2, 3], [0, 1, 2], [0, 1, 2], [0, 2, 3]])
+        self.assertEqual(mesh.triangle_texcoords.tolist(),
+                         [[0, 1, 2], [0, 2, 0], [-1, -1, -1], [-1, -1, -1], [0, 1, 2]])
+        self.assertEqual(mesh.triangle_normals.tolist(),
+                         [[0, 0, 0], [0, 0, 0], [-1, -1, -1], [0, 0, 0], [-1, -1, -1]])
+
+    def test_materials(self):
+        text = b"\n".join([
+            b"mtllib scene.mtl",
+            b"v 0 0 0", b"v 1 0 0", b"v 1 1 0", b"v 0 1 0",
+            b"f 1 2 3",
+            b"usemtl brick wall",
+            b"f 1 2 3 4",
+            b"usemtl wood",
+            b"f 1 3 4",
+            b"usemtl brick wall",
+            b"f 2 3 4",
+        ])
+        mesh = parse_obj(io.BytesIO(text), chunk_bytes=16)
+        self.assertEqual(mesh.material_names, ['brick wall', 'wood'])
+        self.assertEqual(mesh.material_libraries, ['scene.mtl'])
+        self.assertEqual(mesh.triangle_materials.tolist(), [-1, 0, 0, 1, 0])
+
+    def test_fan_triangles(self):
+        self.assertEqual(fan_triangles([5]).tolist(), [[0, 1, 2], [0, 2, 3], [0, 3, 4]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+#!/bin/env python
+
+import io
+import unittest
+
+import numpy
+from PIL import Image
+
+from vrprim.photosphere.decode import decode_image
+
+
+class TestDecodeImage(unittest.TestCase):
+    def encode(self, width, height, format='JPEG'):
+        fh = io.BytesIO()
+        Image.fromarray(numpy.zeros((height, width, 3), dtype=numpy.uint8)).save(fh, format)
+        fh.seek(0)
+        return fh
+
+    def test_reduced_equirectangular(self):
+        # slightly off 2:1, and reduced to an odd width
+        for width, height, max_width in ((1000, 499, 400), (1000, 500, 251), (1002, 500, 500)):
+            image = decode_image(self.encode(width, height), max_width=max_width, equirectangular=True)
+            self.assertEqual(image.shape[1], 2 * image.shape[0])
+            self.assertEqual(image.shape[1], max_width - max_width % 2)
+
+    def test_reduced_aspect(self):
+        image = decode_image(self.encode(800, 600, 'PNG'), max_width=400)
+        self.assertEqual(image.shape, (300, 400, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
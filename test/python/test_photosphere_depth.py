@@ -0,0 +1,45 @@
+#!/bin/env python
+
+import unittest
+from unittest import mock
+
+import numpy
+
+from vrprim.gpu_memory import GpuMemoryManager
+from vrprim.photosphere import DepthMapProxy, min_max_depth_pyramid
+
+
+class TestMinMaxDepthPyramid(unittest.TestCase):
+    def test_levels(self):
+        rng = numpy.random.RandomState(0)
+        depth = rng.uniform(1, 10, size=(8, 16))
+        levels = min_max_depth_pyramid(depth)
+        self.assertEqual([level.shape for level in levels],
+                         [(8, 16, 2), (4, 8, 2), (2, 4, 2), (1, 2, 2)])
+        self.assertTrue(all(level.dtype == numpy.float32 for level in levels))
+        self.assertTrue(numpy.array_equal(levels[0][..., 0], depth.astype(numpy.float32)))
+        self.assertTrue(numpy.array_equal(levels[0][..., 1], depth.astype(numpy.float32)))
+        # each cell bounds the level-zero texels it covers
+        for n, level in enumerate(levels):
+            block = depth.astype(numpy.float32)[0:2 ** n, 2 ** n:2 * 2 ** n]
+            self.assertEqual(level[0, 1].tolist(), [block.min(), block.max()])
+
+    def test_odd_size_and_max_levels(self):
+        self.assertEqual(len(min_max_depth_pyramid(numpy.ones((6, 12)))), 2)  # 3x6 cannot halve
+        self.assertEqual(len(min_max_depth_pyramid(numpy.ones((8, 16)), max_levels=2)), 2)
+
+
+class TestDepthMapProxy(unittest.TestCase):
+    def test_init_gl_twice(self):
+        proxy = DepthMapProxy(depth_array=numpy.ones((4, 8)))
+        with mock.patch('vrprim.photosphere.GL') as gl, \
+                mock.patch('vrprim.photosphere.gpu_memory_manager', GpuMemoryManager(release_cpu_copies=True)):
+            proxy.init_gl()
+            self.assertIsNone(proxy.pyramid)
+            proxy.init_gl()  # shared by a second panorama: nothing to upload again
+            self.assertEqual(gl.glGenTextures.call_count, 1)
+            self.assertEqual(gl.glTexSubImage2D.call_count, proxy.level_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
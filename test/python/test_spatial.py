@@ -0,0 +1,77 @@
+#!/bin/env python
+
+import unittest
+
+import numpy
+
+from vrprim.imposter.sphere.spatial import SphereGrid, StereoCullViews, frame_view_projections
+
+
+def perspective(fov_y_degrees, aspect, n, f):
+    t = n * numpy.tan(numpy.radians(fov_y_degrees) / 2.0)
+    r = aspect * t
+    return numpy.array(
+            [[n/r, 0.0, 0.0, 0.0],
+            [0.0, n/t, 0.0, 0.0],
+            [0.0, 0.0, -(f+n)/(f-n), -1.0],
+            [0.0, 0.0, -2.0*f*n/(f-n), 0.0]])
+
+
+class TestSphereGrid(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.centers = rng.uniform(-1, 1, size=(20000, 3)).astype(numpy.float32)
+        self.radius = 0.01
+        self.grid = SphereGrid(self.centers, self.radius, spheres_per_cell=64)
+        model_view = numpy.identity(4)
+        model_view[3, 2] = -1.0
+        self.view_projection = model_view.dot(perspective(60.0, 1.0, 0.1, 10.0))
+
+    def _drawn_mask(self, grid):
+        first, count = grid.visible_ranges([self.view_projection, ])
+        mask = numpy.zeros(len(self.centers), dtype=bool)
+        for f, c in zip(first, count):
+            mask[f:f+c] = True
+        return mask
+
+    def _inside_mask(self, centers):
+        clip = numpy.c_[centers, numpy.ones(len(centers))].dot(self.view_projection)
+        return numpy.all(numpy.abs(clip[:, 0:3]) <= clip[:, 3:4], axis=1)
+
+    def test_culling_is_conservative(self):
+        drawn = self._drawn_mask(self.grid)
+        inside = self._inside_mask(self.centers[self.grid.order])
+        self.assertFalse(numpy.any(inside & ~drawn))
+        self.assertLess(numpy.count_nonzero(drawn), len(self.centers))
+
+    def test_moved_spheres_stay_visible(self):
+        sorted_centers = self.centers[self.grid.order]
+        positions = numpy.arange(0, len(sorted_centers), 5)
+        sorted_centers[positions] *= -0.5
+        self.grid.update(positions, sorted_centers[positions], self.radius)
+        drawn = self._drawn_mask(self.grid)
+        inside = self._inside_mask(sorted_centers)
+        self.assertFalse(numpy.any(inside & ~drawn))
+
+
+class TestStereoCullViews(unittest.TestCase):
+    def test_view_projections(self):
+        eye_views = [numpy.identity(4), numpy.identity(4)]
+        eye_views[0][3, 0] = 0.03  # head to left eye
+        eye_views[1][3, 0] = -0.03
+        projections = [perspective(90.0, 0.9, 0.1, 10.0), perspective(100.0, 0.9, 0.1, 10.0)]
+        stereo = StereoCullViews(eye_views, projections)
+        head = numpy.identity(4)
+        head[3, 0:3] = [0.5, -1.0, 2.0]
+        head[0:3, 0:3] = [[0, 0, 1], [0, 1, 0], [-1, 0, 0]]
+        first = head.dot(eye_views[0])
+        views = frame_view_projections(stereo, first, projections[0])
+        self.assertEqual(len(views), 2)
+        for view, eye_view, projection in zip(views, eye_views, projections):
+            self.assertTrue(numpy.allclose(view, head.dot(eye_view).dot(projection)))
+        self.assertTrue(numpy.allclose(frame_view_projections(None, first, projections[0])[0],
+                                       first.dot(projections[0])))
+
+
+if __name__ == '__main__':
+    unittest.main()
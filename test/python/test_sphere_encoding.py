@@ -0,0 +1,48 @@
+#!/bin/env python
+
+import unittest
+
+import numpy
+
+from vrprim.imposter.sphere import sphere_array
+from vrprim.imposter.sphere.encoding import CompactSpheres, COMPACT_SPHERE_DTYPE
+
+
+class TestCompactSpheres(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        count = 10000
+        self.spheres = sphere_array(
+                rng.uniform(-10, 10, size=(count, 3)),
+                radii=rng.uniform(0.01, 0.05, size=count),
+                colors=rng.randint(0, 256, size=(count, 4)).astype(numpy.uint8))
+        self.compact = CompactSpheres(self.spheres, block_size=1024)
+
+    def test_size(self):
+        self.assertLess(COMPACT_SPHERE_DTYPE.itemsize, 10)
+
+    def test_position_bound(self):
+        block = numpy.arange(len(self.spheres)) // self.compact.block_size
+        frames = self.compact.block_frames.astype(numpy.float64)
+        decoded = frames[block, 0, 0:3] + frames[block, 1, 0:3] * self.compact.data['offset']
+        error = numpy.abs(decoded - self.spheres['center']).max(axis=0)
+        self.assertTrue(numpy.all(error <= self.compact.max_position_error * 1.001))
+
+    def test_radius_bound(self):
+        r_min, r_step = self.compact.radius_range
+        decoded = r_min + r_step * self.compact.data['radius_index']
+        error = numpy.abs(decoded - self.spheres['radius']).max()
+        self.assertLessEqual(error, self.compact.max_radius_error * 1.001)
+
+    def test_palette(self):
+        self.assertLessEqual(len(self.compact.palette), 256)
+        few_colors = self.spheres.copy()
+        few_colors['color'][::2] = (255, 0, 0, 255)
+        few_colors['color'][1::2] = (0, 0, 255, 255)
+        compact = CompactSpheres(few_colors)
+        self.assertEqual(compact.max_color_error, 0)
+        self.assertEqual(len(compact.palette), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
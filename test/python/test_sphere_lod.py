@@ -0,0 +1,55 @@
+#!/bin/env python
+
+import unittest
+
+import numpy
+
+from vrprim.imposter.sphere import sphere_array
+from vrprim.imposter.sphere.lod import SphereLevelsOfDetail
+from vrprim.imposter.sphere.spatial import SphereGrid
+
+
+class TestSphereLevelsOfDetail(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        spheres = sphere_array(rng.uniform(-1, 1, size=(50000, 3)), radii=0.003)
+        self.grid = SphereGrid(spheres['center'], spheres['radius'])
+        self.spheres = spheres[self.grid.order]
+        self.lod = SphereLevelsOfDetail(self.spheres, self.grid)
+        self.projection = numpy.array(
+                [[1.7, 0.0, 0.0, 0.0],
+                [0.0, 1.7, 0.0, 0.0],
+                [0.0, 0.0, -1.0, -1.0],
+                [0.0, 0.0, -0.2, 0.0]])
+
+    def _levels(self, distance):
+        model_view = numpy.identity(4)
+        model_view[3, 2] = -distance
+        return self.lod.select_levels(model_view, self.projection, 1000)
+
+    def test_fewer_spheres_per_level(self):
+        counts = [c.sum() for c in self.lod.cell_count]
+        self.assertEqual(counts[0], len(self.spheres))
+        self.assertTrue(all(a > b for a, b in zip(counts, counts[1:])))
+        self.assertEqual(counts[-1], len(self.grid.cell_start))
+
+    def test_projected_area_kept(self):
+        area = numpy.sum(self.spheres['radius'] ** 2)
+        coarse = self.lod.spheres[self.lod.cell_start[1][0]:]
+        coarse = coarse[:self.lod.cell_count[1].sum()]
+        self.assertAlmostEqual(numpy.sum(coarse['radius'] ** 2) / area, 1.0, places=3)
+
+    def test_coarser_with_distance(self):
+        self.assertTrue(numpy.all(self._levels(3.0) == 0))
+        self.assertTrue(numpy.all(self._levels(300.0) == self.lod.level_count - 1))
+
+    def test_every_visible_cell_drawn_once(self):
+        levels = self._levels(30.0)
+        visible = numpy.ones(len(levels), dtype=bool)
+        (first, count), (lod_first, lod_count) = self.lod.visible_ranges(visible, levels)
+        expected = sum(self.lod.cell_count[k][levels == k].sum() for k in range(self.lod.level_count))
+        self.assertEqual(count.sum() + lod_count.sum(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/bin/env python
+
+import unittest
+
+import numpy
+import openvr
+
+from vrprim.imposter.sphere.picking import SpherePicker, ray_sphere_distances, controller_rays
+
+
+class TestSpherePicker(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.centers = rng.uniform(-1, 1, size=(20000, 3))
+        self.radii = rng.uniform(0.005, 0.02, size=20000)
+        self.picker = SpherePicker(self.centers, self.radii)
+        # rays from outside the sphere set, aimed at random points inside it
+        self.origins = rng.uniform(-1, 1, size=(40, 3))
+        self.origins[:, 2] = 3.0
+        self.directions = rng.uniform(-1, 1, size=(40, 3)) - self.origins
+
+    def _brute_force(self):
+        result = []
+        for origin, direction in zip(self.origins, self.directions):
+            direction = direction / numpy.linalg.norm(direction)
+            t = ray_sphere_distances(origin, direction, self.centers, self.radii)
+            k = numpy.argmin(t)
+            result.append(k if numpy.isfinite(t[k]) else -1)
+        return numpy.array(result)
+
+    def test_matches_brute_force(self):
+        indices, distances = self.picker.pick(self.origins, self.directions)
+        self.assertTrue(numpy.all(indices == self._brute_force()))
+        self.assertTrue(numpy.all(numpy.isinf(distances[indices < 0])))
+
+    def test_single_ray(self):
+        indices, distances = self.picker.pick([0, 0, 3], [0, 0, -1])
+        self.assertEqual(indices.shape, (1,))
+
+    def test_max_distance(self):
+        indices, distances = self.picker.pick(self.origins, self.directions, max_distance=1.0)
+        self.assertTrue(numpy.all(indices == -1))
+
+    def test_moved_spheres(self):
+        moved = numpy.arange(0, len(self.centers), 3)
+        self.centers[moved] *= -0.5
+        self.picker.move_spheres(moved, self.centers[moved])
+        indices, distances = self.picker.pick(self.origins, self.directions)
+        self.assertTrue(numpy.all(indices == self._brute_force()))
+
+    def test_controller_rays(self):
+        pose = numpy.array([[1, 0, 0, 0.5], [0, 1, 0, 1.5], [0, 0, 1, 2.5]])
+        origins, directions = controller_rays([pose, pose])
+        self.assertEqual(origins.tolist(), [[0.5, 1.5, 2.5], ] * 2)
+        self.assertEqual(directions[0].tolist(), [0, 0, -1])
+
+    def test_controller_rays_openvr(self):
+        pose = openvr.HmdMatrix34_t()
+        for i, row in enumerate([[0, 1, 0, 0.5], [0, 0, 1, 1.5], [1, 0, 0, 2.5]]):
+            for j, value in enumerate(row):
+                pose.m[i][j] = value
+        origins, directions = controller_rays([pose, ])
+        self.assertEqual(origins.tolist(), [[0.5, 1.5, 2.5], ])
+        self.assertEqual(directions.tolist(), [[0, -1, 0], ])
+
+
+if __name__ == '__main__':
+    unittest.main()
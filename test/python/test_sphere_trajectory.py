@@ -0,0 +1,109 @@
+#!/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+from vrprim.imposter.sphere.trajectory import (TrajectoryFile, TrajectoryPlayer,
+                                               convert_to_trajectory, write_trajectory)
+
+
+class FakeSphereActor(object):
+    def __init__(self):
+        self.centers = None
+
+    def update_spheres(self, first=0, centers=None, radii=None, colors=None):
+        self.centers = centers
+
+
+class BlockingTrajectory(object):
+    "Frames are read only once release is set"
+    def __init__(self, frame_count):
+        self.frame_count = frame_count
+        self.release = threading.Event()
+        self.requested = []
+
+    def __len__(self):
+        return self.frame_count
+
+    def frame(self, index):
+        self.requested.append(index)
+        self.release.wait()
+        return numpy.full((1, 3), index, dtype=numpy.float32)
+
+
+class TestTrajectory(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(0)
+        self.frames = rng.uniform(-50, 50, size=(5, 7, 3))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        path = os.path.join(self.folder, 'float.traj')
+        self.assertEqual(write_trajectory(path, iter(self.frames), 7), 5)
+        trajectory = TrajectoryFile(path)
+        self.assertEqual((len(trajectory), trajectory.sphere_count), (5, 7))
+        for i, xyz in enumerate(self.frames):
+            self.assertTrue(numpy.array_equal(trajectory.frame(i), xyz.astype(numpy.float32)))
+
+    def test_quantized_round_trip(self):
+        path = os.path.join(self.folder, 'int16.traj')
+        bounds = (self.frames.min(axis=(0, 1)), self.frames.max(axis=(0, 1)))
+        write_trajectory(path, self.frames, 7, quantize=True, bounds=bounds)
+        trajectory = TrajectoryFile(path)
+        self.assertEqual(os.path.getsize(path), 64 + 5 * 7 * 3 * 2)
+        for i, xyz in enumerate(self.frames):
+            error = numpy.abs(trajectory.frame(i) - xyz)
+            self.assertTrue(numpy.all(error <= 0.5 * trajectory.scale + 1e-5))
+
+    def test_convert_xyz(self):
+        src = os.path.join(self.folder, 'frames.xyz')
+        with open(src, 'w') as fh:
+            for xyz in self.frames:
+                fh.write('7\ncomment\n')
+                for x, y, z in xyz:
+                    fh.write('C %.6f %.6f %.6f\n' % (x, y, z))
+        dst = os.path.join(self.folder, 'frames.traj')
+        self.assertEqual(convert_to_trajectory(src, dst), 5)
+        self.assertTrue(numpy.allclose(TrajectoryFile(dst).frame(4), self.frames[4], atol=1e-4))
+
+    def test_convert_pdb(self):
+        src = os.path.join(self.folder, 'frames.pdb')
+        with open(src, 'w') as fh:
+            for m, xyz in enumerate(self.frames):
+                fh.write('MODEL     %4d\n' % (m + 1))
+                for i, (x, y, z) in enumerate(xyz):
+                    fh.write('ATOM  %5d  CA  ALA A   1    %8.3f%8.3f%8.3f  1.00  0.00           C\n' % (i + 1, x, y, z))
+                fh.write('ENDMDL\n')
+        dst = os.path.join(self.folder, 'frames.traj')
+        self.assertEqual(convert_to_trajectory(src, dst, quantize=True), 5)
+        trajectory = TrajectoryFile(dst)
+        self.assertTrue(numpy.allclose(trajectory.frame(2), self.frames[2], atol=1e-3 + trajectory.scale.max()))
+
+    def test_player_does_not_wait_or_wrap(self):
+        trajectory = BlockingTrajectory(10)
+        actor = FakeSphereActor()
+        player = TrajectoryPlayer(trajectory, actor, frames_per_second=1.0, prefetch_count=4, loop=False)
+        try:
+            player.start(now=0.0)
+            self.assertIsNone(player.update(now=8.0))  # frame 8 is still being read
+            self.assertIsNone(actor.centers)
+            self.assertEqual(sorted(player._prefetched), [8, 9])
+            trajectory.release.set()
+            player._prefetched[8].result()
+            self.assertEqual(player.update(now=8.0), 8)
+            self.assertEqual(actor.centers[0, 0], 8)
+        finally:
+            trajectory.release.set()
+            player.close()
+
+
+if __name__ == '__main__':
+    unittest.main()